@@ -0,0 +1,73 @@
+"""
+Compare the cost of a hot path log call on the calling thread.
+
+Times logging one INFO line per message with the former setup, an
+f-string written synchronously by basicConfig's stream handler, against
+setup_logging with lazy %-formatting, where records are rate limited and
+formatted and written by the listener thread. Output goes to /dev/null.
+Run from the repository root:
+
+    python -m benchmarks.bench_logging --messages 100000
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+
+import service_logging
+
+
+def synchronous(messages):
+    logging.basicConfig(
+        level=logging.INFO, format=service_logging.FORMAT, force=True)
+    start = time.perf_counter()
+    for index in range(messages):
+        logging.info(f"Data from device{index % 100} within deadband")
+    return time.perf_counter() - start
+
+
+def queued(messages):
+    listener = service_logging.setup_logging()
+    start = time.perf_counter()
+    for index in range(messages):
+        logging.info("Data from %s within deadband", f"device{index % 100}")
+    elapsed = time.perf_counter() - start
+    listener.stop()
+    return elapsed
+
+
+def summarized(messages):
+    listener = service_logging.setup_logging()
+    summary = service_logging.PeriodicSummary()
+    start = time.perf_counter()
+    for _ in range(messages):
+        summary.add("suppressed")
+    elapsed = time.perf_counter() - start
+    listener.stop()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark hot path logging setups")
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=100000,
+        help="Log calls per setup, default is 100000",
+    )
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stderr = open(os.devnull, "w")
+    print(f"{'setup':>12} {'us per call':>12}", file=stdout)
+    for name, run in (
+        ("synchronous", synchronous),
+        ("queued", queued),
+        ("summarized", summarized),
+    ):
+        elapsed = run(args.messages)
+        print(f"{name:>12} {elapsed / args.messages * 1e6:>12.2f}",
+              file=stdout)
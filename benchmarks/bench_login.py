@@ -0,0 +1,74 @@
+"""
+Compare logins per second of the former and the current login flow.
+
+The former flow checked the password in UserLoginSerializer and again in
+authenticate(), the current one checks it once. Both run in a single
+thread, like one worker, against a throwaway test database. Run from the
+repository root:
+
+    python -m benchmarks.bench_login --logins 20
+"""
+
+import time
+import argparse
+
+from benchmarks import django_setup
+
+
+def former_login(username, password):
+    from django.contrib.auth import authenticate, get_user_model
+    from rest_framework.authtoken.models import Token
+
+    user = get_user_model().objects.get(username=username)
+    if not user.check_password(password):
+        return None
+    user = authenticate(username=username, password=password)
+    return Token.objects.get_or_create(user=user)[0]
+
+
+def current_login(username, password):
+    from rest_framework.authtoken.models import Token
+    from rest_app.serializers import UserLoginSerializer
+
+    serializer = UserLoginSerializer(
+        data={"username": username, "password": password})
+    serializer.is_valid(raise_exception=True)
+    return Token.objects.get_or_create(
+        user=serializer.validated_data["user"])[0]
+
+
+def run(logins):
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    get_user_model().objects.create_user("benchuser", "benchpassword")
+    print(f"{'flow':>8} {'queries':>8} {'ms/login':>9} {'logins/s':>9}")
+    for name, login in (("former", former_login),
+                        ("current", current_login)):
+        login("benchuser", "benchpassword")
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for _ in range(logins):
+                login("benchuser", "benchpassword")
+            elapsed = time.perf_counter() - start
+        print(
+            f"{name:>8} {len(queries) / logins:>8.1f} "
+            f"{elapsed / logins * 1000:>9.1f} {logins / elapsed:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the former and the current login flow")
+    parser.add_argument(
+        "--logins",
+        type=int,
+        default=20,
+        help="Logins per flow, default is 20",
+    )
+    args = parser.parse_args()
+
+    django_setup.setup()
+    with django_setup.test_database():
+        run(args.logins)
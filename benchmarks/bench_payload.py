@@ -0,0 +1,72 @@
+"""
+Compare the JSON and compact crypto payloads.
+
+Reports bytes on the wire and the decode cost per message for a range of
+coin limits. Run from the repository root:
+
+    python -m benchmarks.bench_payload --limits 10 100 --messages 20000
+"""
+
+import time
+import random
+import argparse
+
+import payload_codec
+
+
+def sample_message(limit):
+    known = payload_codec.SYMBOL_DICTIONARY
+    cryptos = []
+    for rank in range(limit):
+        if rank < len(known):
+            asset_id, symbol = known[rank]
+        else:
+            asset_id, symbol = f"asset-{rank}", f"A{rank}"
+        cryptos.append({
+            "id": asset_id,
+            "symbol": symbol,
+            "priceUsd": f"{random.uniform(0.001, 70000):.16f}",
+        })
+    return {"timestamp": int(time.time() * 1000), "crypto": cryptos}
+
+
+def decode_cost(payload, messages, content_type=None):
+    start = time.perf_counter()
+    for _ in range(messages):
+        payload_codec.decode(payload, content_type)
+    return (time.perf_counter() - start) / messages * 1e6
+
+
+def run(limits, messages):
+    print(f"{'limit':>6} {'format':>8} {'bytes':>8} {'decode us':>10}")
+    for limit in limits:
+        data = sample_message(limit)
+        for payload_format in payload_codec.PAYLOAD_FORMATS:
+            payload, content_type = payload_codec.encode(data, payload_format)
+            if isinstance(payload, str):
+                payload = payload.encode()
+            cost = decode_cost(payload, messages, content_type)
+            print(
+                f"{limit:>6} {payload_format:>8} {len(payload):>8} "
+                f"{cost:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark JSON against compact crypto payloads")
+    parser.add_argument(
+        "--limits",
+        type=int,
+        nargs="+",
+        default=[10, 100, 2000],
+        help="Number of coins per message, default is 10 100 2000",
+    )
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=10000,
+        help="Number of decodes per measurement, default is 10000",
+    )
+    args = parser.parse_args()
+    run(args.limits, args.messages)
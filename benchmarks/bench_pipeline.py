@@ -0,0 +1,529 @@
+"""
+Measure the throughput of the ingest and read paths end to end.
+
+Every scenario runs the real service classes in a fresh process against
+local stand-ins, and records messages or queries per second, p50/p99
+latency and the peak RSS of the process:
+
+- ingest: DeviceSimulator -> LoopbackBroker -> MQTTMongoBridge -> MongoDB
+- modbus: CoinCap stub -> Modbus TLS server -> ModbusPersistenceClient ->
+  MongoDB, with a throwaway self-signed certificate
+- read: MongoService symbol and device history queries
+
+Prices come from the in-process CoinCap stub. Without --mongo_uri the
+collections are kept in mongomock (pip install mongomock), pass a
+MongoDB server to measure the real write and query paths. Run from the
+repository root, keep the report of a release and compare later runs to
+it:
+
+    python -m benchmarks.bench_pipeline --output baseline.json
+    python -m benchmarks.bench_pipeline --compare baseline.json
+"""
+
+import os
+import ssl
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import importlib.util
+
+from concurrent.futures import ProcessPoolExecutor
+
+import certifi
+
+from benchmarks import django_setup
+from benchmarks.bench_symbol_history import percentile, populate
+from benchmarks.loopback_broker import LoopbackBroker
+from benchmarks.stub_coincap import StubCoinCapServer
+from tests import self_signed_certificate
+import payload_codec
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOPIC = "crypto/data"
+
+
+def load_service(filename):
+    """Import a service script of the repository root as a module."""
+    name = os.path.splitext(filename)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def mongo_client_factory(mongo_uri):
+    """
+    Return a callable creating the MongoDB clients of the services.
+
+    Without URI every client is the same mongomock client, so the
+    services and the benchmark see the same collections.
+    """
+    if mongo_uri:
+        from pymongo import MongoClient
+        return lambda *args, **kwargs: MongoClient(mongo_uri)
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit(
+            "Without --mongo_uri the benchmark needs mongomock, "
+            "pip install mongomock")
+    client = mongomock.MongoClient()
+    return lambda *args, **kwargs: client
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def max_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(rss / (1024 ** 2 if sys.platform == "darwin" else 1024), 1)
+
+
+def latency_results(prefix, timings_ms, count, seconds):
+    return {
+        f"{prefix}_per_sec": round(count / seconds, 1) if seconds else 0.0,
+        f"{prefix}_p50_ms": round(percentile(timings_ms, 0.5), 3),
+        f"{prefix}_p99_ms": round(percentile(timings_ms, 0.99), 3),
+    }
+
+
+def run_ingest(config):
+    """Publish from simulated devices through the bridge into MongoDB."""
+    stub = StubCoinCapServer(
+        assets=config["coins"], period=config["interval"]).start()
+    os.environ["COINCAP_API_URL"] = stub.url
+    # Clients are built with TLS settings but never connect, any CA
+    # bundle will do.
+    os.environ["MQTT_CA_CERT_PATH"] = certifi.where()
+    simulator_module = load_service("mqtt-simulator.py")
+    persistence = load_service("mqtt-persistence.py")
+    client = mongo_client_factory(config["mongo_uri"])
+    persistence.MongoClient = client
+    db = client()[config["db"]]
+    db.ingest.drop()
+    db.ingest_symbols.drop()
+
+    broker = LoopbackBroker().start()
+    compact = config["payload_format"] == payload_codec.COMPACT
+    bridge = persistence.MQTTMongoBridge(
+        "loopback", 0, TOPIC, config["mongo_uri"], config["db"], "ingest",
+        mqtt_v5=compact,
+        batch_size=config["batch_size"],
+        flush_interval=config["flush_interval"],
+        layout=config["layout"],
+        symbol_collection="ingest_symbols",
+    )
+    bridge.mqtt_client = broker.attach(bridge.mqtt_client)
+    bridge_thread = threading.Thread(target=bridge.run)
+    bridge_thread.start()
+
+    simulator = simulator_module.DeviceSimulator(
+        "loopback", 0, None, None, TOPIC,
+        devices=config["devices"],
+        connections=config["connections"],
+        interval=config["interval"],
+        rate=config["rate"],
+        limits=[config["coins"]],
+        payload_format=config["payload_format"],
+        qos=1,
+    )
+    simulator.clients = [broker.attach(c) for c in simulator.clients]
+    start = time.perf_counter()
+    simulator.run(config["duration"], report_interval=config["duration"])
+    broker.drain()
+    bridge.mqtt_client.disconnect()
+    bridge_thread.join()
+    seconds = time.perf_counter() - start
+    broker.stop()
+    stub.stop()
+
+    latencies = [
+        document["trace"]["persisted"] - document["trace"]["published"]
+        for document in db.ingest.find({}, {"_id": 0, "trace": 1})
+    ]
+    results = {
+        "offered_rate": round(config["devices"] / config["interval"], 1),
+        "published": simulator.published,
+        "delivered": broker.delivered,
+        # Repeated publishes of an unchanged sample share an _id
+        "persisted": len(latencies),
+        "seconds": round(seconds, 3),
+    }
+    results.update(
+        latency_results("msgs", latencies, broker.delivered, seconds))
+    return results
+
+
+def run_modbus(config):
+    """Poll the Modbus TLS server and persist the registers in MongoDB."""
+    stub = StubCoinCapServer(
+        assets=config["coins"], period=config["interval"]).start()
+    os.environ["COINCAP_API_URL"] = stub.url
+    directory = tempfile.TemporaryDirectory()
+    certfile, keyfile = self_signed_certificate(directory.name)
+    for name, path in (
+        ("MODBUS_SERVER_CERT_PATH", certfile),
+        ("MODBUS_SERVER_KEY_PATH", keyfile),
+        ("MODBUS_CA_CERT_PATH", certfile),
+        ("MODBUS_CLIENT_CERT_PATH", certfile),
+        ("MODBUS_CLIENT_KEY_PATH", keyfile),
+    ):
+        os.environ[name] = path
+    server = load_service("modbus-server.py")
+    client_module = load_service("modbus-client.py")
+    client_module.MongoClient = mongo_client_factory(config["mongo_uri"])
+
+    context = server.setup_server_context()
+    threading.Thread(
+        target=server.update_registers,
+        args=(context, config["interval"]),
+        daemon=True,
+    ).start()
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    port = free_port()
+    threading.Thread(
+        target=server.StartTlsServer,
+        kwargs={
+            "context": context,
+            "identity": None,
+            "address": ("localhost", port),
+            "sslctx": ssl_context,
+        },
+        daemon=True,
+    ).start()
+
+    deadline = time.monotonic() + 10
+    while not server.UPDATES.default.value:
+        if time.monotonic() > deadline:
+            raise SystemExit("The Modbus server did not start")
+        time.sleep(0.01)
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+    client = client_module.ModbusPersistenceClient(
+        "localhost", port, config["mongo_uri"], config["db"], "modbus",
+        config["interval"])
+    client.collection.drop()
+    writer = threading.Thread(target=client.write_samples)
+    writer.start()
+
+    timings = []
+    start = time.perf_counter()
+    end = start + config["duration"]
+    while time.perf_counter() < end:
+        started = time.perf_counter()
+        client.poll()
+        timings.append((time.perf_counter() - started) * 1000)
+    seconds = time.perf_counter() - start
+    client.stopped.set()
+    writer.join()
+    client.modbus_client.close()
+    stub.stop()
+    directory.cleanup()
+
+    results = {
+        "reads": len(timings),
+        "read_errors": client_module.READ_ERRORS.default.value,
+        "persisted": client.collection.count_documents({}),
+        "seconds": round(seconds, 3),
+    }
+    results.update(latency_results("reads", timings, len(timings), seconds))
+    return results
+
+
+def run_read(config):
+    """Query symbol and device histories through MongoService."""
+    sys.path.insert(0, django_setup.DJANGO_PROJECT)
+    from rest_app import mongo_service
+    from rest_app.archive_service import ArchiveService
+
+    client = mongo_client_factory(config["mongo_uri"])
+    mongo_service.MongoClient = client
+    populate(
+        client()[config["db"]], config["read_devices"],
+        config["read_samples"], config["coins"])
+    directory = tempfile.TemporaryDirectory()
+    service = mongo_service.MongoService(
+        db=config["db"], mqtt_col="embedded", mb_col="modbus",
+        symbol_col="exploded", archive=ArchiveService(directory.name))
+
+    symbols = [
+        symbol for _, symbol in
+        payload_codec.SYMBOL_DICTIONARY[:config["coins"]]
+    ]
+    queries = {
+        "symbol_history": lambda: service.find_symbol_history(
+            random.choice(symbols)),
+        "device_data": lambda: list(service.find_by_device_id(
+            f"dev{random.randrange(config['read_devices'])}")),
+    }
+    results = {}
+    for name, query in queries.items():
+        timings = []
+        start = time.perf_counter()
+        for _ in range(config["queries"]):
+            started = time.perf_counter()
+            query()
+            timings.append((time.perf_counter() - started) * 1000)
+        results.update(latency_results(
+            name, timings, len(timings), time.perf_counter() - start))
+    directory.cleanup()
+    return results
+
+
+SCENARIOS = {
+    "ingest": run_ingest,
+    "modbus": run_modbus,
+    "read": run_read,
+}
+
+
+def run_scenario(name, config):
+    import logging
+    from service_logging import setup_logging
+    setup_logging(logging.WARNING)
+    random.seed(config["seed"])
+    results = SCENARIOS[name](config)
+    results["max_rss_mb"] = max_rss_mb()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, check=True,
+            capture_output=True, text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(config, scenarios):
+    """Run every scenario in its own process and return the report."""
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mongo": "mongodb" if config["mongo_uri"] else "mongomock",
+        "config": {
+            key: value for key, value in config.items() if key != "mongo_uri"
+        },
+        "scenarios": {},
+    }
+    spawn = multiprocessing.get_context("spawn")
+    for name in scenarios:
+        with ProcessPoolExecutor(1, mp_context=spawn) as pool:
+            results = pool.submit(run_scenario, name, config).result()
+        report["scenarios"][name] = results
+        print(f"{name}: {json.dumps(results)}")
+    return report
+
+
+def compare(baseline, report, tolerance):
+    """
+    Print the changes of a report against a baseline report.
+
+    Rates (*_per_sec) regress when they drop, latencies (*_ms) and memory
+    (*_mb) when they grow, by more than tolerance percent.
+
+    Returns:
+        list: The regressed "scenario.metric" names.
+    """
+    if (baseline.get("config") != report["config"]
+            or baseline.get("mongo") != report["mongo"]):
+        print("Warning: the baseline ran with another configuration")
+    regressions = []
+    print(f"{'metric':>32} {'baseline':>12} {'current':>12} {'change':>8}")
+    for scenario, results in report["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario, {})
+        for name, value in results.items():
+            old = base.get(name)
+            if not isinstance(old, (int, float)) or not old:
+                continue
+            change = (value - old) / old * 100
+            if name.endswith("_per_sec"):
+                worse = -change
+            elif name.endswith(("_ms", "_mb")):
+                worse = change
+            else:
+                continue
+            metric = f"{scenario}.{name}"
+            flag = ""
+            if worse > tolerance:
+                regressions.append(metric)
+                flag = " regression"
+            print(
+                f"{metric:>32} {old:>12g} {value:>12g} {change:>+7.1f}%"
+                f"{flag}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ingest and read paths end to end")
+    parser.add_argument(
+        "--scenarios",
+        type=str,
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+        help="Scenarios to run, default is all",
+    )
+    parser.add_argument(
+        "--mongo_uri",
+        type=str,
+        default=None,
+        help="MongoDB server to use, default is an in-process mongomock",
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="bench_pipeline",
+        help="Scratch database, its collections are dropped, "
+        "default is bench_pipeline",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10,
+        help="Seconds the ingest and modbus scenarios run, default is 10",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=1000,
+        help="Number of simulated MQTT devices, default is 1000",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=4,
+        help="MQTT connections shared by the devices, default is 4",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Seconds between two publishes of a device and between two "
+        "price updates, default is 1",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="Maximum total publishes per second, default is no limit",
+    )
+    parser.add_argument(
+        "--coins",
+        type=int,
+        default=10,
+        help="Coins per sample, default is 10",
+    )
+    parser.add_argument(
+        "--payload_format",
+        type=str,
+        choices=payload_codec.PAYLOAD_FORMATS,
+        default=payload_codec.JSON,
+        help="Encoding of published data, default is json",
+    )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        choices=("embedded", "exploded", "both"),
+        default="embedded",
+        help="Document layout of the bridge, default is embedded",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=100,
+        help="Bulk insert size of the bridge, default is 100",
+    )
+    parser.add_argument(
+        "--flush_interval",
+        type=float,
+        default=1.0,
+        help="Maximum seconds between two bridge flushes, default is 1",
+    )
+    parser.add_argument(
+        "--read_devices",
+        type=int,
+        default=10,
+        help="Devices stored for the read scenario, default is 10",
+    )
+    parser.add_argument(
+        "--read_samples",
+        type=int,
+        default=500,
+        help="Samples per device stored for the read scenario, "
+        "default is 500",
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=100,
+        help="Queries per read path, default is 100",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the random prices and schedules, default is 0",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="File the JSON report is written to, default is none",
+    )
+    parser.add_argument(
+        "--compare",
+        type=str,
+        default=None,
+        help="Baseline JSON report to compare with, default is none",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=10,
+        help="Percent change of a metric reported as a regression, "
+        "default is 10",
+    )
+    args = parser.parse_args()
+
+    config = {
+        key: value for key, value in vars(args).items()
+        if key not in ("scenarios", "output", "compare", "tolerance")
+    }
+    report = run(config, args.scenarios)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(json.load(baseline), report, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,158 @@
+"""
+Compare single-symbol history queries on the embedded and exploded layouts.
+
+Fills a scratch database with the same samples in both layouts, then
+times reading the price history of one symbol. Needs a MongoDB server,
+run from the repository root:
+
+    python -m benchmarks.bench_symbol_history --mongo_uri mongodb://localhost
+"""
+
+import time
+import random
+import argparse
+
+from pymongo import MongoClient
+
+from benchmarks.bench_payload import sample_message
+import payload_codec
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def populate(db, devices, samples, coins, batch_size=1000):
+    db.embedded.drop()
+    db.exploded.drop()
+    db.exploded.create_index([("s", 1), ("t", 1)])
+    db.exploded.create_index([("d", 1), ("s", 1), ("t", 1)])
+    db.embedded.create_index("device_id")
+
+    embedded, exploded = [], []
+    for sample in range(samples):
+        message = sample_message(coins)
+        timestamp = 1700000000000 + sample * 60000
+        for device in range(devices):
+            device_id = f"dev{device}"
+            embedded.append({
+                "timestamp": timestamp,
+                "crypto": message["crypto"],
+                "device_id": device_id,
+            })
+            exploded.extend(
+                {
+                    "d": device_id,
+                    "s": item["symbol"],
+                    "t": timestamp,
+                    "p": float(item["priceUsd"]),
+                }
+                for item in message["crypto"]
+            )
+            if len(embedded) >= batch_size:
+                db.embedded.insert_many(embedded, ordered=False)
+                db.exploded.insert_many(exploded, ordered=False)
+                embedded, exploded = [], []
+    if embedded:
+        db.embedded.insert_many(embedded, ordered=False)
+        db.exploded.insert_many(exploded, ordered=False)
+
+
+def query_embedded(db, symbol, device_id):
+    match = {"crypto.symbol": symbol}
+    if device_id:
+        match["device_id"] = device_id
+    return list(db.embedded.aggregate([
+        {"$match": match},
+        {"$unwind": "$crypto"},
+        {"$match": {"crypto.symbol": symbol}},
+        {"$project": {
+            "_id": 0,
+            "d": "$device_id",
+            "t": "$timestamp",
+            "p": {"$toDouble": "$crypto.priceUsd"},
+        }},
+        {"$sort": {"t": 1}},
+    ]))
+
+
+def query_exploded(db, symbol, device_id):
+    query = {"s": symbol}
+    if device_id:
+        query["d"] = device_id
+    return list(db.exploded.find(query, {"_id": 0}).sort("t", 1))
+
+
+def run(db, devices, queries, per_device):
+    symbols = [symbol for _, symbol in payload_codec.SYMBOL_DICTIONARY[:10]]
+    print(f"{'layout':>9} {'rows':>7} {'p50 ms':>8} {'p99 ms':>8}")
+    for layout, query in (
+        ("embedded", query_embedded), ("exploded", query_exploded)
+    ):
+        timings, rows = [], 0
+        for _ in range(queries):
+            symbol = random.choice(symbols)
+            device_id = (
+                f"dev{random.randrange(devices)}" if per_device else None)
+            start = time.perf_counter()
+            rows = len(query(db, symbol, device_id))
+            timings.append((time.perf_counter() - start) * 1000)
+        print(
+            f"{layout:>9} {rows:>7} {percentile(timings, 0.5):>8.2f} "
+            f"{percentile(timings, 0.99):>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark symbol history queries per layout")
+    parser.add_argument(
+        "--mongo_uri",
+        type=str,
+        default="mongodb://localhost:27017",
+        help="MongoDB server to use, default is mongodb://localhost:27017",
+    )
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="bench_symbol_history",
+        help="Scratch database, dropped collections are embedded and "
+        "exploded, default is bench_symbol_history",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=10,
+        help="Number of devices, default is 10",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1000,
+        help="Samples per device, default is 1000",
+    )
+    parser.add_argument(
+        "--coins",
+        type=int,
+        default=10,
+        help="Coins per sample, default is 10",
+    )
+    parser.add_argument(
+        "--queries",
+        type=int,
+        default=50,
+        help="Queries per layout, default is 50",
+    )
+    parser.add_argument(
+        "--per_device",
+        action="store_true",
+        help="Query the history of one device instead of all devices",
+    )
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    db = client[args.db]
+    populate(db, args.devices, args.samples, args.coins)
+    run(db, args.devices, args.queries, args.per_device)
+    client.close()
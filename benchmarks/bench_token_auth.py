@@ -0,0 +1,80 @@
+"""
+Compare token authentication with and without the token cache.
+
+Creates users with tokens in a throwaway test database, then
+authenticates requests carrying tokens picked at random, counting the
+database queries. Run from the repository root:
+
+    python -m benchmarks.bench_token_auth --users 100 --requests 10000
+"""
+
+import time
+import random
+import argparse
+
+from benchmarks import django_setup
+
+
+def run(users, requests):
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from rest_framework.authentication import TokenAuthentication
+    from rest_framework.authtoken.models import Token
+    from rest_framework.test import APIRequestFactory
+
+    from rest_app.authentication import (
+        CachedTokenAuthentication, token_cache)
+
+    User = get_user_model()
+    keys = []
+    for index in range(users):
+        user = User(username=f"benchuser{index}")
+        user.set_unusable_password()
+        user.save()
+        keys.append(Token.objects.create(user=user).key)
+
+    factory = APIRequestFactory()
+    sample = [
+        factory.get("/api/mqtt/data",
+                    HTTP_AUTHORIZATION="Token " + random.choice(keys))
+        for _ in range(requests)
+    ]
+
+    print(f"{'authentication':>26} {'queries/req':>12} {'us/req':>8} "
+          f"{'req/s':>9}")
+    for authentication in (TokenAuthentication, CachedTokenAuthentication):
+        token_cache.clear()
+        authenticator = authentication()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            for request in sample:
+                authenticator.authenticate(request)
+            elapsed = time.perf_counter() - start
+        print(
+            f"{authentication.__name__:>26} "
+            f"{len(queries) / requests:>12.3f} "
+            f"{elapsed / requests * 1e6:>8.1f} {requests / elapsed:>9.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark token authentication with and without cache")
+    parser.add_argument(
+        "--users",
+        type=int,
+        default=100,
+        help="Number of users with a token, default is 100",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=10000,
+        help="Number of authenticated requests, default is 10000",
+    )
+    args = parser.parse_args()
+
+    django_setup.setup()
+    with django_setup.test_database():
+        run(args.users, args.requests)
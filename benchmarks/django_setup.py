@@ -0,0 +1,35 @@
+"""
+Set up the Django project for benchmarks run from the repository root.
+
+The settings default to backend.settings and can be overridden with
+DJANGO_SETTINGS_MODULE. Benchmarks run against a throwaway test
+database, like the test suite.
+"""
+
+import os
+import sys
+import contextlib
+
+DJANGO_PROJECT = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "django-project",
+)
+
+
+def setup():
+    sys.path.insert(0, DJANGO_PROJECT)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+    import django
+    django.setup()
+
+
+@contextlib.contextmanager
+def test_database():
+    from django.db import connection
+
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
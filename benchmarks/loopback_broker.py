@@ -0,0 +1,151 @@
+"""
+An in-process stand-in for an MQTT broker.
+
+Services are built with their paho clients as usual, then every client
+is swapped for a LoopbackClient with the same callbacks. Published
+messages are routed to the matching subscriptions by one delivery
+thread, like paho delivers them from its network loop, without TLS,
+sockets or an external broker:
+
+    broker = LoopbackBroker().start()
+    bridge.mqtt_client = broker.attach(bridge.mqtt_client)
+"""
+
+import queue
+import itertools
+import threading
+
+import paho.mqtt.client as mqtt
+
+
+class LoopbackBroker:
+    """
+    A class representing an in-process MQTT broker.
+
+    Messages are delivered in publish order to every subscription whose
+    filter matches the topic. QoS and retained messages are not
+    emulated: messages are acknowledged when they are queued.
+    """
+
+    def __init__(self):
+        self.subscriptions = []
+        self.messages = queue.Queue()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.deliver, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.messages.put(None)
+        self.thread.join()
+
+    def attach(self, paho_client):
+        """Return a loopback client with the callbacks of a paho client."""
+        return LoopbackClient(self, paho_client)
+
+    def subscribe(self, client, topic_filter):
+        with self.lock:
+            self.subscriptions.append((client, topic_filter))
+
+    def publish(self, message):
+        with self.lock:
+            self.published += 1
+        self.messages.put(message)
+
+    def drain(self):
+        """Wait until every published message has been delivered."""
+        self.messages.join()
+
+    def deliver(self):
+        while True:
+            message = self.messages.get()
+            try:
+                if message is None:
+                    return
+                with self.lock:
+                    subscriptions = list(self.subscriptions)
+                for client, topic_filter in subscriptions:
+                    if (client.connected and client.on_message
+                            and mqtt.topic_matches_sub(
+                                topic_filter, message.topic)):
+                        client.on_message(client, None, message)
+                        self.delivered += 1
+            finally:
+                self.messages.task_done()
+
+
+class LoopbackClient:
+    """
+    A class representing a paho client connected to a LoopbackBroker.
+
+    Only the part of the paho client API used by the services is
+    provided.
+
+    Args:
+        broker (LoopbackBroker): The broker to connect to.
+        paho_client (paho.mqtt.client.Client): The client whose callbacks
+        are used.
+    """
+
+    def __init__(self, broker, paho_client):
+        self.broker = broker
+        self.on_connect = paho_client.on_connect
+        self.on_message = paho_client.on_message
+        self.on_publish = paho_client.on_publish
+        self.connected = False
+        self.disconnected = threading.Event()
+        self.mids = itertools.count(1)
+
+    def connect(self, host=None, port=None, *args, **kwargs):
+        self.connected = True
+        self.disconnected.clear()
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def disconnect(self, *args, **kwargs):
+        self.connected = False
+        self.disconnected.set()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def is_connected(self):
+        return self.connected
+
+    def loop_start(self):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_stop(self, *args, **kwargs):
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def loop_forever(self, *args, **kwargs):
+        self.disconnected.wait()
+        return mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, topic, qos=0, *args, **kwargs):
+        self.broker.subscribe(self, topic)
+        return mqtt.MQTT_ERR_SUCCESS, next(self.mids)
+
+    def publish(self, topic, payload=None, qos=0, retain=False,
+                properties=None):
+        mid = next(self.mids)
+        info = mqtt.MQTTMessageInfo(mid)
+        if not self.connected:
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+            return info
+        if isinstance(payload, str):
+            payload = payload.encode()
+        message = mqtt.MQTTMessage(mid, topic.encode())
+        message.payload = payload or b""
+        message.qos = qos
+        message.retain = retain
+        message.properties = properties
+        self.broker.publish(message)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        if self.on_publish:
+            self.on_publish(self, None, mid)
+        return info
@@ -0,0 +1,175 @@
+"""
+A local stand-in for the CoinCap assets API.
+
+Serves CoinCap shaped JSON at /v2/assets with random-walk prices that
+change every --period seconds, answers If-None-Match with 304 and counts
+the requests it served. Setting failures answers that many of the next
+requests with 503. Point COINCAP_API_URL at it:
+
+    python -m benchmarks.stub_coincap --port 8080
+    COINCAP_API_URL=http://localhost:8080/v2/assets python mqtt-client.py
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import payload_codec
+
+
+class StubCoinCapServer:
+    """
+    A class representing an in-process CoinCap stub server.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on, 0 picks a free port.
+        assets (int): The number of assets served.
+        period (float): The number of seconds between price updates.
+        latency (float): An artificial delay in seconds added to every
+        response.
+    """
+
+    def __init__(
+        self, host="localhost", port=0, assets=100, period=1.0, latency=0.0
+    ):
+        self.assets = []
+        for rank in range(assets):
+            if rank < len(payload_codec.SYMBOL_DICTIONARY):
+                asset_id, symbol = payload_codec.SYMBOL_DICTIONARY[rank]
+            else:
+                asset_id, symbol = f"asset-{rank}", f"A{rank}"
+            self.assets.append({
+                "id": asset_id,
+                "rank": str(rank + 1),
+                "symbol": symbol,
+                "priceUsd": random.uniform(0.01, 70000),
+            })
+        self.period = period
+        self.latency = latency
+        self.version = 0
+        self.updated_at = time.time()
+        self.served = 0
+        self.not_modified = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v2/assets"
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def snapshot(self, limit):
+        with self.lock:
+            now = time.time()
+            if now - self.updated_at >= self.period:
+                for asset in self.assets:
+                    asset["priceUsd"] *= random.uniform(0.999, 1.001)
+                self.version += 1
+                self.updated_at = now
+            data = [
+                dict(asset, priceUsd=f"{asset['priceUsd']:.16f}")
+                for asset in self.assets[:limit]
+            ]
+            return self.version, {
+                "data": data, "timestamp": int(now * 1000)}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/v2/assets":
+                    self.send_error(404)
+                    return
+                limit = int(parse_qs(url.query).get("limit", ["100"])[0])
+                version, body = server.snapshot(limit)
+                etag = f'"{version}-{limit}"'
+                if server.latency:
+                    time.sleep(server.latency)
+                with server.lock:
+                    server.served += 1
+                    failing = server.failures > 0
+                    if failing:
+                        server.failures -= 1
+                if failing:
+                    self.send_error(503)
+                    return
+                if self.headers.get("If-None-Match") == etag:
+                    with server.lock:
+                        server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                payload = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local CoinCap stub")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="localhost",
+        help="Address to listen on, default is localhost",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="Port to listen on, default is 8080",
+    )
+    parser.add_argument(
+        "--assets",
+        type=int,
+        default=100,
+        help="Number of assets served, default is 100",
+    )
+    parser.add_argument(
+        "--period",
+        type=float,
+        default=1.0,
+        help="Seconds between price updates, default is 1",
+    )
+    args = parser.parse_args()
+
+    server = StubCoinCapServer(
+        args.host, args.port, args.assets, args.period).start()
+    print(f"Serving {server.url}")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
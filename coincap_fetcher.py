@@ -0,0 +1,171 @@
+import time
+import logging
+import threading
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+REQUEST_SECONDS = metrics.histogram(
+    "coincap_request_seconds",
+    "Latency of CoinCap API requests, retries included")
+FETCHES = metrics.counter(
+    "coincap_fetches_total",
+    "CoinCap fetches by result: ok, not_modified, coalesced or error",
+    ("result",))
+
+
+class CoinCapFetcher:
+    """
+    A class representing a shared, pooled client of the CoinCap API.
+
+    Requests go through one keep-alive session with connect/read timeouts
+    and retries with exponential backoff. Responses are revalidated with
+    ETag/If-Modified-Since, and callers asking for the same resource
+    within max_age seconds share one upstream request: concurrent callers
+    wait for the request in flight instead of sending their own.
+
+    Args:
+        url (str): The CoinCap assets URL.
+        timeout (tuple): The connect and read timeouts in seconds.
+        retries (int): The number of retries of a failed request.
+        backoff_factor (float): The base of the exponential backoff between
+        retries, in seconds.
+        max_age (float): How long in seconds a response is shared between
+        callers.
+        pool_size (int): The maximum number of pooled connections.
+    """
+
+    def __init__(
+        self, url, timeout=(3.05, 10), retries=3, backoff_factor=0.5,
+        max_age=1.0, pool_size=4
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.max_age = max_age
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._cache = {}
+        self.requests = 0
+        self.not_modified = 0
+        self.coalesced = 0
+
+    def get(self, limit=None, max_age=None):
+        """
+        Fetch the assets, sharing recent responses between callers.
+
+        Args:
+            limit (int): The number of assets, None for the API default.
+            max_age (float): Overrides the max_age of the fetcher.
+
+        Returns:
+            dict: The decoded JSON response.
+
+        Raises:
+            requests.RequestException: If the request failed after all
+            retries.
+        """
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            key_lock = self._key_locks.setdefault(limit, threading.Lock())
+
+        with key_lock:
+            cached = self._cache.get(limit)
+            if cached and time.monotonic() - cached["fetched_at"] < max_age:
+                self.coalesced += 1
+                FETCHES.labels("coalesced").inc()
+                return cached["data"]
+
+            headers = {}
+            if cached and cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached and cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+            params = {} if limit is None else {"limit": limit}
+
+            self.requests += 1
+            try:
+                with REQUEST_SECONDS.time():
+                    response = self.session.get(
+                        self.url, params=params, headers=headers,
+                        timeout=self.timeout
+                    )
+                response.raise_for_status()
+            except requests.RequestException:
+                FETCHES.labels("error").inc()
+                raise
+            if response.status_code == 304 and cached:
+                self.not_modified += 1
+                FETCHES.labels("not_modified").inc()
+                cached["fetched_at"] = time.monotonic()
+                cached["fetched_time"] = time.time()
+                logging.debug("CoinCap data not modified: %s", self.url)
+                return cached["data"]
+
+            FETCHES.labels("ok").inc()
+            data = response.json()
+            self._cache[limit] = {
+                "fetched_at": time.monotonic(),
+                "fetched_time": time.time(),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "data": data,
+            }
+            return data
+
+    def fetched_time(self, limit=None):
+        """Return the UNIX time the data of limit was last confirmed
+        upstream, None if it was never fetched."""
+        cached = self._cache.get(limit)
+        return cached["fetched_time"] if cached else None
+
+    def close(self):
+        self.session.close()
+
+
+_fetchers = {}
+_fetchers_lock = threading.Lock()
+
+
+def get_fetcher(url, **kwargs):
+    """
+    Return the fetcher shared by every caller of the process for a URL.
+
+    The keyword arguments are only used when the fetcher is created.
+    """
+    with _fetchers_lock:
+        if url not in _fetchers:
+            _fetchers[url] = CoinCapFetcher(url, **kwargs)
+        return _fetchers[url]
+
+
+def crypto_message(data, limit=None):
+    """Convert a CoinCap assets response to a crypto data message."""
+    return {
+        "timestamp": data.get("timestamp"),
+        "crypto": [
+            {
+                "id": item["id"],
+                "symbol": item["symbol"],
+                "priceUsd": item["priceUsd"],
+            }
+            for item in data.get("data", [])[:limit]
+        ],
+    }
@@ -0,0 +1,99 @@
+import inspect
+import logging
+
+
+class CommandDispatcher:
+    """
+    A class routing MQTT commands to per-device handlers.
+
+    Commands arrive on <command_topic>/<device_id> as "<name> [args...]",
+    for example "publish_stop" or "set_interval 30". The device is looked
+    up from the topic and the command from its name, both in a dict, so
+    routing a message does not depend on the number of devices or
+    commands. With wildcard set, a single <command_topic>/+ subscription
+    serves every registered device.
+
+    Args:
+        command_topic (str): The MQTT topic prefix of the commands.
+        wildcard (bool): Subscribe once for all devices instead of once
+        per registered device.
+    """
+
+    def __init__(self, command_topic, wildcard=True):
+        self.command_topic = command_topic
+        self.wildcard = wildcard
+        self.devices = {}
+        self.dispatched = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def register(self, device_id, handlers):
+        """
+        Register the handlers of a device.
+
+        Args:
+            device_id (str): The device id, last level of the topic.
+            handlers (dict): Maps command names to callables taking the
+            command arguments as strings. A handler raises ValueError for
+            invalid argument values.
+        """
+        self.devices[device_id] = handlers
+
+    def unregister(self, device_id):
+        self.devices.pop(device_id, None)
+
+    def subscribe(self, client):
+        if self.wildcard:
+            client.subscribe(self.command_topic + "/+")
+            logging.info(
+                "Subscribed to command topic %s/+", self.command_topic)
+            return
+        for device_id in self.devices:
+            client.subscribe(self.command_topic + "/" + device_id)
+            logging.info(
+                "Subscribed to command topic %s/%s",
+                self.command_topic, device_id)
+
+    def on_message(self, client, userdata, msg):
+        device_id = msg.topic.rpartition("/")[2]
+        handlers = self.devices.get(device_id)
+        if handlers is None:
+            logging.debug("Command for unknown device %s", device_id)
+            return
+        try:
+            name, *args = msg.payload.decode().split()
+        except (UnicodeDecodeError, ValueError):
+            logging.error("Invalid command %r for %s", msg.payload, device_id)
+            self.rejected += 1
+            return
+
+        handler = handlers.get(name)
+        if handler is None:
+            logging.error("Invalid command %s for %s", name, device_id)
+            self.rejected += 1
+            return
+        try:
+            inspect.signature(handler).bind(*args)
+        except TypeError as e:
+            logging.error(
+                "Invalid arguments %s of command %s for %s: %s",
+                args, name, device_id, e)
+            self.rejected += 1
+            return
+        try:
+            handler(*args)
+        except ValueError as e:
+            logging.error(
+                "Invalid arguments %s of command %s for %s: %s",
+                args, name, device_id, e)
+            self.rejected += 1
+            return
+        except Exception:
+            logging.exception(
+                "Command %s failed for %s", " ".join([name, *args]),
+                device_id)
+            self.failed += 1
+            return
+        self.dispatched += 1
+        logging.info(
+            "Applied command %s to %s", " ".join([name, *args]), device_id)
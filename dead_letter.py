@@ -0,0 +1,104 @@
+import os
+import time
+import base64
+import hashlib
+import threading
+
+from bson import json_util
+
+
+def dedupe_key(topic, payload):
+    """Return a stable key identifying a received message."""
+    return hashlib.sha1(topic.encode() + b"\0" + payload).hexdigest()
+
+
+def sample_id(device_id, timestamp, payload=b""):
+    """
+    Return the document id of a device sample.
+
+    The id only depends on the device and the sample timestamp, so every
+    delivery of the same sample maps to the same document. Samples without
+    timestamp fall back to a hash of their payload.
+    """
+    if timestamp is None:
+        return dedupe_key(device_id, payload)
+    return hashlib.sha1(f"{device_id}\0{timestamp}".encode()).hexdigest()
+
+
+class DeadLetterLog:
+    """
+    A class representing an append-only log of messages that failed.
+
+    Every failed message is appended as one JSON line holding the raw
+    payload, the error class and, when the message could be decoded, the
+    document that was to be stored. Records carry a dedupe key so a replay
+    can be repeated without creating duplicates.
+
+    Args:
+        path (str): The path of the log file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.appended = 0
+
+    def append(
+        self, topic, payload, content_type, error, document=None, key=None
+    ):
+        record = {
+            "key": key or dedupe_key(topic, payload),
+            "topic": topic,
+            "payload": payload,
+            "content_type": content_type,
+            "error": type(error).__name__,
+            "detail": str(error),
+            "failed_at": time.time(),
+            "document": document,
+        }
+        self.write([record])
+
+    def write(self, records):
+        """Append records, as returned by read, to the log."""
+        lines = "".join(
+            json_util.dumps(dict(
+                record,
+                payload=base64.b64encode(record["payload"]).decode()
+            )) + "\n"
+            for record in records
+        )
+        with self.lock:
+            with open(self.path, "a") as log:
+                log.write(lines)
+                log.flush()
+                os.fsync(log.fileno())
+            self.appended += len(records)
+
+    def take(self):
+        """
+        Move the current log aside for a replay.
+
+        New failures keep being appended to a fresh log meanwhile.
+
+        Returns:
+            str: The path of the moved log, None if there is nothing to
+            replay.
+        """
+        replay_path = self.path + ".replay"
+        with self.lock:
+            if os.path.exists(replay_path):
+                # A previous replay was interrupted, finish it first.
+                return replay_path
+            if not os.path.exists(self.path):
+                return None
+            os.replace(self.path, replay_path)
+            return replay_path
+
+    @staticmethod
+    def read(path):
+        with open(path) as log:
+            for line in log:
+                if line.strip():
+                    record = json_util.loads(line)
+                    record["payload"] = base64.b64decode(record["payload"])
+                    yield record
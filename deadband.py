@@ -0,0 +1,86 @@
+import time
+
+
+class DeadbandFilter:
+    """
+    A class representing a change-only filter for persisted samples.
+
+    Samples are grouped in streams (a Modbus block, an MQTT device) and
+    each sample maps point names to values. A sample is written when any
+    of its points moved by more than the deadband since the last written
+    sample of the stream, when its set of points changed, or when the
+    stream has been silent for max_silent_interval seconds (heartbeat).
+    Every other sample is suppressed and counted.
+
+    A numeric point is significant when its change exceeds both the
+    absolute deadband and the percent deadband of the last written value.
+    Non-numeric values are compared for equality.
+
+    Args:
+        absolute (float): The default absolute deadband.
+        percent (float): The default deadband in percent of the last
+        written value.
+        max_silent_interval (float): The maximum number of seconds between
+        two writes of a stream, None to disable the heartbeat.
+        points (dict): Per-point overrides, mapping a point name to an
+        (absolute, percent) tuple.
+    """
+
+    def __init__(
+        self, absolute=0.0, percent=0.0, max_silent_interval=None,
+        points=None, clock=time.monotonic
+    ):
+        self.absolute = absolute
+        self.percent = percent
+        self.max_silent_interval = max_silent_interval
+        self.points = points or {}
+        self.clock = clock
+        self.last = {}
+        self.written = 0
+        self.suppressed = 0
+
+    def should_write(self, stream, values):
+        """
+        Decide whether a sample has to be persisted.
+
+        The reference of the stream is left as it is, call commit once
+        the sample was written; until then later samples of the stream
+        are compared to the previous reference.
+
+        Args:
+            stream (str): The stream the sample belongs to.
+            values (dict): The sample, mapping point names to values.
+
+        Returns:
+            bool: True if the sample has to be written.
+        """
+        last = self.last.get(stream)
+        if last is None or self._significant(values, last[0]) or (
+            self.max_silent_interval is not None
+            and self.clock() - last[1] >= self.max_silent_interval
+        ):
+            return True
+        self.suppressed += 1
+        return False
+
+    def commit(self, stream, values):
+        """Make a written sample the new reference of its stream."""
+        self.last[stream] = (dict(values), self.clock())
+        self.written += 1
+
+    def _significant(self, values, last_values):
+        if values.keys() != last_values.keys():
+            return True
+        for point, value in values.items():
+            last = last_values[point]
+            absolute, percent = self.points.get(
+                point, (self.absolute, self.percent))
+            try:
+                delta = abs(value - last)
+            except TypeError:
+                if value != last:
+                    return True
+                continue
+            if delta > absolute and delta > abs(last) * percent / 100:
+                return True
+        return False
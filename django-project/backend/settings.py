@@ -10,11 +10,20 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# The API imports the modules it shares with the services, like
+# metrics.py, from the repository root. This is the only place setting
+# up that path, every entry point (manage.py, wsgi.py, asgi.py) loads the
+# settings before the apps.
+REPO_DIR = BASE_DIR.parent
+if str(REPO_DIR) not in sys.path:
+    sys.path.append(str(REPO_DIR))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.0/howto/deployment/checklist/
@@ -51,20 +60,48 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'rest_app.middleware.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.urls'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication'
+        'rest_app.authentication.CachedTokenAuthentication'
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ]
 }
 
+# Client addresses allowed to read /metrics
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# Token lookups of CachedTokenAuthentication are cached in the "tokens"
+# cache. The local memory backend is per process, with several worker
+# processes use a shared backend like Redis or Memcached, so that a
+# logout invalidates the token in every worker.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'tokens': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tokens',
+        'TIMEOUT': 30,
+        'OPTIONS': {'MAX_ENTRIES': 1024},
+    },
+}
+
+# Tokens expire after TOKEN_TTL seconds without use, their expiry is
+# extended at most once per TOKEN_REFRESH_INTERVAL seconds
+TOKEN_TTL = 7 * 24 * 3600
+TOKEN_REFRESH_INTERVAL = 3600
+
 AUTH_USER_MODEL = 'rest_app.User'
+AUTHENTICATION_BACKENDS = [
+    'rest_app.authentication.DeferredUpgradeBackend',
+]
 APPEND_SLASH = False
 
 TEMPLATES = [
@@ -9,7 +9,11 @@ urlpatterns = [
     path('api/logout', views.UserLogoutView),
     path('api/mqtt/data', views.GetMQTTDataView),
     path('api/mqtt/data/device', views.GetMQTTDeviceDataView),
+    path('api/mqtt/data/symbol', views.GetMQTTSymbolHistoryView),
+    path('api/mqtt/lag', views.GetMQTTLagView),
     path('api/mqtt/command', views.SendMQTTCommandView),
     path('api/modbus/data', views.GetModbusDataView),
     path('api/modbus/data/timestamp', views.GetModbusDataByTimestampView),
+    path('api/export', views.ExportDataView),
+    path('metrics', views.MetricsView),
 ]
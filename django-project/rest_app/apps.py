@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class RestAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rest_app'
+
+    def ready(self):
+        # Connects the signals invalidating the token cache.
+        from . import authentication  # noqa: F401
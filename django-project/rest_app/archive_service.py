@@ -0,0 +1,179 @@
+import os
+import gzip
+import logging
+import datetime
+import itertools
+
+from bson import json_util
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Raised when reading a partition whose last write was cut short
+INCOMPLETE_WRITE_ERRORS = (EOFError, gzip.BadGzipFile)
+
+
+class ArchiveService:
+    """
+    A class representing the archive of samples removed from MongoDB.
+
+    Samples are stored as gzip compressed NDJSON files (MongoDB extended
+    JSON, so values keep their BSON types), one file per collection and
+    UTC day: <root>/<collection>/<YYYY-MM-DD>.ndjson.gz. Reads only open
+    the files of the days overlapping the requested range.
+
+    Args:
+        root (str): The directory of the archive.
+    """
+
+    def __init__(self, root=os.getenv("ARCHIVE_DIR") or "archive"):
+        self.root = root
+
+    @staticmethod
+    def day_of(timestamp, scale):
+        """Return the UTC date of a timestamp in 1/scale seconds."""
+        return datetime.datetime.fromtimestamp(
+            timestamp / scale, datetime.timezone.utc).date()
+
+    @staticmethod
+    def day_start(day, scale):
+        """Return the first timestamp, in 1/scale seconds, of a day."""
+        start = datetime.datetime.combine(
+            day, datetime.time(), datetime.timezone.utc)
+        return int(start.timestamp()) * scale
+
+    def partition_path(self, collection, day):
+        return os.path.join(
+            self.root, collection, day.isoformat() + ".ndjson.gz")
+
+    def days(self, collection):
+        """Return the archived days of a collection, oldest first."""
+        directory = os.path.join(self.root, collection)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            datetime.date.fromisoformat(name.split(".", 1)[0])
+            for name in os.listdir(directory)
+            if name.endswith(".ndjson.gz")
+        )
+
+    @staticmethod
+    def documents(path):
+        """
+        Yield the documents of a partition file.
+
+        Raises:
+            EOFError, gzip.BadGzipFile: If the last gzip member was not
+            completely written.
+        """
+        with gzip.open(path, "rt") as partition:
+            for line in partition:
+                if line.strip():
+                    yield json_util.loads(line)
+
+    def read_partition(self, collection, day):
+        path = self.partition_path(collection, day)
+        if not os.path.exists(path):
+            return
+        try:
+            yield from self.documents(path)
+        except INCOMPLETE_WRITE_ERRORS:
+            logging.warning("Partition %s ends with an incomplete write", path)
+
+    @staticmethod
+    def write_member(path, mode, documents):
+        """
+        Write documents to a file as one gzip member and sync it.
+
+        Returns:
+            int: The number of documents written.
+        """
+        count = 0
+        with open(path, mode) as partition:
+            with gzip.GzipFile(fileobj=partition, mode="wb") as member:
+                for document in documents:
+                    member.write((json_util.dumps(document) + "\n").encode())
+                    count += 1
+            partition.flush()
+            os.fsync(partition.fileno())
+        return count
+
+    def write_partition(self, collection, day, documents):
+        """
+        Add documents to the partition of a day.
+
+        Documents already in the partition, by _id, are not written twice,
+        so an interrupted archival run can simply be repeated. The added
+        documents are compressed as they are iterated and appended to the
+        partition as a new gzip member, the existing ones are not
+        recompressed. A partition whose last member was cut short by a
+        crash is rewritten atomically instead.
+
+        Returns:
+            int: The number of documents added.
+        """
+        path = self.partition_path(collection, day)
+        seen = set()
+        complete = True
+        if os.path.exists(path):
+            try:
+                for document in self.documents(path):
+                    seen.add(document["_id"])
+            except INCOMPLETE_WRITE_ERRORS:
+                complete = False
+        added = (
+            document for document in documents if document["_id"] not in seen
+        )
+        first = next(added, None)
+        if first is None:
+            return 0
+        added = itertools.chain([first], added)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if complete:
+            return self.write_member(path, "ab", added)
+        # The readable documents are the ones seen above
+        written = self.write_member(path + ".tmp", "wb", itertools.chain(
+            self.read_partition(collection, day), added))
+        os.replace(path + ".tmp", path)
+        return written - len(seen)
+
+    def scan(self, collection, field, scale, start=None, end=None,
+             query=None):
+        """
+        Yield the archived documents with field in [start, end].
+
+        Args:
+            collection (str): The name of the archived collection.
+            field (str): The timestamp field of the documents.
+            scale (int): The timestamp unit, 1 for seconds, 1000 for
+            milliseconds.
+            start (int): The first timestamp, None for no lower bound.
+            end (int): The last timestamp, None for no upper bound.
+            query (dict): Further fields the documents must be equal to.
+        """
+        first = None if start is None else self.day_of(start, scale)
+        last = None if end is None else self.day_of(end, scale)
+        for day in self.days(collection):
+            if (first and day < first) or (last and day > last):
+                continue
+            for document in self.read_partition(collection, day):
+                timestamp = document.get(field)
+                if timestamp is None:
+                    continue
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end:
+                    continue
+                if query and any(
+                    document.get(key) != value
+                    for key, value in query.items()
+                ):
+                    continue
+                yield document
+
+    def find(self, collection, field, scale, start=None, end=None,
+             query=None):
+        """Return the archived documents with field in [start, end], see
+        scan."""
+        return list(self.scan(collection, field, scale, start, end, query))
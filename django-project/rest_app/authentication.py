@@ -0,0 +1,240 @@
+import logging
+import datetime
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.cache import caches
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework import exceptions, permissions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+# Token.created holds the time of the last refresh, a token expires
+# TOKEN_TTL seconds after it and is refreshed at most once per
+# TOKEN_REFRESH_INTERVAL seconds while it is used.
+TOKEN_TTL = datetime.timedelta(
+    seconds=getattr(settings, "TOKEN_TTL", 7 * 24 * 3600))
+TOKEN_REFRESH_INTERVAL = datetime.timedelta(
+    seconds=getattr(settings, "TOKEN_REFRESH_INTERVAL", 3600))
+
+
+def token_expired(token, now=None):
+    return token.created <= (now or timezone.now()) - TOKEN_TTL
+
+
+class TokenCache:
+    """
+    A class representing a cache of authenticated tokens.
+
+    The (user, token) pairs are kept in a cache of Django's cache
+    framework, which bounds its size and expires its entries. With a
+    shared backend like Redis or Memcached, a token deleted or a user
+    saved by one worker process is dropped for every worker. With the
+    local memory backend, other processes keep accepting a deleted token
+    until their entry expires.
+
+    Args:
+        alias (str): The alias of the cache in the CACHES setting.
+    """
+
+    def __init__(self, alias="tokens"):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def cache_key(key):
+        return "token:" + key
+
+    def get(self, key):
+        """Return the cached (user, token) of a key, None on a miss."""
+        return self.cache.get(self.cache_key(key))
+
+    def set(self, key, value):
+        self.cache.set(self.cache_key(key), value)
+
+    def invalidate(self, key):
+        self.cache.delete(self.cache_key(key))
+
+    def invalidate_user(self, user_pk):
+        self.cache.delete_many([
+            self.cache_key(key) for key in Token.objects.filter(
+                user_id=user_pk).values_list("key", flat=True)
+        ])
+
+    def clear(self):
+        self.cache.clear()
+
+
+token_cache = TokenCache(getattr(settings, "TOKEN_CACHE_ALIAS", "tokens"))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication with the token to user lookup cached.
+
+    Repeated requests with the same token are authenticated without a
+    database query until the cache entry expires. Deleting the token,
+    like UserLogoutView does, or saving its user drops the entry.
+
+    Tokens expire TOKEN_TTL after their last refresh. A used token is
+    refreshed with a single update at most once per
+    TOKEN_REFRESH_INTERVAL, not on every request.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            user, token = super().authenticate_credentials(key)
+        else:
+            user, token = cached
+
+        now = timezone.now()
+        if token_expired(token, now) and cached is not None:
+            # Another process may have refreshed the token meanwhile.
+            token_cache.invalidate(key)
+            user, token = super().authenticate_credentials(key)
+        if token_expired(token, now):
+            token.delete()
+            raise exceptions.AuthenticationFailed("Token has expired.")
+        refreshed = token.created <= now - TOKEN_REFRESH_INTERVAL
+        if refreshed:
+            Token.objects.filter(key=key).update(created=now)
+            token.created = now
+        if cached is None or refreshed or cached[1] is not token:
+            token_cache.set(key, (user, token))
+        return user, token
+
+
+def upgrade_password_hash(user_pk, old_hash, new_hash):
+    """
+    Replace the password hash of a user unless the password changed.
+
+    Returns:
+        bool: Whether the hash was replaced.
+    """
+    try:
+        return bool(get_user_model()._default_manager.filter(
+            pk=user_pk, password=old_hash).update(password=new_hash))
+    except Exception as e:
+        logging.error("Failed to upgrade password hash of %s: %s",
+                      user_pk, e)
+        return False
+    finally:
+        connection.close()
+
+
+class PasswordUpgrades:
+    """
+    A class representing the pending password hash upgrades.
+
+    The new hash is computed by the caller, only the compare-and-set
+    update is left to a worker thread, so no raw password is kept. There
+    is at most one pending upgrade per user and at most max_pending in
+    total, further upgrades are dropped, the next login retries them.
+
+    Args:
+        max_pending (int): The maximum number of pending upgrades.
+    """
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="password-upgrade")
+
+    def reserve(self, user_pk):
+        """Return whether an upgrade of the user may be submitted."""
+        with self.lock:
+            if user_pk in self.pending or (
+                len(self.pending) >= self.max_pending
+            ):
+                return False
+            self.pending.add(user_pk)
+            return True
+
+    def submit(self, user_pk, old_hash, new_hash):
+        """Queue the upgrade of a user reserved with reserve()."""
+        self.executor.submit(self.run, user_pk, old_hash, new_hash)
+
+    def run(self, user_pk, old_hash, new_hash):
+        try:
+            upgrade_password_hash(user_pk, old_hash, new_hash)
+        finally:
+            with self.lock:
+                self.pending.discard(user_pk)
+
+    def upgrade(self, user, raw_password):
+        if self.reserve(user.pk):
+            self.submit(user.pk, user.password, make_password(raw_password))
+
+
+password_upgrades = PasswordUpgrades(
+    max_pending=getattr(settings, "PASSWORD_UPGRADES_PENDING", 100))
+
+
+class DeferredUpgradeBackend(ModelBackend):
+    """
+    Model backend upgrading outdated password hashes in the background.
+
+    The password is checked with a single hash like in ModelBackend, but
+    when the stored hash uses an outdated hasher or iteration count, the
+    new hash is saved by a worker thread, see PasswordUpgrades. The save
+    only replaces the hash the password was checked against, a password
+    changed meanwhile is kept.
+    """
+
+    def authenticate(self, request, username=None, password=None,
+                     **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Hash once anyway, unknown users must not answer faster.
+            UserModel().set_password(password)
+            return None
+        if check_password(
+            password, user.password,
+            setter=lambda raw_password: password_upgrades.upgrade(
+                user, raw_password),
+        ) and self.user_can_authenticate(user):
+            return user
+        return None
+
+
+class MetricsClient(permissions.BasePermission):
+    """
+    Allow the clients whose address is in METRICS_ALLOWED_IPS.
+
+    The address is the one of the connection, behind a proxy it is the
+    proxy's address.
+    """
+
+    def has_permission(self, request, view):
+        return request.META.get("REMOTE_ADDR") in getattr(
+            settings, "METRICS_ALLOWED_IPS", ("127.0.0.1", "::1"))
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def invalidate_saved_user(sender, instance, **kwargs):
+    token_cache.invalidate_user(instance.pk)
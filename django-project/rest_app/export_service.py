@@ -0,0 +1,341 @@
+import io
+import csv
+import logging
+import itertools
+
+from bson import json_util
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CSV = "csv"
+PARQUET = "parquet"
+EXPORT_FORMATS = (CSV, PARQUET)
+SCALAR_TYPES = {str, int, float, bool, type(None)}
+CONTENT_TYPES = {
+    CSV: "text/csv",
+    PARQUET: "application/vnd.apache.parquet",
+}
+
+
+def flatten(document, prefix=""):
+    """Flatten nested documents into dotted keys, lists become JSON."""
+    row = {}
+    for key, value in document.items():
+        if isinstance(value, dict):
+            row.update(flatten(value, prefix + key + "."))
+        elif isinstance(value, list):
+            row[prefix + key] = json_util.dumps(value)
+        else:
+            row[prefix + key] = value
+    return row
+
+
+def getter(field):
+    """Return a function reading a dotted field of a document."""
+    if "." not in field:
+        return lambda document: document.get(field)
+    first, *keys = field.split(".")
+
+    def get(document):
+        value = document.get(first)
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+    return get
+
+
+def select(document, fields):
+    """Return the given dotted fields of a document, like a projection."""
+    selected = {}
+    for field in fields:
+        value, target, keys = document, selected, field.split(".")
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return selected
+
+
+class ChunkSink:
+    """A write-only file collecting what is written until it is taken."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return b"".join(chunks)
+
+
+class ExportService:
+    """
+    A class streaming a time range of a collection as CSV or Parquet.
+
+    Documents are read in one pass in batches, archived days first, then
+    MongoDB, and every batch is encoded and handed out as soon as it is
+    read, so memory use does not depend on the size of the range. The
+    columns and their types are taken from the first schema_batches
+    batches; fields that only appear later are not exported unless asked
+    for, and later values not fitting their Parquet type are exported as
+    nulls. Parquet gets one row group per batch and needs the optional
+    pyarrow package.
+
+    Args:
+        mongo_service (MongoService): The service of the exported
+        collections.
+        batch_size (int): The number of documents per batch.
+        schema_batches (int): The number of leading batches the columns
+        and types are taken from.
+    """
+
+    def __init__(self, mongo_service, batch_size=5000, schema_batches=1):
+        self.mongo_service = mongo_service
+        self.batch_size = batch_size
+        self.schema_batches = schema_batches
+
+    def collections(self):
+        return self.mongo_service.archived_collections()
+
+    def batches(self, collection, start=None, end=None, fields=None):
+        """Yield lists of the documents of a collection in [start, end]."""
+        col, field, scale = self.collections()[collection]
+        query = {}
+        if start is not None or end is not None:
+            query[field] = {}
+            if start is not None:
+                query[field]["$gte"] = start
+            if end is not None:
+                query[field]["$lte"] = end
+        # The _id is read to drop the documents of a day being archived,
+        # which are in the archive and still in MongoDB.
+        projection = dict.fromkeys(fields, 1) if fields else None
+        drop_id = bool(fields) and "_id" not in fields
+        oldest = col.find_one(query, {field: 1}, sort=[(field, 1)])
+        archived_ids = set()
+
+        def archived():
+            for document in self.mongo_service.archive.scan(
+                col.name, field, scale, start=start, end=end
+            ):
+                if oldest is not None and document[field] >= oldest[field]:
+                    archived_ids.add(document["_id"])
+                yield select(document, fields) if fields else document
+
+        def live():
+            cursor = col.find(query, projection).sort(field, 1).batch_size(
+                self.batch_size)
+            for document in cursor:
+                if document["_id"] in archived_ids:
+                    continue
+                if drop_id:
+                    del document["_id"]
+                yield document
+
+        documents = itertools.chain(archived(), live())
+        while True:
+            batch = list(itertools.islice(documents, self.batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def csv_columns(self, batches):
+        """Return the dotted fields of the documents of batches, in order
+        of first appearance."""
+        columns = {}
+        for batch in batches:
+            for document in batch:
+                columns.update(dict.fromkeys(flatten(document)))
+        return list(columns)
+
+    def csv_chunks(self, batches, columns):
+        """Encode batches as CSV, nested values of the columns as JSON."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        getters = [getter(column) for column in columns]
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(
+                [
+                    value if type(value) in SCALAR_TYPES
+                    else self.csv_value(value)
+                    for value in (get(document) for get in getters)
+                ]
+                for document in batch
+            )
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+
+    @staticmethod
+    def csv_value(value):
+        if isinstance(value, (dict, list)):
+            return json_util.dumps(value)
+        return str(value)
+
+    def parquet_schema(self, batches):
+        """
+        Return the schema of the documents of batches.
+
+        Columns are the top level fields in order of first appearance.
+        Types inferred per batch are merged, integers widen to floats and
+        structs get the fields of every batch; columns whose types do not
+        merge, like a price that is a string in some documents and a
+        float in others, are strings.
+        """
+        types = {}
+        for batch in batches:
+            columns = dict.fromkeys(
+                key for document in batch for key in document)
+            for column in columns:
+                if types.get(column) == pyarrow.string():
+                    continue
+                values = [
+                    self.parquet_value(document.get(column))
+                    for document in batch
+                ]
+                try:
+                    column_type = pyarrow.array(values).type
+                    if column in types:
+                        column_type = pyarrow.unify_schemas(
+                            [pyarrow.schema([(column, types[column])]),
+                             pyarrow.schema([(column, column_type)])],
+                            promote_options="permissive",
+                        ).field(column).type
+                except pyarrow.ArrowException:
+                    column_type = pyarrow.string()
+                types[column] = column_type
+        return pyarrow.schema(list(types.items()))
+
+    def parquet_chunks(self, batches, schema):
+        """Encode batches as Parquet with the schema of parquet_schema,
+        one row group per batch."""
+        sink = ChunkSink()
+        writer = pyarrow.parquet.ParquetWriter(
+            sink, schema, compression="zstd")
+        try:
+            for batch in batches:
+                arrays = {}
+                for field in schema:
+                    values = [
+                        document.get(field.name) for document in batch]
+                    if field.type == pyarrow.string():
+                        values = [self.text_value(value) for value in values]
+                    elif any(type(value) not in SCALAR_TYPES
+                             for value in values):
+                        values = [self.parquet_value(value)
+                                  for value in values]
+                    arrays[field.name] = self.parquet_array(
+                        field, values)
+                writer.write_table(
+                    pyarrow.Table.from_pydict(arrays, schema=schema))
+                yield sink.take()
+        finally:
+            writer.close()
+        yield sink.take()
+
+    @staticmethod
+    def parquet_array(field, values):
+        """Return values as an array of the type of field, values that do
+        not fit it as nulls."""
+        try:
+            return pyarrow.array(values, type=field.type)
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            pass
+        fitting = []
+        for value in values:
+            try:
+                pyarrow.scalar(value, type=field.type)
+            except (pyarrow.ArrowException, TypeError, ValueError):
+                value = None
+            fitting.append(value)
+        logging.warning(
+            "%d value(s) of %s do not fit %s, exported as null",
+            fitting.count(None) - values.count(None), field.name,
+            field.type)
+        return pyarrow.array(fitting, type=field.type)
+
+    @staticmethod
+    def text_value(value):
+        if value is None or isinstance(value, str):
+            return value
+        return ExportService.csv_value(value)
+
+    @staticmethod
+    def parquet_value(value):
+        if isinstance(value, dict):
+            return {
+                key: ExportService.parquet_value(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [ExportService.parquet_value(item) for item in value]
+        if isinstance(value, (str, int, float, bool)) or value is None:
+            return value
+        return str(value)
+
+    def export(self, collection, export_format, start=None, end=None,
+               fields=None):
+        """
+        Return an iterator of the encoded chunks of an export.
+
+        Args:
+            collection (str): The short name of the collection, see
+            MongoService.archived_collections.
+            export_format (str): "csv" or "parquet".
+            start (int): The first timestamp, None for no lower bound.
+            end (int): The last timestamp, None for no upper bound.
+            fields (list): The dotted fields to export, None for all.
+
+        Raises:
+            ValueError: When the collection or the format is unknown.
+        """
+        if collection not in self.collections():
+            raise ValueError(f"Unknown collection {collection}")
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format}")
+        if export_format == PARQUET and pyarrow is None:
+            raise ValueError("Parquet export needs the pyarrow package")
+        return self.chunks(collection, export_format, start, end, fields)
+
+    def chunks(self, collection, export_format, start, end, fields):
+        # The Parquet schema and the CSV columns, unless fields are
+        # given, are those of the leading batches, read once and then
+        # exported with the rest.
+        batches = self.batches(collection, start, end, fields)
+        leading = list(itertools.islice(batches, self.schema_batches))
+        batches = itertools.chain(leading, batches)
+        if export_format == CSV:
+            columns = fields or self.csv_columns(leading)
+            yield from self.csv_chunks(batches, columns)
+        else:
+            yield from self.parquet_chunks(
+                batches, self.parquet_schema(leading))
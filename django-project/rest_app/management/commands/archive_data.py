@@ -0,0 +1,91 @@
+import os
+import time
+import datetime
+import itertools
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_app.mongo_service import MongoService
+
+
+class Command(BaseCommand):
+    help = (
+        "Move samples older than the retention period from MongoDB to the "
+        "compressed archive, one file per collection and day."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=int(os.getenv("RETENTION_DAYS") or 30),
+            help="Days of samples kept in MongoDB, default is "
+            "RETENTION_DAYS or 30",
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            default=1000,
+            help="Documents deleted per request, default is 1000",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] < 1:
+            raise CommandError("--days must be at least 1")
+        self.verbosity = options["verbosity"]
+        mongo_service = MongoService()
+        cutoff_day = (
+            datetime.datetime.now(datetime.timezone.utc).date()
+            - datetime.timedelta(days=options["days"])
+        )
+        collections = mongo_service.archived_collections()
+        for col, field, scale in collections.values():
+            archived = self.archive_collection(
+                mongo_service.archive, col, field, scale,
+                mongo_service.archive.day_start(cutoff_day, scale),
+                options["batch_size"],
+            )
+            self.stdout.write(
+                f"Archived {archived} documents of {col.name} older than "
+                f"{cutoff_day}")
+
+    def archive_collection(self, archive, col, field, scale, cutoff,
+                           batch_size):
+        """
+        Archive the documents of col with field before cutoff, day by day.
+
+        A day is written to its partition before it is deleted, so an
+        interrupted run loses nothing and is completed by the next one.
+        """
+        col.create_index(field)
+        archived = 0
+        cursor = col.find({field: {"$lt": cutoff}}).sort(field, 1)
+        for day, documents in itertools.groupby(
+            cursor, lambda document: archive.day_of(document[field], scale)
+        ):
+            archived += self.archive_day(
+                archive, col, day, documents, batch_size)
+        return archived
+
+    def archive_day(self, archive, col, day, documents, batch_size):
+        """
+        Stream the documents of a day to its partition, then delete them.
+
+        Only the ids of the documents are kept in memory.
+        """
+        start = time.monotonic()
+        ids = []
+
+        def collect_ids():
+            for document in documents:
+                ids.append(document["_id"])
+                yield document
+
+        archive.write_partition(col.name, day, collect_ids())
+        for index in range(0, len(ids), batch_size):
+            col.delete_many({"_id": {"$in": ids[index:index + batch_size]}})
+        if self.verbosity > 1:
+            self.stdout.write(
+                f"{col.name} {day}: {len(ids)} documents in "
+                f"{time.monotonic() - start:.1f}s")
+        return len(ids)
@@ -0,0 +1,90 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rest_app.mongo_service import MongoService
+from rest_app.export_service import ExportService, EXPORT_FORMATS, CSV
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a time range of a collection, archive included, to a CSV "
+        "or Parquet file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "collection",
+            choices=("mqtt", "symbol", "modbus"),
+            help="The collection to export",
+        )
+        parser.add_argument(
+            "--format",
+            choices=EXPORT_FORMATS,
+            default=CSV,
+            help="The file format, default is csv",
+        )
+        parser.add_argument(
+            "--from",
+            dest="start",
+            type=int,
+            default=None,
+            help="The first UNIX timestamp in the unit of the collection, "
+            "default is no lower bound",
+        )
+        parser.add_argument(
+            "--to",
+            dest="end",
+            type=int,
+            default=None,
+            help="The last UNIX timestamp in the unit of the collection, "
+            "default is no upper bound",
+        )
+        parser.add_argument(
+            "--fields",
+            type=str,
+            default=None,
+            help="Comma separated dotted fields to export, default is all",
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            default=5000,
+            help="Documents read per batch, default is 5000",
+        )
+        parser.add_argument(
+            "--output",
+            type=str,
+            default="-",
+            help="The output file, default is standard output",
+        )
+
+    def handle(self, *args, **options):
+        export_service = ExportService(
+            MongoService(), batch_size=options["batch_size"])
+        try:
+            chunks = export_service.export(
+                options["collection"],
+                options["format"],
+                start=options["start"],
+                end=options["end"],
+                fields=(
+                    options["fields"].split(",") if options["fields"]
+                    else None),
+            )
+        except ValueError as e:
+            raise CommandError(e)
+
+        if options["output"] == "-":
+            output = sys.stdout.buffer
+        else:
+            output = open(options["output"], "wb")
+        written = 0
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        self.stderr.write(f"Exported {written} bytes")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from rest_app.authentication import TOKEN_TTL
+
+
+class Command(BaseCommand):
+    help = "Delete the authentication tokens that have expired."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            default=1000,
+            help="Tokens deleted per query, default is 1000",
+        )
+
+    def handle(self, *args, **options):
+        expired = Token.objects.filter(
+            created__lte=timezone.now() - TOKEN_TTL)
+        purged = 0
+        while True:
+            keys = list(expired.values_list("key", flat=True)[
+                :options["batch_size"]])
+            if not keys:
+                break
+            # Batches keep every delete, and its locks, short.
+            purged += Token.objects.filter(key__in=keys).delete()[0]
+        self.stdout.write(f"Purged {purged} expired tokens")
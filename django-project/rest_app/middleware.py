@@ -0,0 +1,26 @@
+import time
+
+import metrics
+
+REQUEST_SECONDS = metrics.histogram(
+    "api_request_seconds", "Latency of API requests",
+    ("route", "method", "status"))
+
+
+class MetricsMiddleware:
+    """Observe the latency of every request, labeled by URL route, so
+    the number of series does not grow with the query parameters."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        REQUEST_SECONDS.labels(
+            match.route if match else "unmatched",
+            request.method,
+            str(response.status_code),
+        ).observe(time.perf_counter() - start)
+        return response
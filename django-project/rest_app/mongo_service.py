@@ -1,10 +1,44 @@
 import os
+import time
 
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
 
+from .archive_service import ArchiveService
+
 load_dotenv()
 
+# (stage, from, to) timestamps of a traced MQTT sample, "timestamp" is the
+# CoinCap time of the prices
+LAG_STAGES = (
+    ("upstream", "timestamp", "fetched"),
+    ("publish", "fetched", "published"),
+    ("broker", "published", "ingested"),
+    ("persist", "ingested", "persisted"),
+    ("end_to_end", "timestamp", "persisted"),
+)
+LAG_PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+# Error code of MongoDB before 7.0 for $percentile in a $group stage
+UNKNOWN_GROUP_OPERATOR = 15952
+
+
+def distribution(values):
+    """Return the count, percentiles and maximum of values."""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def percentile(fraction):
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+    return {
+        "count": len(values),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": values[-1],
+    }
+
 
 class MongoService:
 
@@ -13,11 +47,48 @@ class MongoService:
         db=os.getenv("MONGO_DB"),
         mqtt_col=os.getenv("MQTT_MONGO_COLLECTION"),
         mb_col=os.getenv("MODBUS_MONGO_COLLECTION"),
+        symbol_col=os.getenv("MQTT_SYMBOL_MONGO_COLLECTION") or "mqtt_symbols",
+        archive=None,
     ):
         self.client = MongoClient(os.getenv("MONGO_URI"))
         self.db = self.client[db]
         self.mb_col = self.db[mb_col]
         self.mqtt_col = self.db[mqtt_col]
+        self.symbol_col = self.db[symbol_col]
+        self.archive = archive or ArchiveService()
+        # Whether the server has $percentile, until an aggregation fails
+        self.server_percentile = True
+
+    def archived_collections(self):
+        """Return (collection, timestamp field, timestamp scale) of the
+        collections subject to retention, by short name."""
+        return {
+            "mqtt": (self.mqtt_col, "timestamp", 1000),
+            "symbol": (self.symbol_col, "t", 1000),
+            "modbus": (self.mb_col, "timestamp", 1),
+        }
+
+    def with_archive(self, col, field, scale, documents, start=None,
+                     end=None, query=None):
+        """
+        Merge the archived documents of a range into live documents.
+
+        Only ranges with a start read the archive, without one every
+        archived day would be decompressed and scanned.
+        """
+        if start is None:
+            return documents
+        archived = self.archive.find(
+            col.name, field, scale, start=start, end=end, query=query)
+        if not archived:
+            return documents
+        # A document is in both places while it is being archived.
+        live = {document["_id"] for document in documents}
+        documents = [
+            document for document in archived if document["_id"] not in live
+        ] + documents
+        documents.sort(key=lambda document: document[field])
+        return documents
 
     def find_all_mqtt_data(self):
         return list(self.mqtt_col.find())
@@ -25,8 +96,117 @@ class MongoService:
     def find_by_device_id(self, device_id):
         return list(self.mqtt_col.find({"device_id": device_id}))
 
+    def find_symbol_history(self, symbol, device_id=None, start=None,
+                            end=None):
+        query = {"s": symbol}
+        if device_id is not None:
+            query["d"] = device_id
+        match = dict(query)
+        if start is not None or end is not None:
+            query["t"] = {}
+            if start is not None:
+                query["t"]["$gte"] = start
+            if end is not None:
+                query["t"]["$lte"] = end
+        documents = self.with_archive(
+            self.symbol_col, "t", 1000,
+            list(self.symbol_col.find(query).sort("t", 1)),
+            start=start, end=end, query=match,
+        )
+        for document in documents:
+            del document["_id"]
+        return documents
+
+    def find_mqtt_lag(self, start, end, device_id=None, now=None,
+                      limit=100000):
+        """
+        Return the lag distribution of the traced MQTT samples in a range.
+
+        Every stage is reported in milliseconds over at most the limit
+        newest samples, "age" is how old the newest sample of every device
+        is at the time of the request. The percentiles are computed by
+        MongoDB 7.0 or newer, approximately. Older servers lack
+        $percentile, the stage lags are then returned by the aggregation
+        and their percentiles computed here.
+        """
+        query = {
+            "timestamp": {"$gte": start, "$lte": end},
+            "trace.persisted": {"$exists": True},
+        }
+        if device_id is not None:
+            query["device_id"] = device_id
+
+        def path(field):
+            return "$timestamp" if field == "timestamp" else f"$trace.{field}"
+        project = {"$project": {
+            stage: {"$subtract": [path(last), path(first)]}
+            for stage, first, last in LAG_STAGES
+        }}
+        group = {"_id": None}
+        for stage, first, last in LAG_STAGES:
+            group[f"{stage}_count"] = {"$sum": {
+                "$cond": [{"$isNumber": f"${stage}"}, 1, 0]}}
+            group[f"{stage}_percentiles"] = {"$percentile": {
+                "input": f"${stage}", "p": list(LAG_PERCENTILES.values()),
+                "method": "approximate"}}
+            group[f"{stage}_max"] = {"$max": f"${stage}"}
+
+        def aggregate(stages):
+            return next(self.mqtt_col.aggregate([
+                {"$match": query},
+                {"$sort": {"timestamp": -1}},
+                {"$limit": limit},
+                {"$facet": {
+                    "stages": stages,
+                    "newest": [{"$group": {
+                        "_id": "$device_id",
+                        "timestamp": {"$max": "$timestamp"},
+                    }}],
+                }},
+            ]))
+
+        result = None
+        if self.server_percentile:
+            try:
+                result = aggregate([project, {"$group": group}])
+            except OperationFailure as e:
+                if e.code != UNKNOWN_GROUP_OPERATOR:
+                    raise
+                self.server_percentile = False
+        stages = {}
+        if result is not None:
+            totals = result["stages"][0] if result["stages"] else {}
+            for stage, _, _ in LAG_STAGES:
+                if not totals.get(f"{stage}_count"):
+                    stages[stage] = {"count": 0}
+                    continue
+                stages[stage] = {
+                    "count": totals[f"{stage}_count"],
+                    **dict(zip(
+                        LAG_PERCENTILES, totals[f"{stage}_percentiles"])),
+                    "max": totals[f"{stage}_max"],
+                }
+        else:
+            result = aggregate([project])
+            for stage, _, _ in LAG_STAGES:
+                stages[stage] = distribution([
+                    sample[stage] for sample in result["stages"]
+                    if isinstance(sample.get(stage), (int, float))
+                ])
+        now = int(time.time() * 1000) if now is None else now
+        return {
+            "stages": stages,
+            "age": distribution(
+                [now - device["timestamp"] for device in result["newest"]]),
+        }
+
     def find_all_modbus_data(self):
         return list(self.mb_col.find())
 
     def find_modbus_data_by_timestamp(self, timestamp):
-        return list(self.mb_col.find({"timestamp": timestamp}))
+        timestamp = int(timestamp)
+        return self.with_archive(
+            self.mb_col, "timestamp", 1,
+            list(self.mb_col.find({"timestamp": timestamp})),
+            start=timestamp, end=timestamp,
+        )
@@ -1,4 +1,4 @@
-from django.contrib.auth import get_user_model
+from django.contrib.auth import authenticate, get_user_model
 from rest_framework import serializers
 
 User = get_user_model()
@@ -38,15 +38,14 @@ class UserLoginSerializer(serializers.ModelSerializer):
         fields = ['username', 'password']
 
     def validate(self, data):
-        username = data['username']
-        password = data['password']
-        try:
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            raise serializers.ValidationError({'username': 'User not found.'})
-        if not user.check_password(password):
+        user = authenticate(
+            request=self.context.get('request'),
+            username=data['username'],
+            password=data['password'])
+        if user is None:
             raise serializers.ValidationError(
-                {'password': 'Incorrect password.'})
+                {'password': 'Invalid credentials.'})
+        data['user'] = user
         return data
 
 
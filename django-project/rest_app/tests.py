@@ -5,6 +5,25 @@ from rest_framework import status
 from django.contrib.auth import get_user_model
 from unittest.mock import patch
 from rest_framework.test import APITestCase
+import tempfile
+import datetime
+from io import BytesIO, StringIO
+from unittest import skipUnless
+from django.core.cache import caches
+from django.core.management import call_command
+from pymongo.errors import OperationFailure
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+from .archive_service import ArchiveService
+from .export_service import ExportService, pyarrow
+from .authentication import (
+    PasswordUpgrades, password_upgrades, token_cache, upgrade_password_hash)
+from .mongo_service import MongoService, distribution
+from django.contrib.auth.hashers import (
+    PBKDF2PasswordHasher, check_password, make_password)
 
 User = get_user_model()
 
@@ -84,6 +103,54 @@ class UserLoginTest(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_user_login_hashes_password_once(self):
+        with patch.object(
+            PBKDF2PasswordHasher, "verify", autospec=True,
+            side_effect=PBKDF2PasswordHasher.verify,
+        ) as mock_verify:
+            response = self.client.post("/api/login", self.data)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(mock_verify.call_count, 1)
+
+    @patch("rest_app.authentication.password_upgrades.submit")
+    def test_user_login_defers_hash_upgrade(self, mock_submit):
+        old_hash = PBKDF2PasswordHasher().encode(
+            "password", "somesalt", iterations=1000)
+        self.user.password = old_hash
+        self.user.save()
+
+        response = self.client.post("/api/login", self.data)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_submit.assert_called_once()
+        user_pk, submitted_hash, new_hash = mock_submit.call_args[0]
+        self.assertEqual((user_pk, submitted_hash), (self.user.pk, old_hash))
+        self.assertTrue(check_password("password", new_hash))
+        self.assertNotEqual(new_hash, old_hash)
+        password_upgrades.run(*mock_submit.call_args[0])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password, new_hash)
+
+    def test_hash_upgrade_keeps_changed_password(self):
+        old_hash = self.user.password
+        new_hash = make_password("password")
+        self.user.set_password("newpassword")
+        self.user.save()
+
+        self.assertFalse(
+            upgrade_password_hash(self.user.pk, old_hash, new_hash))
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password("newpassword"))
+
+    def test_hash_upgrades_are_bounded(self):
+        upgrades = PasswordUpgrades(max_pending=2)
+
+        self.assertTrue(upgrades.reserve(1))
+        self.assertFalse(upgrades.reserve(1))
+        self.assertTrue(upgrades.reserve(2))
+        self.assertFalse(upgrades.reserve(3))
+
 
 class GetMQTTDataViewTest(APITestCase):
 
@@ -175,6 +242,139 @@ class GetMQTTDeviceDataViewTest(APITestCase):
         self.assertEqual(response.json()["error"], "Device ID is required.")
 
 
+class GetMQTTSymbolHistoryViewTest(APITestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="existinguser", password="password"
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+    @patch("rest_app.mongo_service.MongoService.find_symbol_history")
+    def test_get_symbol_history_authenticated(self, mock_find_history):
+        mock_data = [
+            {"d": "1", "s": "BTC", "t": 1706544941355, "p": 42000.5},
+            {"d": "1", "s": "BTC", "t": 1706544951355, "p": 42001.5},
+        ]
+        mock_find_history.return_value = mock_data
+
+        response = self.client.get(
+            "/api/mqtt/data/symbol",
+            {"symbol": "BTC", "device_id": "1", "from": 1706544941355},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["data"], mock_data)
+        mock_find_history.assert_called_once_with(
+            "BTC", device_id="1", start=1706544941355, end=None)
+
+    def test_get_symbol_history_not_authenticated(self):
+        self.client.credentials()
+
+        response = self.client.get("/api/mqtt/data/symbol", {"symbol": "BTC"})
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_get_symbol_history_no_symbol(self):
+        response = self.client.get("/api/mqtt/data/symbol", {})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["error"], "Symbol is required.")
+
+    def test_get_symbol_history_invalid_range(self):
+        response = self.client.get(
+            "/api/mqtt/data/symbol", {"symbol": "BTC", "to": "yesterday"}
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["error"],
+                         "UNIX timestamp is required.")
+
+
+class GetMQTTLagViewTest(APITestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="existinguser", password="password"
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+    @patch("rest_app.mongo_service.MongoService.find_mqtt_lag")
+    def test_get_mqtt_lag(self, mock_find_lag):
+        mock_data = {"stages": {"broker": {"count": 0}}, "age": {"count": 0}}
+        mock_find_lag.return_value = mock_data
+
+        response = self.client.get(
+            "/api/mqtt/lag", {"from": 1706544941355, "to": 1706548541355})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["data"], mock_data)
+        mock_find_lag.assert_called_once_with(
+            1706544941355, 1706548541355, device_id=None)
+
+    def test_get_mqtt_lag_invalid_range(self):
+        response = self.client.get("/api/mqtt/lag", {"from": "today"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["error"],
+                         "UNIX timestamp is required.")
+
+    @patch("pymongo.collection.Collection.aggregate")
+    def test_find_mqtt_lag(self, mock_aggregate):
+        mock_aggregate.return_value = iter([{
+            "stages": [{
+                "_id": None, "broker_count": 2,
+                "broker_percentiles": [10.0, 30.0, 30.0], "broker_max": 30,
+                **{f"{stage}_count": 0 for stage in
+                   ("upstream", "publish", "persist", "end_to_end")},
+            }],
+            "newest": [{"_id": "1", "timestamp": 900}],
+        }])
+        service = MongoService(db="testdb", mqtt_col="mqtt", mb_col="modbus")
+
+        lag = service.find_mqtt_lag(0, 1000, device_id="1", now=1000)
+
+        self.assertEqual(lag["stages"]["broker"], {
+            "count": 2, "p50": 10.0, "p90": 30.0, "p99": 30.0, "max": 30})
+        self.assertEqual(lag["stages"]["persist"], {"count": 0})
+        self.assertEqual(lag["age"]["max"], 100)
+        self.assertEqual(mock_aggregate.call_args[0][0][0], {"$match": {
+            "timestamp": {"$gte": 0, "$lte": 1000},
+            "trace.persisted": {"$exists": True}, "device_id": "1"}})
+
+    @patch("pymongo.collection.Collection.aggregate")
+    def test_find_mqtt_lag_before_mongodb_7(self, mock_aggregate):
+        mock_aggregate.side_effect = [
+            OperationFailure(
+                "unknown group operator '$percentile'", code=15952),
+            iter([{
+                "stages": [{"broker": 10}, {"broker": 30}, {"persist": None}],
+                "newest": [{"_id": "1", "timestamp": 900}],
+            }]),
+        ]
+        service = MongoService(db="testdb", mqtt_col="mqtt", mb_col="modbus")
+
+        lag = service.find_mqtt_lag(0, 1000, now=1000)
+
+        self.assertEqual(lag["stages"]["broker"], {
+            "count": 2, "p50": 30, "p90": 30, "p99": 30, "max": 30})
+        self.assertEqual(lag["stages"]["persist"], {"count": 0})
+        self.assertEqual(lag["age"]["max"], 100)
+        self.assertFalse(service.server_percentile)
+        facet = mock_aggregate.call_args[0][0][3]["$facet"]
+        self.assertNotIn("$group", facet["stages"][-1])
+
+    def test_distribution(self):
+        self.assertEqual(distribution([]), {"count": 0})
+        self.assertEqual(
+            distribution(list(range(100, 0, -1))),
+            {"count": 100, "p50": 51, "p90": 91, "p99": 100, "max": 100})
+
+
 class SendMQTTCommandViewTest(APITestCase):
 
     def setUp(self):
@@ -334,3 +534,357 @@ class GetModbusDataByTimestampViewTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertEqual(response.json()["error"],
                          "UNIX timestamp is required.")
+
+
+class ArchiveServiceTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = ArchiveService(self.directory.name)
+        self.documents = [
+            {"_id": "a", "d": "1", "s": "BTC", "t": 1706544941355, "p": 1.5},
+            {"_id": "b", "d": "2", "s": "BTC", "t": 1706544951355, "p": 2.5},
+            {"_id": "c", "d": "1", "s": "BTC", "t": 1706631341355, "p": 3.5},
+        ]
+        for document in self.documents:
+            self.archive.write_partition(
+                "symbols", self.archive.day_of(document["t"], 1000),
+                [document])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_find_range(self):
+        documents = self.archive.find(
+            "symbols", "t", 1000, start=1706544951355, query={"s": "BTC"})
+
+        self.assertEqual(documents, self.documents[1:])
+        self.assertEqual(len(self.archive.days("symbols")), 2)
+
+    def test_write_partition_is_idempotent(self):
+        day = self.archive.day_of(1706544941355, 1000)
+
+        added = self.archive.write_partition(
+            "symbols", day, self.documents[:2])
+
+        self.assertEqual(added, 0)
+        self.assertEqual(
+            self.archive.find("symbols", "t", 1000, query={"d": "1"}),
+            [self.documents[0], self.documents[2]])
+
+    def test_write_partition_appends_a_member(self):
+        day = self.archive.day_of(1706544941355, 1000)
+        path = self.archive.partition_path("symbols", day)
+        with open(path, "rb") as partition:
+            before = partition.read()
+
+        self.archive.write_partition("symbols", day, [
+            {"_id": "d", "d": "3", "s": "ETH", "t": 1706544961355, "p": 1}])
+
+        with open(path, "rb") as partition:
+            self.assertTrue(partition.read().startswith(before))
+        self.assertEqual(
+            [document["_id"]
+             for document in self.archive.read_partition("symbols", day)],
+            ["a", "b", "d"])
+
+    def test_write_partition_streams_documents(self):
+        day = self.archive.day_of(1706544941355, 1000)
+        new = {"_id": "d", "d": "3", "s": "ETH", "t": 1706544961355, "p": 1}
+        iterated = []
+
+        def documents():
+            for document in [*self.documents[:2], new]:
+                iterated.append(document["_id"])
+                yield document
+
+        added = self.archive.write_partition("symbols", day, documents())
+
+        self.assertEqual(added, 1)
+        self.assertEqual(iterated, ["a", "b", "d"])
+        self.assertEqual(
+            list(self.archive.read_partition("symbols", day)),
+            [*self.documents[:2], new])
+
+    def test_write_partition_repairs_incomplete_write(self):
+        day = self.archive.day_of(1706544941355, 1000)
+        path = self.archive.partition_path("symbols", day)
+        with open(path, "r+b") as partition:
+            partition.truncate(len(partition.read()) - 10)
+
+        self.assertEqual(
+            [document["_id"]
+             for document in self.archive.read_partition("symbols", day)],
+            ["a"])
+        added = self.archive.write_partition(
+            "symbols", day, self.documents[:2])
+
+        self.assertEqual(added, 1)
+        self.assertEqual(
+            list(self.archive.read_partition("symbols", day)),
+            self.documents[:2])
+
+    @skipUnless(mongomock, "needs mongomock")
+    def test_export_skips_live_documents_already_archived(self):
+        service = MongoService(
+            db="testdb", mqtt_col="mqtt", mb_col="modbus",
+            symbol_col="symbols", archive=self.archive)
+        service.symbol_col = mongomock.MongoClient().testdb.symbols
+        live = {"_id": "d", "d": "1", "s": "BTC", "t": 1706631351355,
+                "p": 4.5}
+        service.symbol_col.insert_many([dict(self.documents[1]), live])
+
+        batches = ExportService(service, batch_size=2).batches(
+            "symbol", start=1706544941355, fields=["t", "p"])
+
+        self.assertEqual(
+            [batch for batch in batches],
+            [[{"t": document["t"], "p": document["p"]}
+              for document in self.documents[:2]],
+             [{"t": document["t"], "p": document["p"]}
+              for document in (self.documents[2], live)]])
+
+    def test_open_range_does_not_read_archive(self):
+        service = MongoService(
+            db="testdb", mqtt_col="mqtt", mb_col="modbus",
+            symbol_col="symbols", archive=self.archive)
+
+        with patch.object(self.archive, "find") as mock_find:
+            documents = service.with_archive(
+                service.symbol_col, "t", 1000, [], end=1706544951355)
+
+        self.assertEqual(documents, [])
+        mock_find.assert_not_called()
+        self.assertEqual(
+            service.with_archive(
+                service.symbol_col, "t", 1000, [], start=1706544941355,
+                end=1706544951355),
+            self.documents[:2])
+
+
+class ExportDataViewTest(APITestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="existinguser", password="password"
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+    @patch("rest_app.export_service.ExportService.batches")
+    def test_export_csv(self, mock_batches):
+        mock_batches.return_value = iter([
+            [{"timestamp": 1706544941, "value": {"1": 1.5, "2": 2.5}}],
+            [{"timestamp": 1706544951, "value": {"1": 3.5, "2": 4.5}}],
+        ])
+
+        response = self.client.get(
+            "/api/export",
+            {"collection": "modbus", "from": 1706544941,
+             "fields": "timestamp,value.1"},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            b"".join(response.streaming_content).decode().splitlines(),
+            ["timestamp,value.1", "1706544941,1.5", "1706544951,3.5"])
+        mock_batches.assert_called_once_with(
+            "modbus", 1706544941, None, ["timestamp", "value.1"])
+
+    @patch("rest_app.export_service.ExportService.batches")
+    def test_export_csv_columns_of_leading_batch(self, mock_batches):
+        mock_batches.return_value = iter([
+            [{"timestamp": 1706544941, "value": {"1": 1.5}},
+             {"timestamp": 1706544946, "value": {"2": 2.5}}],
+            [{"timestamp": 1706544951, "value": {"1": "3.5", "3": 4.5}}],
+        ])
+
+        response = self.client.get("/api/export", {"collection": "modbus"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            b"".join(response.streaming_content).decode().splitlines(),
+            ["timestamp,value.1,value.2", "1706544941,1.5,",
+             "1706544946,,2.5", "1706544951,3.5,"])
+        mock_batches.assert_called_once()
+
+    @skipUnless(pyarrow, "needs pyarrow")
+    @patch("rest_app.export_service.ExportService.batches")
+    def test_export_parquet_mixed_types(self, mock_batches):
+        mock_batches.return_value = iter([
+            [{"t": 1706544941000, "priceUsd": "1.5", "value": {"1": 1.5}},
+             {"t": 1706544946000, "priceUsd": 2.0, "value": {"1": 2}}],
+            [{"t": 1706544951000, "priceUsd": 2.5, "value": {"1": "x"},
+              "symbol": "BTC"}],
+        ])
+
+        with self.assertLogs(level="WARNING"):
+            response = self.client.get(
+                "/api/export",
+                {"collection": "symbol", "file_format": "parquet"})
+            content = b"".join(response.streaming_content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        table = pyarrow.parquet.read_table(BytesIO(content))
+        self.assertEqual(table.to_pylist(), [
+            {"t": 1706544941000, "priceUsd": "1.5", "value": {"1": 1.5}},
+            {"t": 1706544946000, "priceUsd": "2.0", "value": {"1": 2.0}},
+            {"t": 1706544951000, "priceUsd": "2.5", "value": None},
+        ])
+
+    def test_export_not_authenticated(self):
+        self.client.credentials()
+
+        response = self.client.get("/api/export", {"collection": "modbus"})
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_export_no_collection(self):
+        response = self.client.get("/api/export", {})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["error"], "Collection is required.")
+
+    def test_export_unknown_format(self):
+        response = self.client.get(
+            "/api/export", {"collection": "modbus", "file_format": "xlsx"})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["error"],
+                         "Unknown export format xlsx")
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="existinguser", password="password"
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+    @patch("rest_app.mongo_service.MongoService.find_all_mqtt_data")
+    def test_cached_token_needs_no_query(self, mock_find_all):
+        mock_find_all.return_value = []
+        self.client.get("/api/mqtt/data", {})
+
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/mqtt/data", {})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @patch("rest_app.mongo_service.MongoService.find_all_mqtt_data")
+    def test_logout_invalidates_cached_token(self, mock_find_all):
+        mock_find_all.return_value = []
+        self.client.get("/api/mqtt/data", {})
+
+        self.client.post("/api/logout")
+        response = self.client.get("/api/mqtt/data", {})
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.json()["detail"], "Invalid token.")
+
+    @patch("rest_app.mongo_service.MongoService.find_all_mqtt_data")
+    def test_saved_user_invalidates_cached_token(self, mock_find_all):
+        mock_find_all.return_value = []
+        self.client.get("/api/mqtt/data", {})
+
+        self.user.set_password("newpassword")
+        self.user.save()
+
+        self.assertIsNone(token_cache.get(self.token.key))
+
+    @patch("rest_app.mongo_service.MongoService.find_all_mqtt_data")
+    def test_token_is_cached_in_shared_cache(self, mock_find_all):
+        mock_find_all.return_value = []
+        self.client.get("/api/mqtt/data", {})
+        key = "token:" + self.token.key
+
+        user, token = caches["tokens"].get(key)
+
+        self.assertEqual((user.pk, token.key), (self.user.pk, self.token.key))
+        self.token.delete()
+        self.assertIsNone(caches["tokens"].get(key))
+
+
+class TokenExpiryTest(APITestCase):
+
+    def setUp(self):
+        token_cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username="existinguser", password="password"
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+    def age_token(self, token, **age):
+        Token.objects.filter(key=token.key).update(
+            created=token.created - datetime.timedelta(**age))
+
+    @patch("rest_app.mongo_service.MongoService.find_all_mqtt_data")
+    def test_expired_token(self, mock_find_all):
+        mock_find_all.return_value = []
+        self.age_token(self.token, days=8)
+
+        response = self.client.get("/api/mqtt/data", {})
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.json()["detail"], "Token has expired.")
+        self.assertFalse(Token.objects.filter(key=self.token.key).exists())
+
+    @patch("rest_app.mongo_service.MongoService.find_all_mqtt_data")
+    def test_used_token_is_refreshed(self, mock_find_all):
+        mock_find_all.return_value = []
+        self.age_token(self.token, days=6)
+
+        self.client.get("/api/mqtt/data", {})
+        refreshed = Token.objects.get(key=self.token.key).created
+        with self.assertNumQueries(0):
+            response = self.client.get("/api/mqtt/data", {})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(refreshed, self.token.created)
+
+    def test_login_replaces_expired_token(self):
+        self.age_token(self.token, days=8)
+
+        response = self.client.post(
+            "/api/login", {"username": "existinguser",
+                           "password": "password"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response.json()["token"], self.token.key)
+
+    def test_purge_tokens(self):
+        other = User.objects.create_user(username="other", password="pw")
+        self.age_token(Token.objects.create(user=other), days=8)
+        out = StringIO()
+
+        call_command("purge_tokens", stdout=out)
+
+        self.assertEqual(list(Token.objects.all()), [self.token])
+        self.assertIn("Purged 1 expired tokens", out.getvalue())
+
+
+class MetricsViewTest(APITestCase):
+
+    @patch("rest_app.mongo_service.MongoService.find_all_modbus_data")
+    def test_metrics(self, mock_find_all_modbus_data):
+        self.client.get("/api/modbus/data", {})
+
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(
+            'api_request_seconds_count{route="api/modbus/data",'
+            'method="GET",status="401"}',
+            response.content.decode())
+
+    def test_metrics_forbidden_address(self):
+        response = self.client.get("/metrics", REMOTE_ADDR="203.0.113.7")
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
@@ -1,23 +1,31 @@
 import json
+import time
 
 from rest_framework.exceptions import ValidationError
 from .serializers import UserLoginSerializer, UserRegisterSerializer
-from django.contrib.auth import login, logout, authenticate
+from django.contrib.auth import login, logout
 from rest_framework import permissions, status
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import (
+    api_view, authentication_classes, permission_classes)
 from rest_framework.authtoken.models import Token
+from django.http import HttpResponse, StreamingHttpResponse
 from bson import json_util
+import metrics
 
+from .authentication import MetricsClient, token_expired
 from .mqtt_service import MQTTService
 from .mongo_service import MongoService
+from .export_service import ExportService, CONTENT_TYPES, CSV
 
 
 mongo_service = MongoService()
 mqtt_service = MQTTService()
+export_service = ExportService(mongo_service)
 
 
 @api_view(["POST"])
+@authentication_classes([])
 @permission_classes([permissions.AllowAny])
 def UserRegisterView(request):
     try:
@@ -38,24 +46,24 @@ def UserRegisterView(request):
 
 
 @api_view(["POST"])
+@authentication_classes([])
 @permission_classes([permissions.AllowAny])
 def UserLoginView(request):
     try:
         data = request.data
-        serializer = UserLoginSerializer(data=data)
+        serializer = UserLoginSerializer(
+            data=data, context={"request": request})
         if serializer.is_valid(raise_exception=True):
-            clean_data = serializer.validated_data
-            user = authenticate(
-                username=clean_data["username"],
-                password=clean_data["password"])
-            if user is not None:
-                login(request, user)
-                token, created = Token.objects.get_or_create(user=user)
-                return Response({"token": token.key},
-                                status=status.HTTP_200_OK)
-            else:
-                return Response({"error": "Invalid Credentials"},
-                                status=status.HTTP_401_UNAUTHORIZED,)
+            # The serializer already authenticated the user, checking the
+            # password again would double the cost of a login.
+            user = serializer.validated_data["user"]
+            login(request, user)
+            token, created = Token.objects.get_or_create(user=user)
+            if not created and token_expired(token):
+                token.delete()
+                token = Token.objects.create(user=user)
+            return Response({"token": token.key},
+                            status=status.HTTP_200_OK)
     except ValidationError as e:
         return Response(
             data={"error": e.detail},
@@ -116,6 +124,52 @@ def GetMQTTDeviceDataView(request):
         return Response(data=str(e), status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def GetMQTTSymbolHistoryView(request):
+    try:
+        data = request.query_params
+        if "symbol" not in data:
+            return Response(
+                {"error": "Symbol is required."},
+                status=status.HTTP_400_BAD_REQUEST)
+        for param in ("from", "to"):
+            if param in data and not data[param].isdigit():
+                return Response(
+                    {"error": "UNIX timestamp is required."},
+                    status=status.HTTP_400_BAD_REQUEST)
+        data = mongo_service.find_symbol_history(
+            data["symbol"],
+            device_id=data.get("device_id"),
+            start=int(data["from"]) if "from" in data else None,
+            end=int(data["to"]) if "to" in data else None,
+        )
+        return Response(
+            {"data": json.loads(json_util.dumps(data))},
+            status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response(data=str(e), status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def GetMQTTLagView(request):
+    try:
+        data = request.query_params
+        for param in ("from", "to"):
+            if param in data and not data[param].isdigit():
+                return Response(
+                    {"error": "UNIX timestamp is required."},
+                    status=status.HTTP_400_BAD_REQUEST)
+        end = int(data["to"]) if "to" in data else int(time.time() * 1000)
+        start = int(data["from"]) if "from" in data else end - 3600 * 1000
+        data = mongo_service.find_mqtt_lag(
+            start, end, device_id=data.get("device_id"))
+        return Response({"data": data}, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response(data=str(e), status=status.HTTP_400_BAD_REQUEST)
+
+
 @api_view(["POST"])
 @permission_classes([permissions.IsAuthenticated])
 def SendMQTTCommandView(request):
@@ -177,3 +231,45 @@ def GetModbusDataByTimestampView(request):
                             status=status.HTTP_200_OK)
     except Exception as e:
         return Response(data=str(e), status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+def ExportDataView(request):
+    try:
+        data = request.query_params
+        if "collection" not in data:
+            return Response(
+                {"error": "Collection is required."},
+                status=status.HTTP_400_BAD_REQUEST)
+        for param in ("from", "to"):
+            if param in data and not data[param].isdigit():
+                return Response(
+                    {"error": "UNIX timestamp is required."},
+                    status=status.HTTP_400_BAD_REQUEST)
+        export_format = data.get("file_format", CSV)
+        fields = data["fields"].split(",") if data.get("fields") else None
+        chunks = export_service.export(
+            data["collection"],
+            export_format,
+            start=int(data["from"]) if "from" in data else None,
+            end=int(data["to"]) if "to" in data else None,
+            fields=fields,
+        )
+        response = StreamingHttpResponse(
+            chunks, content_type=CONTENT_TYPES[export_format])
+        response["Content-Disposition"] = (
+            f'attachment; filename="{data["collection"]}.{export_format}"')
+        return response
+    except ValueError as e:
+        return Response({"error": str(e)},
+                        status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response(data=str(e), status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([MetricsClient])
+def MetricsView(request):
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,296 @@
+import os
+import time
+import bisect
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\")
+                     .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    ) + "}"
+
+
+class CounterValue:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name):
+        yield name, (), self.value
+
+
+class GaugeValue:
+    __slots__ = ("value", "function", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Read the value from function when the metrics are rendered."""
+        self.function = function
+
+    def samples(self, name):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                logging.debug("Failed to read gauge %s: %s", name, e)
+        yield name, (), value
+
+
+class HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Return a context manager observing the seconds it lasted."""
+        return Timer(self)
+
+    def samples(self, name):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += count
+            yield name + "_bucket", (("le", format_value(bound)),), cumulative
+        yield name + "_sum", (), total
+        yield name + "_count", (), cumulative
+
+
+class Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """
+    A class representing a named metric and its labeled values.
+
+    Without label names the metric is used directly, like its single
+    value; otherwise labels(*values) returns the value of a label
+    combination, created on first use.
+
+    Args:
+        kind (str): The Prometheus type, "counter", "gauge" or
+        "histogram".
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        labelnames (tuple): The names of the labels.
+        buckets (tuple): The upper bounds of the histogram buckets.
+    """
+
+    def __init__(self, kind, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.children = {}
+        self.lock = threading.Lock()
+        self.default = None if self.labelnames else self.labels()
+
+    def new_value(self):
+        if self.kind == "counter":
+            return CounterValue()
+        if self.kind == "gauge":
+            return GaugeValue()
+        return HistogramValue(self.buckets)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    f"{self.name} needs labels {self.labelnames}")
+            with self.lock:
+                child = self.children.setdefault(values, self.new_value())
+        return child
+
+    # Shortcuts to the value of an unlabeled metric
+
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+    def dec(self, amount=1):
+        self.default.dec(amount)
+
+    def set(self, value):
+        self.default.set(value)
+
+    def set_function(self, function):
+        self.default.set_function(function)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def time(self):
+        return self.default.time()
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in list(self.children.items()):
+            for name, extra, value in child.samples(self.name):
+                lines.append(
+                    name + format_labels(self.labelnames, values, extra)
+                    + " " + format_value(value))
+        return "\n".join(lines)
+
+
+class Registry:
+    """A class representing the metrics of a process."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, kind, name, documentation, labelnames=(),
+                      buckets=LATENCY_BUCKETS):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = Metric(
+                    kind, name, documentation, labelnames, buckets)
+                self.metrics[name] = metric
+            elif metric.kind != kind:
+                raise ValueError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.get_or_create(
+        "counter", name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.get_or_create("gauge", name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.get_or_create(
+        "histogram", name, documentation, labelnames, buckets)
+
+
+def render():
+    """Return the metrics of the process in the Prometheus text format."""
+    return REGISTRY.render()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_textfile(path):
+    """Write the metrics to path atomically, for a textfile collector."""
+    with open(path + ".tmp", "w") as textfile:
+        textfile.write(render())
+    os.replace(path + ".tmp", path)
+
+
+def start_exporter(port=None, path=None, interval=15):
+    """
+    Export the metrics of the process in the background.
+
+    Args:
+        port (int): Serve the metrics over HTTP on this port, None to not
+        serve them.
+        path (str): Write the metrics to this file every interval
+        seconds, None to not write them.
+        interval (float): The seconds between two writes of the file.
+    """
+    if port is not None:
+        server = ThreadingHTTPServer(("", port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info("Serving metrics on port %s", port)
+    if path is not None:
+        def write_periodically():
+            while True:
+                try:
+                    write_textfile(path)
+                except OSError as e:
+                    logging.error(
+                        "Failed to write metrics with error: %s", e)
+                time.sleep(interval)
+        threading.Thread(target=write_periodically, daemon=True).start()
+        logging.info("Writing metrics to %s every %ss", path, interval)
@@ -1,17 +1,149 @@
 import os
 import ssl
 import time
+import queue
+import select
+import socket
 import logging
 import argparse
+import threading
 
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, PyMongoError
 from pymodbus.client import ModbusTlsClient
-from pymodbus.exceptions import ModbusException
-from pymodbus.payload import BinaryPayloadDecoder, Endian
+from pymodbus.exceptions import ConnectionException, ModbusIOException
 from dotenv import load_dotenv
+from scheduler import DeadlineScheduler, OVERRUN_POLICIES, SKIP
+from deadband import DeadbandFilter
+from service_logging import PeriodicSummary, setup_logging
+import modbus_registers
+import metrics
 
 load_dotenv()
 
+COINS = 10
+DUPLICATE_KEY_ERROR = 11000
+
+READ_SECONDS = metrics.histogram(
+    "modbus_client_read_seconds", "Round-trip time of Modbus register reads")
+READ_ERRORS = metrics.counter(
+    "modbus_client_read_errors_total", "Failed Modbus register reads")
+WRITE_SECONDS = metrics.histogram(
+    "modbus_client_mongo_write_seconds", "Latency of MongoDB inserts")
+SAMPLES = metrics.counter(
+    "modbus_client_samples_total",
+    "Polls by result: persisted, unchanged, suppressed, dropped or failed",
+    ("result",))
+BATCH_SIZE = metrics.histogram(
+    "modbus_client_batch_samples", "Samples per bulk insert",
+    buckets=metrics.SIZE_BUCKETS)
+BACKFILL = metrics.counter(
+    "modbus_client_backfill_samples_total",
+    "Missed server updates by result: backfilled or lost", ("result",))
+QUEUED = metrics.gauge(
+    "modbus_client_queued_samples", "Samples waiting for their insert")
+CONNECTS = metrics.counter(
+    "modbus_client_connects_total",
+    "Connection attempts by result: full, resumed or failed", ("result",))
+RECONNECTS = metrics.counter(
+    "modbus_client_reconnects_total",
+    "Connections re-established after the connection was lost")
+CONNECT_SECONDS = metrics.histogram(
+    "modbus_client_connect_seconds",
+    "TCP connect and TLS handshake time by handshake: full or resumed",
+    ("handshake",))
+
+
+class ResumingTlsClient(ModbusTlsClient):
+    """
+    A class representing a Modbus TLS client resuming its TLS sessions.
+
+    The TLS session of the last connection, taken once it served a read,
+    is offered on the next connect, so a reconnect to the same server
+    skips the full handshake when the server accepts the session ticket.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tls_session = None
+        self.session_pending = False
+
+    def connect(self):
+        if self.socket:
+            return True
+        sock = None
+        try:
+            sock = socket.create_connection(
+                (self.comm_params.host, self.comm_params.port),
+                timeout=self.comm_params.timeout_connect,
+                source_address=self.params.source_address,
+            )
+            self.socket = self.sslctx.wrap_socket(
+                sock, server_side=False,
+                server_hostname=self.comm_params.host,
+                session=self.tls_session,
+            )
+            self.session_pending = True
+        except OSError as e:
+            logging.debug(
+                "Connection to %s:%s failed: %s",
+                self.comm_params.host, self.comm_params.port, e)
+            if sock is not None:
+                sock.close()
+            self.close()
+        return self.socket is not None
+
+    def recv(self, size):
+        """
+        Read size bytes, or what arrives before the timeout if size is
+        None, like pymodbus does.
+
+        TLS 1.3 session tickets arrive after the handshake: the socket
+        then polls readable without application data and the read raises
+        SSLWantReadError, which only means to wait for more data. Bytes
+        already read are kept.
+        """
+        if not self.socket:
+            raise ConnectionException(str(self))
+        self.socket.setblocking(False)
+        recv_size = 4096 if size is None else size
+        data = []
+        started = time.time()
+        end = started + self.comm_params.timeout_connect
+        while recv_size > 0:
+            # Bytes the TLS layer already decrypted do not poll readable
+            if not self.socket.pending():
+                try:
+                    select.select(
+                        [self.socket], [], [], max(end - time.time(), 0))
+                except ValueError:
+                    return self._handle_abrupt_socket_close(
+                        size, data, time.time() - started)
+            try:
+                chunk = self.socket.recv(recv_size)
+            except (ssl.SSLWantReadError, BlockingIOError):
+                chunk = None
+            if chunk == b"":
+                return self._handle_abrupt_socket_close(
+                    size, data, time.time() - started)
+            if chunk:
+                data.append(chunk)
+                if size:
+                    recv_size -= len(chunk)
+            if time.time() > end:
+                break
+        data = b"".join(data)
+        # The session of a connection that broke is not resumable, keep
+        # the one of its first successful read, its ticket has arrived.
+        if data and self.session_pending:
+            self.tls_session = self.socket.session
+            self.session_pending = False
+        return data
+
+    @property
+    def session_reused(self):
+        return self.socket is not None and self.socket.session_reused
+
 
 class ModbusPersistenceClient:
     """
@@ -20,6 +152,22 @@ class ModbusPersistenceClient:
     This client connects to a Modbus server, reads holding registers
     and persists the values to a MongoDB database at a specified interval.
 
+    Polls read the status registers of the server and only read the
+    prices when its sequence number changed, so polling faster than the
+    server updates costs one small read per poll. Samples carry the time
+    of the server update. Updates missed since the last poll, while the
+    server was unreachable or polls were slower than updates, are read
+    from the history the server keeps in its input registers.
+
+    Polls only read and decode the registers and queue the sample, a
+    writer thread inserts the queued samples in batches, so slow MongoDB
+    writes do not delay polls. When the queue is full the oldest sample
+    is dropped.
+
+    A lost connection is re-established at once, resuming the TLS
+    session, and the read is retried; while the server stays unreachable
+    polls are skipped and attempts are spaced with exponential backoff.
+
     Args:
         modbus_host (str): The host address of the Modbus server.
         modbus_port (int): The port number of the Modbus server.
@@ -27,8 +175,21 @@ class ModbusPersistenceClient:
         mongo_port (int): The port number of the MongoDB server.
         mongo_db (str): The name of the MongoDB database.
         mongo_collection (str): The name of the MongoDB collection.
-        interval (int): The interval in seconds between each reading
+        interval (float): The interval in seconds between each reading
         and persistence.
+        overrun_policy (str): What to do with missed polling deadlines,
+        "skip" or "catch_up".
+        deadband (DeadbandFilter): An optional filter that suppresses
+        writes of samples which did not change significantly.
+        reconnect_delay (float): The seconds before the second attempt to
+        reconnect, doubled after every failed attempt.
+        reconnect_delay_max (float): The maximum seconds between two
+        attempts to reconnect.
+        batch_size (int): The maximum number of samples per insert.
+        max_queued (int): The maximum number of samples waiting for their
+        insert.
+        write_retries (int): The maximum number of retries of a failed
+        insert.
     """
 
     def __init__(
@@ -39,6 +200,13 @@ class ModbusPersistenceClient:
         mongo_db,
         mongo_collection,
         interval,
+        overrun_policy=SKIP,
+        deadband=None,
+        reconnect_delay=1.0,
+        reconnect_delay_max=60.0,
+        batch_size=100,
+        max_queued=10000,
+        write_retries=5,
     ):
 
         ssl_context = ssl.create_default_context(
@@ -53,7 +221,7 @@ class ModbusPersistenceClient:
         ssl_context.check_hostname = False
         ssl_context.verify_mode = ssl.CERT_NONE
 
-        self.modbus_client = ModbusTlsClient(
+        self.modbus_client = ResumingTlsClient(
             host=modbus_host,
             port=modbus_port,
             sslctx=ssl_context,
@@ -65,43 +233,288 @@ class ModbusPersistenceClient:
         self.collection = self.db[mongo_collection]
 
         self.interval = interval
+        self.overrun_policy = overrun_policy
+        self.deadband = deadband
+        self.summary = PeriodicSummary()
+        self.batch_size = batch_size
+        self.write_retries = write_retries
+        self.samples = queue.Queue(max_queued)
+        QUEUED.set_function(self.samples.qsize)
+        self.stopped = threading.Event()
+        self.sequence = None
+        self.updated_ms = None
+
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_delay_max = reconnect_delay_max
+        self.backoff = reconnect_delay
+        self.next_attempt = 0.0
+        self.was_connected = False
+        self.connect()
 
-        if self.modbus_client.connect():
-            logging.info("Connected to Modbus server")
+    def connect(self):
+        """
+        Connect to the Modbus server unless waiting for the next attempt.
+
+        Returns:
+            bool: Whether the client is connected.
+        """
+        now = time.monotonic()
+        if now < self.next_attempt:
+            return False
+        started = time.perf_counter()
+        if not self.modbus_client.connect():
+            CONNECTS.labels("failed").inc()
+            logging.warning(
+                "Failed to connect to Modbus server, next attempt in %.1fs",
+                self.backoff)
+            self.next_attempt = now + self.backoff
+            self.backoff = min(self.backoff * 2, self.reconnect_delay_max)
+            return False
+        seconds = time.perf_counter() - started
+        handshake = "resumed" if self.modbus_client.session_reused else "full"
+        CONNECTS.labels(handshake).inc()
+        CONNECT_SECONDS.labels(handshake).observe(seconds)
+        if self.was_connected:
+            RECONNECTS.inc()
+        self.was_connected = True
+        self.backoff = self.reconnect_delay
+        self.next_attempt = 0.0
+        logging.info(
+            "Connected to Modbus server in %.1fms, %s handshake",
+            seconds * 1000, handshake)
+        return True
+
+    def read_registers(self, address, count, input_registers=False):
+        """
+        Read holding or input registers, reconnecting once if the
+        connection was lost.
+
+        Returns:
+            The pymodbus response, None if the server is unreachable.
+        """
+        for _ in range(2):
+            if not self.modbus_client.is_socket_open() and not self.connect():
+                return None
+            try:
+                with READ_SECONDS.time():
+                    if input_registers:
+                        response = self.modbus_client.read_input_registers(
+                            address, count, unit=1)
+                    else:
+                        response = self.modbus_client.read_holding_registers(
+                            address, count, unit=1)
+            except ConnectionException as e:
+                response = e
+            # Unlike error responses of the server, I/O errors leave the
+            # connection in an unknown state.
+            if not isinstance(
+                response, (ModbusIOException, ConnectionException)
+            ):
+                return response
+            READ_ERRORS.inc()
+            logging.warning("Modbus connection lost: %s", response)
+            self.modbus_client.close()
+        return None
+
+    def poll(self):
+        """Read the prices if the server updated them and persist them."""
+        status = self.read_registers(
+            modbus_registers.STATUS_ADDRESS, modbus_registers.STATUS_COUNT)
+        if status is None:
+            return
+        if status.isError():
+            READ_ERRORS.inc()
+            logging.error("Modbus error: %s", status)
+            return
+        sequence, updated_ms = modbus_registers.decode_status(
+            status.registers)
+        # A server restarted without a snapshot numbers its updates from
+        # 1 again, so a known sequence with another time is a new update.
+        if sequence == 0 or (
+                sequence == self.sequence and updated_ms == self.updated_ms):
+            SAMPLES.labels("unchanged").inc()
+            return
+        # A server restored from its snapshot serves an older update until
+        # its next one, which was persisted already.
+        if self.updated_ms is not None and updated_ms < self.updated_ms:
+            SAMPLES.labels("unchanged").inc()
+            return
+
+        response = self.read_registers(
+            modbus_registers.PRICE_ADDRESS,
+            modbus_registers.price_count(COINS))
+        if response is None:
+            return
+        if not response.isError():
+            if self.sequence is not None and sequence > self.sequence + 1:
+                self.backfill(sequence)
+            self.sequence = sequence
+            self.updated_ms = updated_ms
+            self.persist(
+                sequence, updated_ms,
+                modbus_registers.decode_prices(response.registers))
         else:
-            raise ModbusException("Failed to connect to Modbus server")
+            READ_ERRORS.inc()
+            logging.error("Modbus error: %s", response)
+
+    def backfill(self, sequence):
+        """
+        Persist the updates after the last persisted one and before
+        sequence that the server history still holds.
+
+        Args:
+            sequence (int): The sequence number of the current update.
+        """
+        missed = sequence - self.sequence - 1
+        header = self.read_registers(
+            modbus_registers.HISTORY_ADDRESS,
+            modbus_registers.HISTORY_HEADER_COUNT, input_registers=True)
+        entries = {}
+        if header is not None and not header.isError():
+            head, slots, newest = modbus_registers.decode_history_header(
+                header.registers)
+            wanted = range(
+                max(self.sequence + 1, newest - slots + 1),
+                min(sequence, newest + 1))
+            per_read = (modbus_registers.MAX_READ_COUNT
+                        // modbus_registers.HISTORY_ENTRY_COUNT)
+            index = 0
+            # Consecutive updates are in consecutive slots, read them in
+            # bulk, split where the ring wraps around
+            while index < len(wanted):
+                slot = modbus_registers.history_slot(
+                    head, newest, wanted[index], slots)
+                count = min(per_read, len(wanted) - index, slots - slot)
+                response = self.read_registers(
+                    modbus_registers.history_address(slot),
+                    count * modbus_registers.HISTORY_ENTRY_COUNT,
+                    input_registers=True)
+                if response is None or response.isError():
+                    break
+                for entry in modbus_registers.decode_history_entries(
+                    response.registers
+                ):
+                    entries[entry[0]] = entry
+                index += count
+        # Entries overwritten by newer updates meanwhile are lost too
+        backfilled = 0
+        for missed_sequence in range(self.sequence + 1, sequence):
+            if missed_sequence in entries:
+                self.persist(*entries[missed_sequence])
+                backfilled += 1
+        BACKFILL.labels("backfilled").inc(backfilled)
+        if missed > backfilled:
+            BACKFILL.labels("lost").inc(missed - backfilled)
+            logging.warning(
+                "Lost %s server updates no longer in its history",
+                missed - backfilled)
+        if backfilled:
+            self.summary.add("backfilled", backfilled)
+
+    def persist(self, sequence, updated_ms, prices):
+        ranked_values = {
+            str(i+1): val for i, val in enumerate(prices)
+        }
+
+        if self.deadband and not self.deadband.should_write(
+            "modbus", ranked_values
+        ):
+            SAMPLES.labels("suppressed").inc()
+            self.summary.add("suppressed")
+        else:
+            self.enqueue({
+                "value": ranked_values,
+                "timestamp": updated_ms // 1000,
+                "sequence": sequence,
+            })
+
+    def enqueue(self, sample):
+        while True:
+            try:
+                self.samples.put_nowait(sample)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.samples.get_nowait()
+                SAMPLES.labels("dropped").inc()
+                self.summary.add("dropped")
+            except queue.Empty:
+                pass
+
+    def write_samples(self):
+        """Insert the queued samples until stopped and the queue is empty."""
+        while not (self.stopped.is_set() and self.samples.empty()):
+            try:
+                batch = [self.samples.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.samples.get_nowait())
+                except queue.Empty:
+                    break
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        """
+        Insert a batch, retrying the samples not written with backoff at
+        most write_retries times or until the client is stopped.
+
+        The first insert sets the _id of the samples, samples written by
+        a failed attempt are thus duplicates on the next and count as
+        written.
+        """
+        samples = batch
+        delay = self.reconnect_delay
+        for attempt in range(self.write_retries + 1):
+            try:
+                with WRITE_SECONDS.time():
+                    self.collection.insert_many(batch, ordered=False)
+                batch = []
+                break
+            except BulkWriteError as e:
+                failed = sorted(
+                    error["index"] for error in e.details["writeErrors"]
+                    if error["code"] != DUPLICATE_KEY_ERROR)
+                batch = [batch[index] for index in failed]
+                if not batch:
+                    break
+                logging.error(
+                    "Failed to insert %s samples with error: %s",
+                    len(batch), e.details["writeErrors"][0]["errmsg"])
+            except PyMongoError as e:
+                logging.error("Failed to insert samples with error: %s", e)
+            if attempt == self.write_retries or self.stopped.wait(delay):
+                break
+            delay = min(delay * 2, self.reconnect_delay_max)
+        BATCH_SIZE.observe(len(samples))
+        SAMPLES.labels("persisted").inc(len(samples) - len(batch))
+        self.summary.add("persisted", len(samples) - len(batch))
+        if batch:
+            SAMPLES.labels("failed").inc(len(batch))
+            self.summary.add("failed", len(batch))
+        if self.deadband:
+            failed = {id(sample) for sample in batch}
+            for sample in samples:
+                if id(sample) not in failed:
+                    self.deadband.commit("modbus", sample["value"])
 
     def run(self):
+        scheduler = DeadlineScheduler(
+            self.interval, policy=self.overrun_policy)
+        writer = threading.Thread(target=self.write_samples)
+        writer.start()
         try:
             while True:
-
-                response = self.modbus_client.read_holding_registers(
-                    0, 20, unit=1)
-                if not response.isError():
-                    decoded_values = []
-                    for i in range(0, len(response.registers), 2):
-                        builder = BinaryPayloadDecoder.fromRegisters(
-                            [response.registers[i], response.registers[i + 1]],
-                            byteorder=Endian.LITTLE,
-                        )
-
-                        decoded_values.append(builder.decode_32bit_float())
-
-                    ranked_values = {
-                        str(i+1): val for i, val in enumerate(decoded_values)
-                    }
-
-                    self.collection.insert_one(
-                        {"value": ranked_values,
-                            "timestamp": int(time.time())}
-                    )
-                    logging.info("Values persisted to database")
-                else:
-                    logging.error(f"Modbus error: {response}")
-                time.sleep(int(self.interval))
+                self.poll()
+                scheduler.wait()
         except Exception as e:
-            logging.error(f"Client error: {e}")
+            logging.error("Client error: %s", e)
         finally:
+            self.stopped.set()
+            writer.join()
+            self.summary.flush()
             logging.info("Stoping client")
             if self.modbus_client:
                 self.modbus_client.close()
@@ -111,9 +524,7 @@ class ModbusPersistenceClient:
 
 if __name__ == "__main__":
 
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-    )
+    setup_logging()
 
     parser = argparse.ArgumentParser(
         description="Modbus client for data persistence")
@@ -131,11 +542,98 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--interval",
-        type=int,
+        type=float,
         default=60,
         help="Interval in seconds to read and persist data, default is 60",
     )
+    parser.add_argument(
+        "--overrun",
+        type=str,
+        choices=OVERRUN_POLICIES,
+        default=SKIP,
+        help="How to handle missed polling deadlines, default is skip",
+    )
+    parser.add_argument(
+        "--change_only",
+        action="store_true",
+        help="Persist only samples that changed beyond the deadband",
+    )
+    parser.add_argument(
+        "--deadband_abs",
+        type=float,
+        default=0.0,
+        help="Absolute deadband per register value, default is 0",
+    )
+    parser.add_argument(
+        "--deadband_pct",
+        type=float,
+        default=0.0,
+        help="Deadband in percent of the last written value, default is 0",
+    )
+    parser.add_argument(
+        "--max_silent_interval",
+        type=int,
+        default=600,
+        help="Maximum seconds between two writes with --change_only, "
+        "default is 600",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=100,
+        help="Maximum samples per MongoDB insert, default is 100",
+    )
+    parser.add_argument(
+        "--queue_size",
+        type=int,
+        default=10000,
+        help="Maximum samples waiting for their insert, default is 10000",
+    )
+    parser.add_argument(
+        "--write_retries",
+        type=int,
+        default=5,
+        help="Maximum retries of a failed MongoDB insert, default is 5",
+    )
+    parser.add_argument(
+        "--reconnect_delay",
+        type=float,
+        default=1.0,
+        help="Seconds before retrying a failed reconnect, doubled after "
+        "every failure, default is 1",
+    )
+    parser.add_argument(
+        "--reconnect_delay_max",
+        type=float,
+        default=60.0,
+        help="Maximum seconds between two reconnect attempts, "
+        "default is 60",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Port serving Prometheus metrics, default is none",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="File the Prometheus metrics are written to every 15s, "
+        "default is none",
+    )
     args = parser.parse_args()
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    metrics.start_exporter(args.metrics_port, args.metrics_file)
+
+    deadband = None
+    if args.change_only:
+        deadband = DeadbandFilter(
+            absolute=args.deadband_abs,
+            percent=args.deadband_pct,
+            max_silent_interval=args.max_silent_interval,
+        )
 
     try:
         mb_persistence_client = ModbusPersistenceClient(
@@ -145,6 +643,13 @@ if __name__ == "__main__":
             mongo_db=os.getenv("MONGO_DB"),
             mongo_collection=os.getenv("MODBUS_MONGO_COLLECTION"),
             interval=args.interval,
+            overrun_policy=args.overrun,
+            deadband=deadband,
+            reconnect_delay=args.reconnect_delay,
+            reconnect_delay_max=args.reconnect_delay_max,
+            batch_size=args.batch_size,
+            max_queued=args.queue_size,
+            write_retries=args.write_retries,
         )
         mb_persistence_client.run()
     except KeyboardInterrupt:
@@ -1,5 +1,6 @@
 import os
 import ssl
+import math
 import time
 import logging
 import argparse
@@ -8,62 +9,160 @@ import requests
 import threading
 
 from pymodbus.server import StartTlsServer
-from pymodbus.payload import BinaryPayloadBuilder, Endian
 from pymodbus.datastore import (
     ModbusSequentialDataBlock,
     ModbusServerContext,
     ModbusSlaveContext,
 )
 from dotenv import load_dotenv
+from scheduler import DeadlineScheduler, OVERRUN_POLICIES, SKIP
+from coincap_fetcher import get_fetcher
+from service_logging import PeriodicSummary, setup_logging
+from register_snapshot import RegisterSnapshot
+import modbus_registers
+import metrics
 
 load_dotenv()
 
+UPDATES = metrics.counter(
+    "modbus_server_register_updates_total",
+    "Updates of the register values")
+LAST_UPDATE = metrics.gauge(
+    "modbus_server_last_update_timestamp_seconds",
+    "UNIX time of the last update of the register values")
+SNAPSHOT_SECONDS = metrics.histogram(
+    "modbus_server_snapshot_seconds",
+    "Time to save the registers to the snapshot file")
 
-def setup_server_context():
-    initial_values = [0]
+
+def setup_server_context(history=60):
+    # Addresses of the slave context start at 1, block index 0 is unused
+    initial_values = [0] * (modbus_registers.HOLDING_COUNT + 1)
     datablock = ModbusSequentialDataBlock(0, initial_values)
+    history_block = ModbusSequentialDataBlock(
+        0, [0] * (modbus_registers.history_size(history) + 1))
 
     slave_context = ModbusSlaveContext(
-        di=datablock, co=datablock, hr=datablock, ir=datablock
+        di=datablock, co=datablock, hr=datablock, ir=history_block
     )
+    slave_context.setValues(
+        4, modbus_registers.HISTORY_ADDRESS,
+        modbus_registers.encode_history_header(0, history, 0))
     return ModbusServerContext(slaves=slave_context, single=True)
 
 
-def update_registers(context, interval):
-    while True:
-        address = 0
-        price = fetch_data()  # list of tuples (rank, priceUsd)
+def restore_registers(context, snapshot):
+    """
+    Write the registers saved in a snapshot to the server context.
+
+    Args:
+        context (ModbusServerContext): The context to restore.
+        snapshot (RegisterSnapshot): The snapshot to restore from.
+
+    Returns:
+        bool: Whether the registers were restored.
+    """
+    saved = snapshot.load()
+    if saved is None:
+        logging.info("No register snapshot to restore in %s", snapshot.path)
+        return False
+    saved_ms, holding_values, input_values = saved
+    context[0].setValues(3, 0, holding_values)
+    if input_values is not None:
+        context[0].setValues(4, 0, input_values)
+    else:
+        logging.warning("History size changed, history not restored")
+    logging.info(
+        "Restored registers saved %.0fs ago from %s",
+        time.time() - saved_ms / 1000, snapshot.path)
+    return True
 
-        builder = BinaryPayloadBuilder(byteorder=Endian.LITTLE)
-        for coin in price:
-            builder.add_32bit_float(float(coin[1]))
 
-            payload = builder.to_registers()
-            context[0].setValues(3, address, payload)
-            address + 1
-        logging.info("Updated register values")
+def save_registers(context, snapshot, sync=False):
+    holding, inputs = snapshot.counts
+    with SNAPSHOT_SECONDS.time():
+        snapshot.save(
+            context[0].getValues(3, 0, holding),
+            context[0].getValues(4, 0, inputs),
+            sync=sync,
+        )
+
+
+def update_registers(
+    context, interval, overrun_policy=SKIP, snapshot=None,
+    snapshot_interval=10.0, stopped=None,
+):
+    stopped = stopped or threading.Event()
+    scheduler = DeadlineScheduler(
+        interval, policy=overrun_policy, sleep=stopped.wait)
+    saved = None
+    summary = PeriodicSummary()
+    # Continue the sequence of the registers, clients only compare it
+    sequence, _ = modbus_registers.decode_status(context[0].getValues(
+        3, modbus_registers.STATUS_ADDRESS, modbus_registers.STATUS_COUNT))
+    _, slots, _ = modbus_registers.decode_history_header(context[0].getValues(
+        4, modbus_registers.HISTORY_ADDRESS,
+        modbus_registers.HISTORY_HEADER_COUNT))
+    if snapshot and sequence:
+        # Updates made after the last save were lost with their sequence
+        # numbers, which clients may have seen. Skip past all of them.
+        lost = math.ceil(snapshot_interval / interval) + 1
+        sequence = (sequence + lost - 1) % 0xFFFFFFFF + 1
+    while not stopped.is_set():
+        price = fetch_data()  # list of tuples (rank, priceUsd)
+        if price is None:
+            scheduler.wait()
+            continue
 
-        time.sleep(interval)
+        prices = [coin[1] for coin in price]
+        context[0].setValues(
+            3, modbus_registers.PRICE_ADDRESS,
+            modbus_registers.encode_prices(prices))
+        # Skip 0, it means no update yet
+        sequence = sequence % 0xFFFFFFFF + 1
+        updated_ms = int(time.time() * 1000)
+        context[0].setValues(
+            3, modbus_registers.STATUS_ADDRESS,
+            modbus_registers.encode_status(sequence, updated_ms))
+        head = (sequence - 1) % slots
+        context[0].setValues(
+            4, modbus_registers.history_address(head),
+            modbus_registers.encode_history_entry(
+                sequence, updated_ms, prices))
+        context[0].setValues(
+            4, modbus_registers.HISTORY_ADDRESS,
+            modbus_registers.encode_history_header(head, slots, sequence))
+        UPDATES.inc()
+        LAST_UPDATE.set(time.time())
+        summary.add("register updates")
+        # Updates and saves share the thread, saved registers are
+        # consistent
+        if snapshot and (
+            saved is None or time.monotonic() - saved >= snapshot_interval
+        ):
+            save_registers(context, snapshot)
+            saved = time.monotonic()
+
+        scheduler.wait()
+    if snapshot and saved is not None:
+        save_registers(context, snapshot, sync=True)
 
 
 def fetch_data() -> (int, float):
     try:
-        response = requests.get(os.getenv("COINCAP_API_URL"))
-        data = response.json()
+        data = get_fetcher(os.getenv("COINCAP_API_URL")).get()
 
         prices = [(coin["rank"], coin["priceUsd"]) for coin in data["data"]]
 
         return prices
-    except requests.RequestException as e:
-        logging.error(f"Failed to fetch data with error: {e}")
+    except (requests.RequestException, ValueError) as e:
+        logging.error("Failed to fetch data with error: %s", e)
         return None
 
 
 if __name__ == "__main__":
 
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-    )
+    setup_logging()
 
     parser = argparse.ArgumentParser(
         description="Modbus server for storing Bitcoin price to registers"
@@ -82,22 +181,78 @@ if __name__ == "__main__":
     )
     parser.add_argument(
         "--interval",
-        type=int,
+        type=float,
         default=60,
         help="Interval in seconds to update register values, default is 60",
     )
+    parser.add_argument(
+        "--history",
+        type=int,
+        default=60,
+        help="Number of updates kept in the input registers, default is 60",
+    )
+    parser.add_argument(
+        "--snapshot_path",
+        type=str,
+        default="modbus-registers.snapshot",
+        help="File the registers are saved to and restored from at start, "
+        "default is modbus-registers.snapshot",
+    )
+    parser.add_argument(
+        "--snapshot_interval",
+        type=float,
+        default=10,
+        help="Minimum seconds between two saves of the registers, "
+        "default is 10",
+    )
+    parser.add_argument(
+        "--overrun",
+        type=str,
+        choices=OVERRUN_POLICIES,
+        default=SKIP,
+        help="How to handle missed update deadlines, default is skip",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Port serving Prometheus metrics, default is none",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="File the Prometheus metrics are written to every 15s, "
+        "default is none",
+    )
     args = parser.parse_args()
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if not 1 <= args.history <= modbus_registers.MAX_HISTORY_SLOTS:
+        parser.error(
+            "--history must be between 1 and "
+            f"{modbus_registers.MAX_HISTORY_SLOTS}")
+    metrics.start_exporter(args.metrics_port, args.metrics_file)
 
+    stopped = threading.Event()
+    snapshot = None
+    thread = None
     try:
         ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         ssl_context.load_cert_chain(
             certfile=os.getenv("MODBUS_SERVER_CERT_PATH"),
             keyfile=os.getenv("MODBUS_SERVER_KEY_PATH"),
         )
-        context = setup_server_context()
+        context = setup_server_context(args.history)
+        snapshot = RegisterSnapshot(
+            args.snapshot_path, modbus_registers.HOLDING_COUNT,
+            modbus_registers.history_size(args.history))
+        restore_registers(context, snapshot)
 
         thread = threading.Thread(
-            target=update_registers, args=(context, args.interval)
+            target=update_registers,
+            args=(context, args.interval, args.overrun, snapshot,
+                  args.snapshot_interval, stopped)
         )
         thread.start()
 
@@ -109,7 +264,12 @@ if __name__ == "__main__":
         )
 
     except ModbusException as e:
-        logging.error(f"Modbus error: {e}")
+        logging.error("Modbus error: %s", e)
     except KeyboardInterrupt:
         logging.info("Modbus server stopped by user.")
-        thread.join()
+    finally:
+        stopped.set()
+        if thread is not None:
+            thread.join()
+        if snapshot is not None:
+            snapshot.close()
@@ -0,0 +1,110 @@
+from pymodbus.payload import BinaryPayloadBuilder, BinaryPayloadDecoder, Endian
+
+# Holding registers of modbus-server.py: the price of every coin by rank
+# as a 32-bit float, and a status block holding the sequence number of
+# the last update (32-bit unsigned, 0 before the first update) followed
+# by its UNIX time in milliseconds (64-bit unsigned). The status is
+# written after the prices, a changed sequence number thus means the
+# prices of that update are in place.
+PRICE_ADDRESS = 0
+STATUS_ADDRESS = 1000
+STATUS_COUNT = 6
+HOLDING_COUNT = STATUS_ADDRESS + STATUS_COUNT
+
+# Input registers of modbus-server.py: a ring buffer of the last updates.
+# A header holds the slot of the newest entry (16-bit unsigned), the
+# number of slots (16-bit unsigned) and the sequence number of the newest
+# entry (32-bit unsigned), followed by the slots. An entry is a status,
+# laid out like the status block, and the prices of the first
+# HISTORY_COINS coins. The entry is written before the header.
+HISTORY_ADDRESS = 0
+HISTORY_HEADER_COUNT = 4
+HISTORY_COINS = 10
+HISTORY_ENTRY_COUNT = STATUS_COUNT + 2 * HISTORY_COINS
+# The most registers a single Modbus read returns
+MAX_READ_COUNT = 125
+# The most history entries whose registers fit the 16-bit address space
+MAX_HISTORY_SLOTS = (
+    0x10000 - HISTORY_ADDRESS - HISTORY_HEADER_COUNT) // HISTORY_ENTRY_COUNT
+
+
+def price_count(coins):
+    """Return the number of registers holding the prices of coins."""
+    return 2 * coins
+
+
+def encode_prices(prices):
+    builder = BinaryPayloadBuilder(byteorder=Endian.LITTLE)
+    for price in prices:
+        builder.add_32bit_float(float(price))
+    return builder.to_registers()
+
+
+def decode_prices(registers):
+    decoder = BinaryPayloadDecoder.fromRegisters(
+        registers, byteorder=Endian.LITTLE)
+    return [decoder.decode_32bit_float() for _ in range(len(registers) // 2)]
+
+
+def encode_status(sequence, updated_ms):
+    builder = BinaryPayloadBuilder(byteorder=Endian.LITTLE)
+    builder.add_32bit_uint(sequence & 0xFFFFFFFF)
+    builder.add_64bit_uint(updated_ms)
+    return builder.to_registers()
+
+
+def decode_status(registers):
+    """Return the (sequence number, update time in ms) of the status."""
+    decoder = BinaryPayloadDecoder.fromRegisters(
+        registers, byteorder=Endian.LITTLE)
+    return decoder.decode_32bit_uint(), decoder.decode_64bit_uint()
+
+
+def history_address(slot):
+    """Return the address of the history entry in slot."""
+    return HISTORY_ADDRESS + HISTORY_HEADER_COUNT + slot * HISTORY_ENTRY_COUNT
+
+
+def history_slot(head, newest, sequence, slots):
+    """Return the slot of the entry of sequence, given the newest slot and
+    sequence number of the history header."""
+    return (head - (newest - sequence)) % slots
+
+
+def history_size(slots):
+    """Return the number of registers of a history of slots entries."""
+    return history_address(slots) - HISTORY_ADDRESS
+
+
+def encode_history_header(head, slots, sequence):
+    builder = BinaryPayloadBuilder(byteorder=Endian.LITTLE)
+    builder.add_16bit_uint(head)
+    builder.add_16bit_uint(slots)
+    builder.add_32bit_uint(sequence & 0xFFFFFFFF)
+    return builder.to_registers()
+
+
+def decode_history_header(registers):
+    """Return the (newest slot, slots, newest sequence number)."""
+    decoder = BinaryPayloadDecoder.fromRegisters(
+        registers, byteorder=Endian.LITTLE)
+    return (decoder.decode_16bit_uint(), decoder.decode_16bit_uint(),
+            decoder.decode_32bit_uint())
+
+
+def encode_history_entry(sequence, updated_ms, prices):
+    prices = list(prices)[:HISTORY_COINS]
+    prices += [0.0] * (HISTORY_COINS - len(prices))
+    return encode_status(sequence, updated_ms) + encode_prices(prices)
+
+
+def decode_history_entries(registers):
+    """Return the (sequence number, update time in ms, prices) of the
+    consecutive entries held by registers."""
+    entries = []
+    for start in range(0, len(registers), HISTORY_ENTRY_COUNT):
+        entry = registers[start:start + HISTORY_ENTRY_COUNT]
+        sequence, updated_ms = decode_status(entry[:STATUS_COUNT])
+        entries.append(
+            (sequence, updated_ms, decode_prices(entry[STATUS_COUNT:])))
+    return entries
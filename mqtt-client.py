@@ -1,25 +1,54 @@
 import os
 import ssl
 import time
-import json
 import random
 import logging
 import argparse
 import requests
+import threading
 
 import paho.mqtt.client as mqtt
 
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from dotenv import load_dotenv
+from scheduler import DeadlineScheduler, OVERRUN_POLICIES, SKIP
+from coincap_fetcher import get_fetcher, crypto_message
+from command_dispatcher import CommandDispatcher
+from offline_buffer import OfflineBuffer
+from service_logging import PeriodicSummary, setup_logging
+import payload_codec
+import metrics
 
 load_dotenv()
 
+PUBLISHED = metrics.counter(
+    "mqtt_client_messages_published_total",
+    "Messages published to the broker")
+PUBLISHED_BYTES = metrics.counter(
+    "mqtt_client_published_bytes_total", "Payload bytes published")
+PUBLISH_FAILURES = metrics.counter(
+    "mqtt_client_publish_failures_total",
+    "Messages the client failed to publish")
+BUFFERED = metrics.counter(
+    "mqtt_client_messages_buffered_total",
+    "Messages stored in the offline buffer")
+DRAINED = metrics.counter(
+    "mqtt_client_messages_drained_total",
+    "Buffered messages acknowledged by the broker")
+BUFFER_DEPTH = metrics.gauge(
+    "mqtt_client_offline_buffer_messages",
+    "Messages waiting in the offline buffer")
+
 
 class MQTTCryptoClient:
     """
     A class representing an MQTT client for publishing crypto data.
 
     This client fetches crypto data from CoinCap API and publishes
-    it to an MQTT broker at a specified interval.
+    it to an MQTT broker at a specified interval. It accepts the commands
+    client_stop, publish_start, publish_stop, set_interval <seconds> and
+    set_limit <coins> on its command topic.
 
     Args:
         broker (str): The MQTT broker address.
@@ -29,19 +58,47 @@ class MQTTCryptoClient:
         data_topic (str): The MQTT topic for publishing data.
         command_topic (str): The MQTT topic for receiving commands.
         interval (int): The interval (in seconds) between data publishing.
+        overrun_policy (str): What to do with missed publish deadlines,
+        "skip" or "catch_up".
+        payload_format (str): The payload encoding, "json" or "compact".
+        The compact format is published over MQTT v5 with its content
+        type set.
+        limit (int): The number of coins fetched and published.
+        keyframe_interval (int): The number of compact messages between
+        two full keyframes, the messages in between are deltas.
+        compression (str): Compression of large compact messages, None,
+        "zlib" or "zstd".
+        offline_buffer (OfflineBuffer): An optional disk buffer keeping the
+        messages produced while the broker is unreachable.
+        drain_rate (float): The maximum number of buffered messages sent
+        per second once the broker is reachable again.
+        drain_batch (int): The number of buffered messages sent per batch,
+        and so the most buffered messages in flight.
     """
 
     def __init__(
         self, broker, port, username, password,
-        data_topic, command_topic, interval
+        data_topic, command_topic, interval, overrun_policy=SKIP,
+        payload_format=payload_codec.JSON, limit=10,
+        keyframe_interval=1, compression=None, offline_buffer=None,
+        drain_rate=50, drain_batch=100
     ):
         self.broker = broker
         self.port = port
         self.username = username
         self.password = password
+        self.payload_format = payload_format
+        self.limit = limit
+        self.fetcher = get_fetcher(os.getenv("COINCAP_API_URL"))
+        self.encoder = payload_codec.DeltaEncoder(
+            keyframe_interval=keyframe_interval, compression=compression)
         self.client = mqtt.Client(
             "cryptodev" + time.strftime("%H%M") +
-            str(random.randint(0, 1000)).zfill(4)
+            str(random.randint(0, 1000)).zfill(4),
+            protocol=(
+                mqtt.MQTTv5 if payload_format == payload_codec.COMPACT
+                else mqtt.MQTTv311
+            ),
         )
         self.client.tls_set(
             ca_certs=os.getenv("MQTT_CA_CERT_PATH"),
@@ -49,91 +106,227 @@ class MQTTCryptoClient:
         )
         self.client.username_pw_set(
             username=self.username, password=self.password)
+        self.buffer = offline_buffer
+        self.drain_rate = drain_rate
+        self.drain_batch = drain_batch
+        self.drain_thread = None
+        if self.buffer is not None:
+            BUFFER_DEPTH.set_function(lambda: len(self.buffer))
         self.running = True
         self.publishing = True
         self.data_topic = data_topic+"/"+self.client._client_id.decode()
-        self.command_topic = command_topic+"/"+self.client._client_id.decode()
         self.interval = interval
+        self.overrun_policy = overrun_policy
+        self.scheduler = None
+        self.summary = PeriodicSummary()
+
+        self.dispatcher = CommandDispatcher(command_topic, wildcard=False)
+        self.dispatcher.register(self.client._client_id.decode(), {
+            "client_stop": self.stop_client,
+            "publish_start": self.start_publishing,
+            "publish_stop": self.stop_publishing,
+            "set_interval": self.set_interval,
+            "set_limit": self.set_limit,
+        })
 
         self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
+        self.client.on_message = self.dispatcher.on_message
 
         logging.info(
-            "MQTT client initialized, ID: %s" % self.client._client_id.decode()
+            "MQTT client initialized, ID: %s", self.client._client_id.decode()
         )
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
-            logging.info("Connected to broker %s" % self.broker)
-            self.client.subscribe(self.command_topic)
-            logging.info("Subscribed to command topic %s" %
-                         self.command_topic)
+            logging.info("Connected to broker %s", self.broker)
+            self.dispatcher.subscribe(self.client)
         else:
-            logging.error("Failed to connect with error: %s" % rc)
+            logging.error("Failed to connect with error: %s", rc)
 
-    def on_message(self, client, userdata, msg):
+    def stop_client(self):
+        logging.info("Stopping client")
+        self.running = False
 
-        logging.info("Received command %s" % msg.payload.decode())
-        if msg.payload.decode() == "client_stop":
-            logging.info("Stopping client")
-            self.running = False
-        elif msg.payload.decode() == "publish_start":
-            logging.info("Starting publishing")
-            self.publishing = True
-        elif msg.payload.decode() == "publish_stop":
-            logging.info("Stopping publishing")
-            self.publishing = False
-        else:
-            logging.error("Invalid command %s" % msg.payload.decode())
+    def start_publishing(self):
+        logging.info("Starting publishing")
+        self.publishing = True
+
+    def stop_publishing(self):
+        logging.info("Stopping publishing")
+        self.publishing = False
+
+    def set_interval(self, interval):
+        interval = int(interval)
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.interval = interval
+        if self.scheduler:
+            self.scheduler.interval = interval
+        logging.info("Publishing interval set to %ds", interval)
+
+    def set_limit(self, limit):
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        self.limit = limit
+        logging.info("Coin limit set to %d", limit)
 
     def run(self):
-        self.client.connect(self.broker, self.port)
+        if self.buffer is not None:
+            # Start offline if needed, paho keeps retrying in the background
+            self.client.connect_async(self.broker, self.port)
+            self.drain_thread = threading.Thread(
+                target=self.drain_buffer, daemon=True)
+            self.drain_thread.start()
+        else:
+            self.client.connect(self.broker, self.port)
         self.client.loop_start()
         logging.info("Client loop started")
+        self.scheduler = DeadlineScheduler(
+            int(self.interval), policy=self.overrun_policy)
         try:
             while self.running:
                 if self.publishing:
                     self.publish_data()
-                time.sleep(int(self.interval))
+                self.scheduler.wait()
         except Exception as e:
-            logging.error("Client error: %s" % e)
+            logging.error("Client error: %s", e)
         finally:
+            self.running = False
+            # The drain thread uses the buffer until its batch is settled
+            if self.drain_thread is not None:
+                self.drain_thread.join()
             self.client.disconnect()
+            self.client.loop_stop()
+            if self.buffer is not None:
+                self.buffer.close()
+            self.summary.flush()
             logging.info("Client disconnected")
 
+    def publish_properties(self, content_type, trace=None):
+        if self.payload_format != payload_codec.COMPACT:
+            return None
+        properties = Properties(PacketTypes.PUBLISH)
+        properties.ContentType = content_type
+        if trace:
+            properties.UserProperty = payload_codec.trace_user_properties(
+                trace)
+        return properties
+
+    def send(self, topic, payload, content_type, trace, qos=0):
+        """
+        Publish a message stamped with the time it is sent.
+
+        JSON payloads get the trace in their "trace" field, compact ones
+        as user properties.
+        """
+        trace = dict(trace, published=payload_codec.now_ms())
+        if content_type == payload_codec.JSON_CONTENT_TYPE:
+            payload = payload_codec.with_trace(payload, trace)
+        return self.client.publish(
+            topic, payload, qos=qos,
+            properties=self.publish_properties(content_type, trace))
+
     def publish_data(self):
         try:
             data = self.fetch_data()
             if data:
-                self.client.publish(self.data_topic, json.dumps(data))
-                logging.info("Published data to topic %s" % self.data_topic)
+                fetched = self.fetcher.fetched_time(self.limit)
+                trace = {}
+                if fetched is not None:
+                    trace["fetched"] = int(fetched * 1000)
+                payload = None
+                if self.payload_format == payload_codec.COMPACT:
+                    try:
+                        payload = self.encoder.encode(data)
+                        content_type = payload_codec.COMPACT_CONTENT_TYPE
+                    except payload_codec.PayloadError as e:
+                        logging.warning("Publishing as JSON: %s", e)
+                if payload is None:
+                    payload, content_type = payload_codec.encode(data)
+
+                # Keep the order: while a backlog exists, new data queues
+                # behind it.
+                if self.buffer is not None and (
+                    len(self.buffer) or not self.client.is_connected()
+                ):
+                    self.buffer.push(
+                        self.data_topic, payload, content_type, trace)
+                    BUFFERED.inc()
+                    self.summary.add("buffered")
+                    return
+
+                info = self.send(
+                    self.data_topic, payload, content_type, trace)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    PUBLISH_FAILURES.inc()
+                    if self.buffer is not None:
+                        self.buffer.push(
+                            self.data_topic, payload, content_type, trace)
+                        BUFFERED.inc()
+                        self.summary.add("buffered")
+                        logging.info(
+                            "Publish failed with %s, data buffered", info.rc)
+                        return
+                else:
+                    PUBLISHED.inc()
+                    PUBLISHED_BYTES.inc(len(payload))
+                    self.summary.add("published")
         except Exception as e:
-            logging.error("Failed to publish data with error: %s" % e)
+            PUBLISH_FAILURES.inc()
+            logging.error("Failed to publish data with error: %s", e)
+
+    def drain_buffer(self):
+        """
+        Send the buffered messages in batches once the broker is reachable.
+
+        A batch is published with QoS 1 and removed from the buffer only
+        once the broker acknowledged it, so at most drain_batch buffered
+        messages are in flight. Live messages are not limited. Batches are
+        spaced to keep the send rate under drain_rate messages per second.
+        """
+        while self.running:
+            if not len(self.buffer) or not self.client.is_connected():
+                time.sleep(1)
+                continue
+
+            sent = []
+            for message_id, topic, payload, content_type, trace in (
+                self.buffer.peek(self.drain_batch)
+            ):
+                info = self.send(topic, payload, content_type, trace, qos=1)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                sent.append((message_id, info))
+            deadline = time.monotonic() + 10
+            try:
+                for _, info in sent:
+                    info.wait_for_publish(
+                        timeout=max(deadline - time.monotonic(), 0))
+            except (RuntimeError, ValueError) as e:
+                logging.error("Draining buffer failed with: %s", e)
+            acked, drained = None, 0
+            for message_id, info in sent:
+                if not info.is_published():
+                    break
+                acked, drained = message_id, drained + 1
+            if acked is not None:
+                self.buffer.ack(acked)
+                DRAINED.inc(drained)
+                self.summary.add("drained", drained)
+            time.sleep(max(len(sent), 1) / self.drain_rate)
 
     def fetch_data(self):
         try:
-            response = requests.get(os.getenv("COINCAP_API_URL") + "?limit=10")
-            data = response.json()
-            timestamp = data.get("timestamp")
-            cryptos = [
-                {
-                    "id": item["id"],
-                    "symbol": item["symbol"],
-                    "priceUsd": item["priceUsd"],
-                }
-                for item in data.get("data", [])
-            ]
-            return {"timestamp": timestamp, "crypto": cryptos}
-        except requests.RequestException as e:
-            logging.error("Failed to fetch data with error: %s" % e)
+            return crypto_message(self.fetcher.get(limit=self.limit))
+        except (requests.RequestException, ValueError) as e:
+            logging.error("Failed to fetch data with error: %s", e)
             return None
 
 
 if __name__ == "__main__":
 
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-    )
+    setup_logging()
 
     parser = argparse.ArgumentParser(description="MQTT Crypto Client")
     parser.add_argument(
@@ -166,7 +359,108 @@ if __name__ == "__main__":
         default=60,
         help="Interval in seconds to publish data, default is 60",
     )
+    parser.add_argument(
+        "--overrun",
+        type=str,
+        choices=OVERRUN_POLICIES,
+        default=SKIP,
+        help="How to handle missed publish deadlines, default is skip",
+    )
+    parser.add_argument(
+        "--payload_format",
+        type=str,
+        choices=payload_codec.PAYLOAD_FORMATS,
+        default=payload_codec.JSON,
+        help="Encoding of published data, compact uses MQTT v5, "
+        "default is json",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=10,
+        help="Number of coins to publish, default is 10",
+    )
+    parser.add_argument(
+        "--keyframe_interval",
+        type=int,
+        default=1,
+        help="Messages between two full keyframes of the compact format, "
+        "the ones in between only carry changed prices, default is 1",
+    )
+    parser.add_argument(
+        "--compression",
+        type=str,
+        choices=payload_codec.COMPRESSIONS,
+        default=None,
+        help="Compression of large compact messages, default is none",
+    )
+    parser.add_argument(
+        "--buffer_path",
+        type=str,
+        default=None,
+        help="SQLite file buffering data while the broker is unreachable, "
+        "default is no buffering",
+    )
+    parser.add_argument(
+        "--buffer_max_messages",
+        type=int,
+        default=100000,
+        help="Maximum number of buffered messages, default is 100000",
+    )
+    parser.add_argument(
+        "--buffer_max_mb",
+        type=int,
+        default=64,
+        help="Maximum size of buffered payloads in MB, default is 64",
+    )
+    parser.add_argument(
+        "--drain_rate",
+        type=float,
+        default=50,
+        help="Buffered messages sent per second after an outage, "
+        "default is 50",
+    )
+    parser.add_argument(
+        "--drain_batch",
+        type=int,
+        default=100,
+        help="Buffered messages in flight while draining, default is 100",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Port serving Prometheus metrics, default is none",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="File the Prometheus metrics are written to every 15s, "
+        "default is none",
+    )
     args = parser.parse_args()
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if args.drain_rate <= 0 or args.drain_batch <= 0:
+        parser.error("--drain_rate and --drain_batch must be positive")
+    if args.payload_format != payload_codec.COMPACT and (
+        args.keyframe_interval != 1 or args.compression
+    ):
+        parser.error(
+            "--keyframe_interval and --compression need "
+            "--payload_format compact"
+        )
+
+    metrics.start_exporter(args.metrics_port, args.metrics_file)
+
+    offline_buffer = None
+    if args.buffer_path:
+        offline_buffer = OfflineBuffer(
+            args.buffer_path,
+            max_messages=args.buffer_max_messages,
+            max_bytes=args.buffer_max_mb * 1024 ** 2,
+        )
 
     try:
         client = MQTTCryptoClient(
@@ -177,6 +471,14 @@ if __name__ == "__main__":
             args.topic,
             args.command,
             args.interval,
+            overrun_policy=args.overrun,
+            payload_format=args.payload_format,
+            limit=args.limit,
+            keyframe_interval=args.keyframe_interval,
+            compression=args.compression,
+            offline_buffer=offline_buffer,
+            drain_rate=args.drain_rate,
+            drain_batch=args.drain_batch,
         )
         client.run()
     except KeyboardInterrupt:
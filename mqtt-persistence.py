@@ -1,17 +1,59 @@
 import os
-import json
+import time
 import logging
 import argparse
 import ssl
+import threading
 
 import paho.mqtt.client as mqtt
 
 from functools import partial
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, PyMongoError, WriteError
 from dotenv import load_dotenv
+from deadband import DeadbandFilter
+from dead_letter import DeadLetterLog, sample_id
+from service_logging import PeriodicSummary, setup_logging
+import payload_codec
+import metrics
 
 load_dotenv()
 
+RECEIVED = metrics.counter(
+    "bridge_messages_received_total", "MQTT messages received")
+SUPPRESSED = metrics.counter(
+    "bridge_messages_suppressed_total",
+    "Messages dropped as deltas without keyframe or within the deadband")
+DECODE_ERRORS = metrics.counter(
+    "bridge_decode_errors_total", "Messages that could not be decoded")
+BATCH_SIZE = metrics.histogram(
+    "bridge_batch_documents", "Documents per bulk insert",
+    buckets=metrics.SIZE_BUCKETS)
+WRITE_SECONDS = metrics.histogram(
+    "bridge_mongo_write_seconds", "Latency of MongoDB bulk writes")
+DOCUMENTS = metrics.counter(
+    "bridge_documents_total",
+    "Written documents by result: inserted, duplicate or failed",
+    ("result",))
+DEAD_LETTERS = metrics.counter(
+    "bridge_dead_letters_total", "Messages appended to the dead letters")
+PENDING = metrics.gauge(
+    "bridge_pending_documents", "Documents waiting for their bulk insert")
+
+DUPLICATE_KEY_ERROR = 11000
+
+EMBEDDED = "embedded"
+EXPLODED = "exploded"
+BOTH = "both"
+LAYOUTS = (EMBEDDED, EXPLODED, BOTH)
+
+
+def price_value(price):
+    try:
+        return float(price)
+    except (TypeError, ValueError):
+        return None
+
 
 class MQTTMongoBridge:
     """
@@ -20,6 +62,20 @@ class MQTTMongoBridge:
     This class subscribes to an MQTT topic, receives data, and persists
     it to a MongoDB collection at a specified interval.
 
+    Documents get a deterministic _id derived from the device id and the
+    sample timestamp and are written in unordered bulk inserts that skip
+    duplicate ids, so QoS 1 redeliveries and several bridge instances
+    never store a sample twice.
+
+    Documents keep the trace timestamps of their publisher, fetched and
+    published, and get the times they were ingested and persisted, all in
+    milliseconds since the epoch.
+
+    In the exploded layout every price is also stored as its own compact
+    document {d: device_id, s: symbol, t: timestamp, p: price} in a
+    symbol collection indexed on (s, t) and (d, s, t), so the history of
+    one symbol is read without unwinding the embedded crypto arrays.
+
     Args:
         broker_host (str): The hostname of the MQTT broker.
         broker_port (int): The port number of the MQTT broker.
@@ -28,6 +84,20 @@ class MQTTMongoBridge:
         mongo_port (int): The port number of the MongoDB server.
         mongo_db (str): The name of the MongoDB database.
         mongo_collection (str): The name of the MongoDB collection.
+        deadband (DeadbandFilter): An optional filter that suppresses
+        writes of samples which did not change significantly.
+        mqtt_v5 (bool): Connect with MQTT v5 to receive the content type
+        of the messages. Payload formats are detected either way.
+        dead_letters (DeadLetterLog): An optional log keeping the messages
+        that could not be decoded or persisted, for a later replay.
+        batch_size (int): The number of documents per bulk insert.
+        flush_interval (float): The maximum number of seconds a document
+        waits for its batch to fill up.
+        layout (str): Where samples are written, "embedded" for one
+        document per message, "exploded" for one document per symbol or
+        "both".
+        symbol_collection (str): The name of the MongoDB collection of the
+        exploded layout.
     """
 
     def __init__(
@@ -38,16 +108,47 @@ class MQTTMongoBridge:
         mongo_uri,
         mongo_db,
         mongo_collection,
+        deadband=None,
+        mqtt_v5=False,
+        dead_letters=None,
+        batch_size=100,
+        flush_interval=1.0,
+        layout=EMBEDDED,
+        symbol_collection="mqtt_symbols",
     ):
         self.broker_host = broker_host
         self.broker_port = broker_port
         self.topic = topic
+        self.deadband = deadband
+        self.decoder = payload_codec.StreamDecoder()
+        self.dead_letters = dead_letters
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        PENDING.set_function(lambda: len(self.pending))
+        self.stopped = threading.Event()
+        self.summary = PeriodicSummary()
 
         self.mongo_client = MongoClient(mongo_uri)
         self.db = self.mongo_client[mongo_db]
         self.collection = self.db[mongo_collection]
+        self.layout = layout
+        if layout in (EMBEDDED, BOTH):
+            # Serves the lag queries of the REST API
+            self.collection.create_index(
+                "timestamp", name="timestamp_traced",
+                partialFilterExpression={"trace.persisted": {"$exists": True}},
+            )
+        self.symbol_collection = None
+        if layout in (EXPLODED, BOTH):
+            self.symbol_collection = self.db[symbol_collection]
+            self.symbol_collection.create_index([("s", 1), ("t", 1)])
+            self.symbol_collection.create_index(
+                [("d", 1), ("s", 1), ("t", 1)])
 
-        self.mqtt_client = mqtt.Client()
+        self.mqtt_client = mqtt.Client(
+            protocol=mqtt.MQTTv5 if mqtt_v5 else mqtt.MQTTv311)
         self.mqtt_client.tls_set(
             ca_certs=os.getenv("MQTT_CA_CERT_PATH"),
             tls_version=ssl.PROTOCOL_TLS,
@@ -60,28 +161,284 @@ class MQTTMongoBridge:
         self.mqtt_client.on_connect = partial(self.on_connect)
         self.mqtt_client.on_message = partial(self.on_message)
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
-            logging.info(f"Connected to broker {self.broker_host}")
+            logging.info("Connected to broker %s", self.broker_host)
             self.mqtt_client.subscribe(self.topic + "/+")
-            logging.info(f"Subscribed to topic {self.topic}")
+            logging.info("Subscribed to topic %s", self.topic)
         else:
-            logging.error(f"Failed to connect to broker, return code {rc}")
+            logging.error("Failed to connect to broker, return code %s", rc)
 
     def on_message(self, client, userdata, msg):
+        RECEIVED.inc()
+        self.summary.add("received")
+        ingested = payload_codec.now_ms()
+        data = None
+        content_type = payload_codec.message_content_type(msg)
         try:
-            data = json.loads(msg.payload.decode())
-            data["device_id"] = msg.topic.split("/")[-1]
-            self.collection.insert_one(data)
-            logging.info(
-                f"Received data from {data['device_id']}, inserting to MongoDB"
-            )
+            device_id = msg.topic.split("/")[-1]
+            data = self.decoder.decode(
+                device_id, msg.payload, content_type)
+            if data is None:
+                SUPPRESSED.inc()
+                self.summary.add("deltas dropped")
+                logging.info(
+                    "Waiting for a keyframe from %s, delta dropped",
+                    device_id)
+                return
+            data["device_id"] = device_id
+            trace = data.get("trace")
+            data["trace"] = dict(
+                trace if isinstance(trace, dict) else {},
+                **payload_codec.message_trace(msg), ingested=ingested)
+            if self.deadband and not self.deadband.should_write(
+                data["device_id"], self.sample_values(data)
+            ):
+                SUPPRESSED.inc()
+                self.summary.add("suppressed")
+                return
+            data["_id"] = sample_id(
+                device_id, data.get("timestamp"), msg.payload)
         except Exception as e:
-            logging.error(f"Failed to insert data with error: {e}")
+            DECODE_ERRORS.inc()
+            logging.error("Failed to decode data with error: %s", e)
+            self.dead_letter(msg.topic, msg.payload, content_type, e, data)
+            return
+
+        with self.pending_lock:
+            self.pending.append((msg.topic, msg.payload, content_type, data))
+            if len(self.pending) < self.batch_size:
+                return
+            batch, self.pending = self.pending, []
+        self.flush(batch)
+
+    def dead_letter(self, topic, payload, content_type, error, document):
+        if self.dead_letters is None:
+            return
+        DEAD_LETTERS.inc()
+        key = None
+        if document is not None:
+            key = document.get("_id")
+            document = {
+                field: value for field, value in document.items()
+                if field != "_id"
+            }
+        self.dead_letters.append(
+            topic, payload, content_type, error, document, key)
+
+    def insert_documents(self, documents, collection=None):
+        """
+        Insert documents in one unordered bulk write.
+
+        Documents whose _id is already stored are skipped, so a message
+        delivered twice is stored once. The collection defaults to the
+        embedded layout collection.
+
+        Returns:
+            tuple: The number of inserted documents, the number of
+            duplicates and a list of (index, error message) of the
+            documents that failed otherwise.
+
+        Raises:
+            PyMongoError: If the bulk write failed as a whole.
+        """
+        BATCH_SIZE.observe(len(documents))
+        try:
+            collection = self.collection if collection is None else collection
+            with WRITE_SECONDS.time():
+                result = collection.insert_many(documents, ordered=False)
+            DOCUMENTS.labels("inserted").inc(len(result.inserted_ids))
+            return len(result.inserted_ids), 0, []
+        except BulkWriteError as e:
+            duplicates, failures = 0, []
+            for error in e.details["writeErrors"]:
+                if error["code"] == DUPLICATE_KEY_ERROR:
+                    duplicates += 1
+                else:
+                    failures.append((error["index"], error["errmsg"]))
+            DOCUMENTS.labels("inserted").inc(e.details["nInserted"])
+            DOCUMENTS.labels("duplicate").inc(duplicates)
+            DOCUMENTS.labels("failed").inc(len(failures))
+            return e.details["nInserted"], duplicates, failures
+
+    @staticmethod
+    def exploded_documents(document):
+        # Symbols are not unique across assets, the CoinCap id is
+        return [
+            {
+                "_id": f"{document['_id']}:{item['id']}",
+                "d": document["device_id"],
+                "s": item["symbol"],
+                "t": document.get("timestamp"),
+                "p": price_value(item["priceUsd"]),
+            }
+            for item in document.get("crypto", [])
+        ]
+
+    def write_documents(self, documents):
+        """
+        Write documents in the configured layouts.
+
+        Returns:
+            tuple: The number of inserted documents, the number of
+            duplicates and a list of (index, error message) of the
+            documents that could not be written in every layout.
+        """
+        inserted = duplicates = 0
+        failures = {}
+        persisted = payload_codec.now_ms()
+        for document in documents:
+            if isinstance(document.get("trace"), dict):
+                document["trace"]["persisted"] = persisted
+        if self.layout in (EMBEDDED, BOTH):
+            inserted, duplicates, failed = self.insert_documents(documents)
+            failures.update(failed)
+        if self.layout in (EXPLODED, BOTH):
+            rows, owners = [], []
+            for index, document in enumerate(documents):
+                exploded = self.exploded_documents(document)
+                rows.extend(exploded)
+                owners.extend([index] * len(exploded))
+            if rows:
+                rows_inserted, rows_duplicates, failed = (
+                    self.insert_documents(rows, self.symbol_collection))
+                inserted += rows_inserted
+                duplicates += rows_duplicates
+                for index, message in failed:
+                    failures.setdefault(owners[index], message)
+        return inserted, duplicates, sorted(failures.items())
+
+    def flush(self, batch):
+        if not batch:
+            return
+        try:
+            inserted, duplicates, failures = self.write_documents(
+                [document for *_, document in batch])
+        except PyMongoError as e:
+            DOCUMENTS.labels("failed").inc(len(batch))
+            logging.error("Failed to insert data with error: %s", e)
+            for topic, payload, content_type, document in batch:
+                self.dead_letter(topic, payload, content_type, e, document)
+            return
+        for index, message in failures:
+            logging.error("Failed to insert data with error: %s", message)
+            topic, payload, content_type, document = batch[index]
+            self.dead_letter(
+                topic, payload, content_type, WriteError(message), document)
+        if self.deadband:
+            failed = {index for index, _ in failures}
+            for index, (*_, document) in enumerate(batch):
+                if index not in failed:
+                    self.deadband.commit(
+                        document["device_id"], self.sample_values(document))
+        self.summary.add("inserted", inserted)
+        self.summary.add("duplicates", duplicates)
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            with self.pending_lock:
+                batch, self.pending = self.pending, []
+            self.flush(batch)
+
+    @staticmethod
+    def sample_values(data):
+        values = {}
+        for item in data.get("crypto", []):
+            try:
+                values[item["id"]] = float(item["priceUsd"])
+            except (TypeError, ValueError):
+                values[item["id"]] = item["priceUsd"]
+        return values
+
+    def replay_dead_letters(self, rate=100, batch_size=100):
+        """
+        Re-ingest the dead-lettered messages.
+
+        Records are inserted in unordered bulk writes of batch_size, at
+        most rate documents per second with the same deterministic ids as
+        live messages, so replaying twice never stores a sample twice.
+        Records failing again are appended back to the dead-letter log.
+        Delta payloads dead-lettered before they were decoded cannot be
+        rebuilt without their stream, they are skipped and kept in the log.
+        """
+        path = self.dead_letters.take()
+        if path is None:
+            logging.info("No dead letters to replay")
+            return
+        records = self.dead_letters.read(path)
+        inserted = duplicates = failed = skipped = 0
+        while True:
+            batch = [record for _, record in zip(range(batch_size), records)]
+            if not batch:
+                break
+            started = time.monotonic()
+
+            documents, keep, deltas = [], [], []
+            for record in batch:
+                if record["document"] is None and payload_codec.is_delta(
+                    record["payload"], record["content_type"]
+                ):
+                    deltas.append(record)
+                    continue
+                try:
+                    document = record["document"] or payload_codec.decode(
+                        record["payload"], record["content_type"])
+                except Exception as e:
+                    record["error"] = type(e).__name__
+                    record["detail"] = str(e)
+                    keep.append(record)
+                    continue
+                document["device_id"] = record["topic"].split("/")[-1]
+                document["_id"] = sample_id(
+                    document["device_id"], document.get("timestamp"),
+                    record["payload"]
+                )
+                documents.append((record, document))
+
+            if documents:
+                try:
+                    batch_inserted, batch_duplicates, failures = (
+                        self.write_documents(
+                            [document for _, document in documents])
+                    )
+                except PyMongoError as e:
+                    logging.error("Replay stopped, MongoDB error: %s", e)
+                    self.dead_letters.write(
+                        keep + deltas + [record for record, _ in documents]
+                        + list(records)
+                    )
+                    os.remove(path)
+                    return
+                inserted += batch_inserted
+                duplicates += batch_duplicates
+                for index, message in failures:
+                    record = documents[index][0]
+                    record["error"] = "WriteError"
+                    record["detail"] = message
+                    keep.append(record)
+
+            failed += len(keep)
+            skipped += len(deltas)
+            if keep or deltas:
+                self.dead_letters.write(keep + deltas)
+            logging.info(
+                "Replayed %d dead letters, %d duplicates, %d failed again, "
+                "%d undecoded deltas skipped",
+                inserted, duplicates, failed, skipped)
+            time.sleep(max(
+                0, len(batch) / rate - (time.monotonic() - started)))
+        os.remove(path)
+        if skipped:
+            logging.warning(
+                "%d delta payload(s) were dead-lettered before they could "
+                "be decoded and cannot be replayed, they stay in %s",
+                skipped, self.dead_letters.path)
 
     def run(self):
         self.mqtt_client.connect(self.broker_host, self.broker_port)
         logging.info("Starting MQTT client")
+        flusher = threading.Thread(target=self.flush_periodically)
+        flusher.start()
         try:
             self.mqtt_client.loop_forever(
                 timeout=10, max_packets=1, retry_first_connection=True
@@ -90,13 +447,17 @@ class MQTTMongoBridge:
             logging.info("Service interrupted by keyboard")
         finally:
             self.mqtt_client.disconnect()
+            self.stopped.set()
+            flusher.join()
+            with self.pending_lock:
+                batch, self.pending = self.pending, []
+            self.flush(batch)
+            self.summary.flush()
             self.mongo_client.close()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
-    )
+    setup_logging()
 
     parser = argparse.ArgumentParser(
         description="Service for persisting MQTT data to MongoDB"
@@ -119,7 +480,97 @@ if __name__ == "__main__":
         default="crypto/data",
         help="The MQTT topic to subscribe to",
     )
+    parser.add_argument(
+        "--mqtt_v5",
+        action="store_true",
+        help="Connect with MQTT v5 to read the payload content type",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=100,
+        help="Documents per bulk insert, default is 100",
+    )
+    parser.add_argument(
+        "--flush_interval",
+        type=float,
+        default=1.0,
+        help="Maximum seconds before a partial batch is inserted, "
+        "default is 1",
+    )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        choices=LAYOUTS,
+        default=EMBEDDED,
+        help="Store one document per message (embedded), one per symbol "
+        "(exploded) or both, default is embedded",
+    )
+    parser.add_argument(
+        "--dead_letter_path",
+        type=str,
+        default="mqtt-dead-letters.ndjson",
+        help="File keeping messages that failed to persist, "
+        "default is mqtt-dead-letters.ndjson",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="Re-ingest the dead-lettered messages and exit",
+    )
+    parser.add_argument(
+        "--replay_rate",
+        type=float,
+        default=100,
+        help="Documents per second inserted by --replay, default is 100",
+    )
+    parser.add_argument(
+        "--change_only",
+        action="store_true",
+        help="Persist only samples that changed beyond the deadband",
+    )
+    parser.add_argument(
+        "--deadband_abs",
+        type=float,
+        default=0.0,
+        help="Absolute deadband per price, default is 0",
+    )
+    parser.add_argument(
+        "--deadband_pct",
+        type=float,
+        default=0.0,
+        help="Deadband in percent of the last written price, default is 0",
+    )
+    parser.add_argument(
+        "--max_silent_interval",
+        type=int,
+        default=600,
+        help="Maximum seconds between two writes per device with "
+        "--change_only, default is 600",
+    )
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        default=None,
+        help="Port serving Prometheus metrics, default is none",
+    )
+    parser.add_argument(
+        "--metrics_file",
+        type=str,
+        default=None,
+        help="File the Prometheus metrics are written to every 15s, "
+        "default is none",
+    )
     args = parser.parse_args()
+    metrics.start_exporter(args.metrics_port, args.metrics_file)
+
+    deadband = None
+    if args.change_only:
+        deadband = DeadbandFilter(
+            absolute=args.deadband_abs,
+            percent=args.deadband_pct,
+            max_silent_interval=args.max_silent_interval,
+        )
 
     try:
         bridge = MQTTMongoBridge(
@@ -129,7 +580,19 @@ if __name__ == "__main__":
             mongo_uri=os.getenv("MONGO_URI"),
             mongo_db=os.getenv("MONGO_DB"),
             mongo_collection=os.getenv("MQTT_MONGO_COLLECTION"),
+            deadband=deadband,
+            mqtt_v5=args.mqtt_v5,
+            dead_letters=DeadLetterLog(args.dead_letter_path),
+            batch_size=args.batch_size,
+            flush_interval=args.flush_interval,
+            layout=args.layout,
+            symbol_collection=(
+                os.getenv("MQTT_SYMBOL_MONGO_COLLECTION") or "mqtt_symbols"),
         )
-        bridge.run()
+        if args.replay:
+            bridge.replay_dead_letters(rate=args.replay_rate)
+            bridge.mongo_client.close()
+        else:
+            bridge.run()
     except KeyboardInterrupt:
         logging.info("Service interrupted by keyboard")
@@ -0,0 +1,456 @@
+import os
+import ssl
+import time
+import heapq
+import random
+import logging
+import argparse
+import threading
+
+import requests
+import paho.mqtt.client as mqtt
+
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from dotenv import load_dotenv
+from functools import partial
+from coincap_fetcher import get_fetcher, crypto_message
+from command_dispatcher import CommandDispatcher
+from service_logging import setup_logging
+import payload_codec
+
+load_dotenv()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class DeviceSimulator:
+    """
+    A class representing a fleet of simulated crypto devices.
+
+    Thousands of virtual devices are multiplexed over a few MQTT
+    connections, each device publishing to its own data topic like an
+    MQTTCryptoClient would. Publishes are driven by a single timer heap,
+    the upstream data is fetched once per interval and fanned out to
+    every device. Publish rate and acknowledgement latency are reported
+    periodically. Publishes not acknowledged within ack_timeout seconds
+    are dropped from the in-flight table and counted as failed. Devices
+    accept the same commands as MQTTCryptoClient, received through one
+    wildcard subscription.
+
+    Args:
+        broker (str): The MQTT broker address.
+        port (int): The MQTT broker port.
+        username (str): The username for authentication.
+        password (str): The password for authentication.
+        data_topic (str): The MQTT topic prefix for publishing data.
+        devices (int): The number of virtual devices.
+        connections (int): The number of MQTT connections to share.
+        interval (float): The interval in seconds between two publishes
+        of a device.
+        jitter (float): The maximum random offset in seconds added to
+        every publish.
+        rate (float): The maximum total number of publishes per second,
+        None for no limit.
+        limits (list): The coin counts of the payload size distribution.
+        weights (list): The relative weights of the coin counts.
+        payload_format (str): The payload encoding, "json" or "compact".
+        qos (int): The QoS level of the published messages.
+        command_topic (str): The MQTT topic prefix for receiving commands.
+        ack_timeout (float): The time in seconds after which a publish
+        that was not acknowledged counts as failed.
+    """
+
+    def __init__(
+        self, broker, port, username, password, data_topic,
+        devices, connections, interval, jitter=0.0, rate=None,
+        limits=(10,), weights=None, payload_format=payload_codec.JSON,
+        qos=0, command_topic="crypto/command", ack_timeout=30.0
+    ):
+        self.broker = broker
+        self.port = port
+        self.data_topic = data_topic
+        self.devices = devices
+        self.interval = interval
+        self.jitter = jitter
+        self.rate = rate
+        self.limits = list(limits)
+        self.fetch_limit = max(self.limits)
+        self.weights = weights
+        self.payload_format = payload_format
+        self.qos = qos
+        self.ack_timeout = ack_timeout
+        self.fetcher = get_fetcher(os.getenv("COINCAP_API_URL"))
+        self.running = True
+        self.intervals = {}
+        self.device_limits = {}
+        self.paused = set()
+        self.stopped = set()
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.acked = {}
+        self.published = 0
+        self.failed = 0
+        self.expired = 0
+        self.latencies = []
+        self.lateness = []
+
+        prefix = "cryptosim" + time.strftime("%H%M") + str(
+            random.randint(0, 1000)).zfill(4)
+        self.clients = []
+        for index in range(connections):
+            client = mqtt.Client(
+                f"{prefix}-{index}",
+                protocol=(
+                    mqtt.MQTTv5 if payload_format == payload_codec.COMPACT
+                    else mqtt.MQTTv311
+                ),
+            )
+            client.tls_set(
+                ca_certs=os.getenv("MQTT_CA_CERT_PATH"),
+                tls_version=ssl.PROTOCOL_TLS,
+            )
+            client.username_pw_set(username=username, password=password)
+            client.max_inflight_messages_set(1000)
+            client.on_publish = self._on_publish(index)
+            self.clients.append(client)
+
+        self.device_ids = [
+            f"{prefix}d{index:05d}" for index in range(devices)]
+        self.dispatcher = CommandDispatcher(command_topic)
+        for device, device_id in enumerate(self.device_ids):
+            self.dispatcher.register(device_id, {
+                "client_stop": partial(self.stopped.add, device),
+                "publish_start": partial(self.paused.discard, device),
+                "publish_stop": partial(self.paused.add, device),
+                "set_interval": partial(self.set_interval, device),
+                "set_limit": partial(self.set_limit, device),
+            })
+        self.clients[0].on_connect = self.on_connect
+        self.clients[0].on_message = self.dispatcher.on_message
+        self.encoders = None
+        if payload_format == payload_codec.COMPACT:
+            self.encoders = [
+                payload_codec.DeltaEncoder() for _ in range(devices)]
+
+        logging.info(
+            "Simulator initialized, %d devices over %d connections",
+            devices, connections)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            self.dispatcher.subscribe(client)
+        else:
+            logging.error("Failed to connect with error: %s", rc)
+
+    def set_interval(self, device, interval):
+        interval = float(interval)
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.intervals[device] = interval
+
+    def set_limit(self, device, limit):
+        limit = int(limit)
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        self.device_limits[device] = limit
+        self.fetch_limit = max(self.fetch_limit, limit)
+
+    def _on_publish(self, index):
+        def on_publish(client, userdata, mid):
+            now = time.monotonic()
+            with self.lock:
+                sent = self.pending.pop((index, mid), None)
+                if sent is None:
+                    self.acked[(index, mid)] = now
+                else:
+                    self.latencies.append(now - sent)
+        return on_publish
+
+    def run(self, duration=None, report_interval=10):
+        for client in self.clients:
+            client.connect(self.broker, self.port)
+            client.loop_start()
+
+        start = time.monotonic()
+        end = None if duration is None else start + duration
+        next_report = start + report_interval
+        last_report, last_published = start, 0
+        next_slot = start
+        heap = [
+            (start + offset, start + offset, device)
+            for device, offset in enumerate(
+                random.uniform(0, self.interval)
+                for _ in range(self.devices))
+        ]
+        heapq.heapify(heap)
+
+        try:
+            while self.running and (end is None or time.monotonic() < end):
+                now = time.monotonic()
+                if now >= next_report:
+                    self.report(now - last_report, last_published)
+                    last_report, last_published = now, self.published
+                    next_report += report_interval
+                if not heap:
+                    logging.info("All devices stopped")
+                    break
+                due, nominal, device = heap[0]
+                if device in self.stopped:
+                    heapq.heappop(heap)
+                    continue
+                if due > now:
+                    time.sleep(min(due, next_report) - now)
+                    continue
+                interval = self.intervals.get(device, self.interval)
+                heapq.heapreplace(heap, (
+                    nominal + interval
+                    + random.uniform(-self.jitter, self.jitter),
+                    nominal + interval,
+                    device,
+                ))
+                if device in self.paused:
+                    continue
+                if self.rate:
+                    if now < next_slot:
+                        time.sleep(next_slot - now)
+                    next_slot = max(next_slot, now) + 1 / self.rate
+                self.publish(device, time.monotonic() - due)
+        except KeyboardInterrupt:
+            logging.info("Simulator stopped via keyboard interrupt")
+        finally:
+            self.report(time.monotonic() - last_report, last_published)
+            for client in self.clients:
+                client.disconnect()
+                client.loop_stop()
+            logging.info(
+                "Published %d messages in %.1fs, %d failed, "
+                "%d upstream requests", self.published,
+                time.monotonic() - start, self.failed,
+                self.fetcher.requests)
+
+    def publish(self, device, lateness):
+        try:
+            data = self.fetcher.get(
+                limit=self.fetch_limit, max_age=self.interval)
+        except (requests.RequestException, ValueError) as e:
+            logging.error("Failed to fetch data with error: %s", e)
+            self.failed += 1
+            return
+        limit = self.device_limits.get(device) or random.choices(
+            self.limits, self.weights)[0]
+        message = crypto_message(data, limit)
+        trace = {"published": payload_codec.now_ms()}
+        fetched = self.fetcher.fetched_time(self.fetch_limit)
+        if fetched is not None:
+            trace["fetched"] = int(fetched * 1000)
+        properties = None
+        if self.encoders:
+            payload = self.encoders[device].encode(message)
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = payload_codec.COMPACT_CONTENT_TYPE
+            properties.UserProperty = payload_codec.trace_user_properties(
+                trace)
+        else:
+            message["trace"] = trace
+            payload, _ = payload_codec.encode(message)
+
+        index = device % len(self.clients)
+        topic = self.data_topic + "/" + self.device_ids[device]
+        # The lock is not held while publishing: paho calls on_publish with
+        # its own message lock held, an ack may thus arrive before the mid
+        # is registered and is then parked in self.acked.
+        sent = time.monotonic()
+        info = self.clients[index].publish(
+            topic, payload, qos=self.qos, properties=properties)
+        with self.lock:
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                self.failed += 1
+                return
+            self.published += 1
+            self.lateness.append(lateness)
+            acked = self.acked.pop((index, info.mid), None)
+            # An ack parked before sending is a late one of an expired
+            # publish that used the same mid
+            if acked is None or acked < sent:
+                self.pending[(index, info.mid)] = sent
+            else:
+                self.latencies.append(acked - sent)
+
+    def expire(self, now):
+        """
+        Count the publishes sent before now - ack_timeout as failed and
+        drop the acks parked as long.
+        """
+        deadline = now - self.ack_timeout
+        with self.lock:
+            self.acked = {
+                key: acked for key, acked in self.acked.items()
+                if acked > deadline}
+            # Publishes are registered in the order they were sent
+            while self.pending:
+                key, sent = next(iter(self.pending.items()))
+                if sent > deadline:
+                    break
+                del self.pending[key]
+                self.expired += 1
+                self.failed += 1
+
+    def report(self, elapsed, last_published):
+        self.expire(time.monotonic())
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            lateness, self.lateness = self.lateness, []
+            inflight = len(self.pending)
+        published = self.published - last_published
+        logging.info(
+            "%d msgs in last %.1fs (%.1f msg/s), ack latency p50 %.1fms "
+            "p99 %.1fms, schedule lateness p99 %.1fms, %d in flight, "
+            "%d unacknowledged",
+            published, elapsed, published / elapsed if elapsed else 0,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            percentile(lateness, 0.99) * 1000, inflight, self.expired)
+
+
+if __name__ == "__main__":
+
+    setup_logging()
+
+    parser = argparse.ArgumentParser(
+        description="Simulator of many MQTT crypto devices")
+    parser.add_argument(
+        "--broker",
+        type=str,
+        default="localhost",
+        help="The MQTT broker address, default is localhost",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=1883,
+        help="The MQTT broker port, default is 1883"
+    )
+    parser.add_argument(
+        "--topic",
+        type=str,
+        default="crypto/data",
+        help="The MQTT topic to publish data, default is crypto/data",
+    )
+    parser.add_argument(
+        "--command",
+        type=str,
+        default="crypto/command",
+        help="The MQTT topic to receive commands, default is crypto/command",
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=1000,
+        help="Number of simulated devices, default is 1000",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=4,
+        help="Number of MQTT connections shared by the devices, "
+        "default is 4",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="Interval in seconds between publishes of a device, "
+        "default is 60",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="Maximum random offset in seconds of every publish, "
+        "default is 0",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="Maximum total publishes per second, default is no limit",
+    )
+    parser.add_argument(
+        "--limits",
+        type=int,
+        nargs="+",
+        default=[10],
+        help="Coin counts of the payload size distribution, default is 10",
+    )
+    parser.add_argument(
+        "--weights",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Relative weights of the coin counts, default is uniform",
+    )
+    parser.add_argument(
+        "--payload_format",
+        type=str,
+        choices=payload_codec.PAYLOAD_FORMATS,
+        default=payload_codec.JSON,
+        help="Encoding of published data, default is json",
+    )
+    parser.add_argument(
+        "--qos",
+        type=int,
+        choices=(0, 1, 2),
+        default=1,
+        help="QoS of published messages, default is 1",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=None,
+        help="Seconds to run, default is until interrupted",
+    )
+    parser.add_argument(
+        "--report_interval",
+        type=float,
+        default=10,
+        help="Seconds between two reports, default is 10",
+    )
+    parser.add_argument(
+        "--ack_timeout",
+        type=float,
+        default=30,
+        help="Seconds after which an unacknowledged publish counts as "
+        "failed, default is 30",
+    )
+    args = parser.parse_args()
+    if args.ack_timeout <= 0:
+        parser.error("--ack_timeout must be positive")
+    if args.weights and len(args.weights) != len(args.limits):
+        parser.error("--weights needs one weight per --limits value")
+
+    simulator = DeviceSimulator(
+        args.broker,
+        args.port,
+        os.getenv("MQTT_USERNAME"),
+        os.getenv("MQTT_PASSWORD"),
+        args.topic,
+        devices=args.devices,
+        connections=args.connections,
+        interval=args.interval,
+        jitter=args.jitter,
+        rate=args.rate,
+        limits=args.limits,
+        weights=args.weights,
+        payload_format=args.payload_format,
+        qos=args.qos,
+        command_topic=args.command,
+        ack_timeout=args.ack_timeout,
+    )
+    simulator.run(args.duration, args.report_interval)
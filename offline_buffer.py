@@ -0,0 +1,116 @@
+import json
+import sqlite3
+import logging
+import threading
+
+
+class OfflineBuffer:
+    """
+    A class representing a disk-backed FIFO of unsent MQTT messages.
+
+    Messages are kept in an SQLite database in WAL mode, so they survive
+    restarts of the device. The buffer is capped by number of messages
+    and by payload bytes; when a cap is hit the oldest messages are
+    dropped, so a long outage cannot exhaust the disk or the memory.
+
+    Args:
+        path (str): The path of the SQLite database file.
+        max_messages (int): The maximum number of buffered messages.
+        max_bytes (int): The maximum total size of buffered payloads.
+    """
+
+    def __init__(self, path, max_messages=100000, max_bytes=64 * 1024 ** 2):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "topic TEXT NOT NULL, "
+            "payload BLOB NOT NULL, "
+            "content_type TEXT, "
+            "trace TEXT)"
+        )
+        columns = {
+            row[1] for row in self.db.execute("PRAGMA table_info(messages)")}
+        if "trace" not in columns:
+            self.db.execute("ALTER TABLE messages ADD COLUMN trace TEXT")
+        self.db.commit()
+        self.count, self.bytes = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) "
+            "FROM messages"
+        ).fetchone()
+        self.dropped = 0
+        if self.count:
+            logging.info(
+                "Offline buffer %s holds %d messages", path, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def push(self, topic, payload, content_type=None, trace=None):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO messages (topic, payload, content_type, trace) "
+                "VALUES (?, ?, ?, ?)",
+                (topic, payload, content_type,
+                 json.dumps(trace) if trace else None),
+            )
+            self.count += 1
+            self.bytes += len(payload)
+            self._enforce_caps()
+            self.db.commit()
+
+    def _enforce_caps(self):
+        while self.count > self.max_messages or (
+            self.bytes > self.max_bytes and self.count > 1
+        ):
+            excess = max(self.count - self.max_messages, 1)
+            rows = self.db.execute(
+                "SELECT id, LENGTH(payload) FROM messages "
+                "ORDER BY id LIMIT ?",
+                (excess,),
+            ).fetchall()
+            self.db.execute(
+                "DELETE FROM messages WHERE id <= ?", (rows[-1][0],))
+            self.count -= len(rows)
+            self.bytes -= sum(size for _, size in rows)
+            self.dropped += len(rows)
+            logging.warning(
+                "Offline buffer full, dropped %d oldest messages", len(rows))
+
+    def peek(self, limit):
+        """Return up to limit of the oldest (id, topic, payload,
+        content_type, trace) rows without removing them."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, topic, payload, content_type, trace "
+                "FROM messages ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [
+            (*row[:4], json.loads(row[4]) if row[4] else {}) for row in rows
+        ]
+
+    def ack(self, last_id):
+        """Remove every message up to and including last_id."""
+        with self.lock:
+            count, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) "
+                "FROM messages WHERE id <= ?",
+                (last_id,),
+            ).fetchone()
+            self.db.execute("DELETE FROM messages WHERE id <= ?", (last_id,))
+            self.db.commit()
+            self.count -= count
+            self.bytes -= size
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,476 @@
+import json
+import math
+import zlib
+import struct
+import time
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = "json"
+COMPACT = "compact"
+PAYLOAD_FORMATS = (JSON, COMPACT)
+
+ZLIB = "zlib"
+ZSTD = "zstd"
+COMPRESSIONS = (ZLIB, ZSTD)
+
+JSON_CONTENT_TYPE = "application/json"
+COMPACT_CONTENT_TYPE = "application/vnd.crypto.compact"
+
+# Milliseconds since the epoch stamped on a sample by its publisher
+TRACE_STAGES = ("fetched", "published")
+
+COMPACT_MAGIC = b"CQ"
+COMPACT_VERSION = 1
+
+# Header: magic, version, flags, timestamp in ms (-1 if unknown), count
+_HEADER = struct.Struct("<2sBBqH")
+_PRICE = struct.Struct("<d")
+_KNOWN_ENTRY = struct.Struct("<Bd")
+_DELTA_ENTRY = struct.Struct("<Hd")
+_SEQUENCE = struct.Struct("<I")
+_INLINE = 0xFF
+# Set when every entry is in the symbol dictionary, entries are then a
+# packed array of (code, price) pairs.
+FLAG_KNOWN_ONLY = 0x01
+# Set when the entries are (position, price) changes against the previous
+# message of the stream.
+FLAG_DELTA = 0x02
+# Set when a 32-bit sequence number follows the header.
+FLAG_SEQUENCE = 0x04
+# Set when the entries are compressed.
+FLAG_ZLIB = 0x08
+FLAG_ZSTD = 0x10
+_KNOWN_FLAGS = (
+    FLAG_KNOWN_ONLY | FLAG_DELTA | FLAG_SEQUENCE | FLAG_ZLIB | FLAG_ZSTD
+)
+
+# Well-known CoinCap assets encoded as a single byte. Append only: the
+# position of an entry is its code on the wire.
+SYMBOL_DICTIONARY = (
+    ("bitcoin", "BTC"),
+    ("ethereum", "ETH"),
+    ("tether", "USDT"),
+    ("binance-coin", "BNB"),
+    ("solana", "SOL"),
+    ("usd-coin", "USDC"),
+    ("xrp", "XRP"),
+    ("dogecoin", "DOGE"),
+    ("cardano", "ADA"),
+    ("tron", "TRX"),
+    ("avalanche", "AVAX"),
+    ("shiba-inu", "SHIB"),
+    ("polkadot", "DOT"),
+    ("chainlink", "LINK"),
+    ("bitcoin-cash", "BCH"),
+    ("near-protocol", "NEAR"),
+    ("polygon", "MATIC"),
+    ("litecoin", "LTC"),
+    ("internet-computer", "ICP"),
+    ("uniswap", "UNI"),
+    ("wrapped-bitcoin", "WBTC"),
+    ("ethereum-classic", "ETC"),
+    ("stellar", "XLM"),
+    ("monero", "XMR"),
+    ("multi-collateral-dai", "DAI"),
+    ("cosmos", "ATOM"),
+    ("filecoin", "FIL"),
+    ("hedera-hashgraph", "HBAR"),
+    ("vechain", "VET"),
+    ("algorand", "ALGO"),
+)
+_SYMBOL_CODES = {entry: code for code, entry in enumerate(SYMBOL_DICTIONARY)}
+
+
+class PayloadError(ValueError):
+    """Raised when a message cannot be encoded or a payload decoded."""
+
+
+def encode(data, payload_format=JSON):
+    """
+    Encode a crypto message in the given format.
+
+    Args:
+        data (dict): The message, {"timestamp": int, "crypto": [{"id",
+        "symbol", "priceUsd"}]}.
+        payload_format (str): "json" or "compact".
+
+    Returns:
+        tuple: The encoded payload and its content type.
+    """
+    if payload_format == COMPACT:
+        return encode_compact(data), COMPACT_CONTENT_TYPE
+    return json.dumps(data), JSON_CONTENT_TYPE
+
+
+def encode_compact(data, seq=None, compression=None, compress_threshold=256):
+    """
+    Encode a crypto message in the compact format.
+
+    Args:
+        data (dict): The message.
+        seq (int): An optional sequence number of the message.
+        compression (str): None, "zlib" or "zstd".
+        compress_threshold (int): The minimum size in bytes of the entries
+        to compress them.
+    """
+    cryptos = data.get("crypto", [])
+    flags, body = _encode_entries(cryptos)
+    return _frame(
+        flags, data.get("timestamp"), len(cryptos), body,
+        seq, compression, compress_threshold
+    )
+
+
+def _price(value):
+    return math.nan if value is None else float(value)
+
+
+def _inline(value):
+    # Inline ids and symbols are prefixed with a one byte length
+    value = value.encode()
+    if len(value) > 0xFF:
+        raise PayloadError(
+            f"{value[:16]!r}... is longer than 255 bytes, too long to "
+            "encode compactly")
+    return bytes((len(value),)) + value
+
+
+def _encode_entries(cryptos):
+    codes = [_SYMBOL_CODES.get((item["id"], item["symbol"]))
+             for item in cryptos]
+    if None not in codes:
+        return FLAG_KNOWN_ONLY, b"".join(
+            _KNOWN_ENTRY.pack(code, _price(item["priceUsd"]))
+            for code, item in zip(codes, cryptos)
+        )
+    parts = []
+    for code, item in zip(codes, cryptos):
+        if code is None:
+            parts.append(bytes((_INLINE,)) + _inline(item["id"]))
+            parts.append(_inline(item["symbol"]))
+        else:
+            parts.append(bytes((code,)))
+        parts.append(_PRICE.pack(_price(item["priceUsd"])))
+    return 0, b"".join(parts)
+
+
+def _frame(flags, timestamp, count, body, seq, compression, threshold):
+    if compression and len(body) >= threshold:
+        if compression == ZSTD:
+            if zstandard is None:
+                raise PayloadError("zstd compression requires zstandard")
+            body = zstandard.ZstdCompressor().compress(body)
+            flags |= FLAG_ZSTD
+        else:
+            body = zlib.compress(body)
+            flags |= FLAG_ZLIB
+    if seq is not None:
+        flags |= FLAG_SEQUENCE
+    header = _HEADER.pack(
+        COMPACT_MAGIC, COMPACT_VERSION, flags,
+        -1 if timestamp is None else int(timestamp), count
+    )
+    if seq is not None:
+        header += _SEQUENCE.pack(seq)
+    return header + body
+
+
+def _parse(payload):
+    """Split a compact payload into flags, timestamp, seq and entries."""
+    try:
+        magic, version, flags, timestamp, count = _HEADER.unpack_from(
+            payload)
+        if magic != COMPACT_MAGIC:
+            raise PayloadError("Not a compact payload")
+        if version != COMPACT_VERSION:
+            raise PayloadError(f"Unsupported compact version {version}")
+        if flags & ~_KNOWN_FLAGS:
+            raise PayloadError(f"Unsupported compact flags {flags:#x}")
+        offset = _HEADER.size
+        seq = None
+        if flags & FLAG_SEQUENCE:
+            seq, = _SEQUENCE.unpack_from(payload, offset)
+            offset += _SEQUENCE.size
+        body = payload[offset:]
+        if flags & FLAG_ZSTD:
+            if zstandard is None:
+                raise PayloadError("zstd payload requires zstandard")
+            body = zstandard.ZstdDecompressor().decompress(body)
+        elif flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+
+        if flags & FLAG_DELTA:
+            if len(body) != count * _DELTA_ENTRY.size:
+                raise PayloadError("Truncated compact payload")
+            entries = [
+                (position, None if price != price else price)
+                for position, price in _DELTA_ENTRY.iter_unpack(body)
+            ]
+        elif flags & FLAG_KNOWN_ONLY:
+            if len(body) != count * _KNOWN_ENTRY.size:
+                raise PayloadError("Truncated compact payload")
+            entries = [
+                {
+                    "id": SYMBOL_DICTIONARY[code][0],
+                    "symbol": SYMBOL_DICTIONARY[code][1],
+                    "priceUsd": None if price != price else price,
+                }
+                for code, price in _KNOWN_ENTRY.iter_unpack(body)
+            ]
+        else:
+            entries = _decode_entries(body, count)
+    except (struct.error, IndexError, UnicodeDecodeError, zlib.error) as e:
+        raise PayloadError(f"Malformed compact payload: {e}") from e
+    return flags, None if timestamp < 0 else timestamp, seq, entries
+
+
+def _decode_entries(body, count):
+    offset = 0
+    cryptos = []
+    for _ in range(count):
+        code = body[offset]
+        offset += 1
+        if code == _INLINE:
+            size = body[offset]
+            asset_id = body[offset + 1:offset + 1 + size].decode()
+            offset += 1 + size
+            size = body[offset]
+            symbol = body[offset + 1:offset + 1 + size].decode()
+            offset += 1 + size
+        else:
+            asset_id, symbol = SYMBOL_DICTIONARY[code]
+        price, = _PRICE.unpack_from(body, offset)
+        offset += _PRICE.size
+        cryptos.append({
+            "id": asset_id,
+            "symbol": symbol,
+            "priceUsd": None if math.isnan(price) else price,
+        })
+    return cryptos
+
+
+def decode_compact(payload):
+    """
+    Decode a self-contained compact payload.
+
+    Prices are returned as floats, a missing price as None. Delta payloads
+    need the previous message of their stream, see StreamDecoder.
+    """
+    flags, timestamp, _, entries = _parse(payload)
+    if flags & FLAG_DELTA:
+        raise PayloadError("Delta payload needs a stream decoder")
+    return {"timestamp": timestamp, "crypto": entries}
+
+
+def message_content_type(msg):
+    """Return the content type of a paho message, None before MQTT v5."""
+    return getattr(getattr(msg, "properties", None), "ContentType", None)
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def trace_user_properties(trace):
+    """Return trace timestamps as MQTT v5 user properties."""
+    return [(stage, str(trace[stage])) for stage in TRACE_STAGES
+            if stage in trace]
+
+
+def with_trace(payload, trace):
+    """Return a JSON payload with a trace field added, without decoding
+    it."""
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+    body = payload.rstrip()[:-1].rstrip()
+    separator = ", " if body != "{" else ""
+    return f'{body}{separator}"trace": {json.dumps(trace)}}}'
+
+
+def message_trace(msg):
+    """
+    Return the trace timestamps a publisher attached to a paho message.
+
+    Compact messages carry them as MQTT v5 user properties, JSON messages
+    in their "trace" field, which is handled by the JSON decoding.
+    """
+    properties = getattr(
+        getattr(msg, "properties", None), "UserProperty", None) or []
+    return {
+        name: int(value) for name, value in properties
+        if name in TRACE_STAGES and value.isdigit()
+    }
+
+
+def is_compact(payload, content_type=None):
+    if content_type is not None:
+        return content_type == COMPACT_CONTENT_TYPE
+    return payload[:2] == COMPACT_MAGIC
+
+
+def is_delta(payload, content_type=None):
+    """
+    Return whether a payload is a compact delta, which only decodes against
+    the previous message of its stream.
+    """
+    if not is_compact(payload, content_type) or len(payload) < _HEADER.size:
+        return False
+    return bool(payload[3] & FLAG_DELTA)
+
+
+def decode(payload, content_type=None):
+    """
+    Decode a crypto message, detecting its format.
+
+    The MQTT v5 content type is used when the publisher set one, otherwise
+    the format is recognized from the leading magic bytes.
+
+    Args:
+        payload (bytes): The raw MQTT payload.
+        content_type (str): The content type property of the message.
+
+    Returns:
+        dict: The decoded message.
+    """
+    if is_compact(payload, content_type):
+        return decode_compact(payload)
+    return json.loads(payload)
+
+
+class DeltaEncoder:
+    """
+    A class representing the publishing side of a compact message stream.
+
+    Every message carries a sequence number. A full keyframe is sent every
+    keyframe_interval messages and whenever the list of assets changes,
+    the messages in between only carry the prices that changed.
+
+    Args:
+        keyframe_interval (int): The number of messages between two
+        keyframes, 1 disables deltas.
+        compression (str): None, "zlib" or "zstd".
+        compress_threshold (int): The minimum size in bytes of the entries
+        to compress them.
+    """
+
+    def __init__(
+        self, keyframe_interval=1, compression=None, compress_threshold=256
+    ):
+        if compression == ZSTD and zstandard is None:
+            raise PayloadError("zstd compression requires zstandard")
+        self.keyframe_interval = keyframe_interval
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.seq = 0
+        self.deltas = 0
+        self.assets = None
+        self.prices = None
+
+    def encode(self, data):
+        cryptos = data.get("crypto", [])
+        assets = [(item["id"], item["symbol"]) for item in cryptos]
+        prices = [_price(item["priceUsd"]) for item in cryptos]
+        if (
+            assets != self.assets
+            or self.deltas >= self.keyframe_interval - 1
+        ):
+            flags, body = _encode_entries(cryptos)
+            count = len(cryptos)
+            self.deltas = 0
+        else:
+            changes = [
+                _DELTA_ENTRY.pack(position, price)
+                for position, (price, previous) in enumerate(
+                    zip(prices, self.prices))
+                if price != previous
+                and not (math.isnan(price) and math.isnan(previous))
+            ]
+            flags, body, count = FLAG_DELTA, b"".join(changes), len(changes)
+            self.deltas += 1
+        # Only a message that could be encoded takes a sequence number
+        seq = self.seq
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.assets = assets
+        self.prices = prices
+        return _frame(
+            flags, data.get("timestamp"), count, body, seq,
+            self.compression, self.compress_threshold
+        )
+
+
+class StreamDecoder:
+    """
+    A class representing the receiving side of compact message streams.
+
+    Keeps the last message of every stream to rebuild full messages from
+    deltas, and detects lost messages from gaps in the sequence numbers.
+    After a gap the deltas of the stream are dropped until its next
+    keyframe. JSON and unsequenced compact messages are decoded as is.
+
+    Attributes:
+        gaps (int): The number of sequence gaps detected.
+        lost (int): The number of messages missing in those gaps.
+        dropped (int): The number of deltas that could not be applied.
+    """
+
+    def __init__(self):
+        self.streams = {}
+        self.gaps = 0
+        self.lost = 0
+        self.dropped = 0
+
+    def decode(self, stream, payload, content_type=None):
+        """
+        Decode a message of a stream.
+
+        Returns:
+            dict: The full message, or None if it was a delta that could
+            not be applied.
+        """
+        if not is_compact(payload, content_type):
+            return json.loads(payload)
+        flags, timestamp, seq, entries = _parse(payload)
+        if seq is None:
+            if flags & FLAG_DELTA:
+                raise PayloadError("Delta payload without sequence number")
+            return {"timestamp": timestamp, "crypto": entries}
+
+        last_seq, base = self.streams.get(stream, (None, None))
+        if last_seq is not None:
+            missing = (seq - last_seq - 1) & 0xFFFFFFFF
+            if missing >= 0x80000000:
+                if flags & FLAG_DELTA:
+                    logging.warning(
+                        "Stale message %d from %s, dropping it", seq, stream)
+                    self.dropped += 1
+                    return None
+                logging.info("Stream %s restarted at %d", stream, seq)
+            elif missing:
+                logging.warning(
+                    "Lost %d message(s) from %s before %d",
+                    missing, stream, seq)
+                self.gaps += 1
+                self.lost += missing
+                base = None
+
+        if flags & FLAG_DELTA:
+            if base is None:
+                self.streams[stream] = (seq, None)
+                self.dropped += 1
+                return None
+            cryptos = [dict(item) for item in base]
+            try:
+                for position, price in entries:
+                    cryptos[position]["priceUsd"] = price
+            except IndexError as e:
+                raise PayloadError(f"Delta out of range: {e}") from e
+        else:
+            cryptos = entries
+        self.streams[stream] = (seq, cryptos)
+        return {"timestamp": timestamp, "crypto": [
+            dict(item) for item in cryptos]}
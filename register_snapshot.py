@@ -0,0 +1,113 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+
+MAGIC = b"MBREGS01"
+# Magic, generation, save time in ms, holding and input register counts
+# and the CRC32 of the registers
+HEADER = struct.Struct("<8sQQIII")
+
+
+class RegisterSnapshot:
+    """
+    A class representing a memory-mapped snapshot of the Modbus registers.
+
+    The file holds two copies of the holding and input registers, saved
+    alternately, each with a generation number and a checksum. A save
+    interrupted by a crash fails the checksum and leaves the previous
+    copy to restore. Saving copies the registers to the mapped pages,
+    which the OS writes back; it costs no system call unless the pages
+    are also synced to the disk.
+
+    Args:
+        path (str): The path of the snapshot file.
+        holding (int): The number of holding registers.
+        input (int): The number of input registers.
+    """
+
+    def __init__(self, path, holding, input):
+        self.path = path
+        self.counts = (holding, input)
+        self.registers = struct.Struct(f"<{holding + input}H")
+        self.slot_size = HEADER.size + self.registers.size
+        self.generation = 0
+        self.saved = None
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with os.fdopen(os.dup(fd), "rb") as file:
+                self.saved = self._newest(file.read())
+            if self.saved is not None:
+                self.generation = self.saved[0]
+            os.ftruncate(fd, 2 * self.slot_size)
+            self.map = mmap.mmap(fd, 2 * self.slot_size)
+        finally:
+            os.close(fd)
+
+    def _newest(self, data):
+        # Both copies have the size of the registers they were saved with
+        slot_size = len(data) // 2
+        newest = None
+        for offset in (0, slot_size):
+            if slot_size < HEADER.size:
+                break
+            magic, generation, saved_ms, holding, input, crc = (
+                HEADER.unpack_from(data, offset))
+            if magic != MAGIC or (
+                HEADER.size + 2 * (holding + input) != slot_size
+            ):
+                continue
+            registers = data[offset + HEADER.size:offset + slot_size]
+            if zlib.crc32(registers) == crc and (
+                newest is None or generation > newest[0]
+            ):
+                values = struct.unpack(f"<{holding + input}H", registers)
+                newest = (generation, saved_ms, holding,
+                          list(values[:holding]), list(values[holding:]))
+        return newest
+
+    def load(self):
+        """
+        Return the registers of the newest valid copy in the file as it
+        was opened.
+
+        Returns:
+            tuple: The save time in ms, the holding registers and the input
+            registers, None for those whose count changed. None if no copy
+            is valid.
+        """
+        if self.saved is None:
+            return None
+        _, saved_ms, holding, holding_values, input_values = self.saved
+        if holding != self.counts[0]:
+            return None
+        if len(input_values) != self.counts[1]:
+            input_values = None
+        return saved_ms, holding_values, input_values
+
+    def save(self, holding_values, input_values, sync=False):
+        """
+        Save the registers over the older copy.
+
+        Args:
+            holding_values (list): The holding registers.
+            input_values (list): The input registers.
+            sync (bool): Whether to also wait for the copy to be written
+            to the disk.
+        """
+        self.generation += 1
+        offset = (self.generation % 2) * self.slot_size
+        self.registers.pack_into(
+            self.map, offset + HEADER.size, *holding_values, *input_values)
+        crc = zlib.crc32(self.map[
+            offset + HEADER.size:offset + self.slot_size])
+        HEADER.pack_into(
+            self.map, offset, MAGIC, self.generation,
+            int(time.time() * 1000), *self.counts, crc)
+        if sync:
+            self.map.flush()
+
+    def close(self):
+        self.map.close()
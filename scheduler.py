@@ -0,0 +1,94 @@
+import time
+import logging
+
+from collections import namedtuple
+
+SKIP = "skip"
+CATCH_UP = "catch_up"
+OVERRUN_POLICIES = (SKIP, CATCH_UP)
+
+Tick = namedtuple("Tick", ["index", "lateness", "skipped"])
+
+
+class DeadlineScheduler:
+    """
+    A class representing a fixed-rate scheduler for polling loops.
+
+    Deadlines are kept on the monotonic clock and advanced by exactly one
+    interval per tick, so the time spent doing the work between ticks does
+    not accumulate into drift. When the work overruns the next deadline
+    the overrun policy decides what happens to the missed ticks:
+
+    - "skip" drops every deadline that has already passed and waits for
+      the next one, so ticks stay on the original time grid.
+    - "catch_up" runs the missed ticks back to back until the schedule is
+      on time again, up to max_catch_up ticks, after which the remaining
+      backlog is skipped.
+
+    Args:
+        interval (float): The period in seconds between ticks.
+        policy (str): The overrun policy, "skip" or "catch_up".
+        max_catch_up (int): The maximum number of missed ticks to run
+        back to back with the "catch_up" policy.
+    """
+
+    def __init__(
+        self, interval, policy=SKIP, max_catch_up=10,
+        clock=time.monotonic, sleep=time.sleep
+    ):
+        if policy not in OVERRUN_POLICIES:
+            raise ValueError(f"Unknown overrun policy: {policy}")
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.interval = interval
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        """Start a new schedule with tick 0 due now."""
+        self.deadline = self.clock()
+        self.index = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+
+    def wait(self):
+        """
+        Block until the next tick is due.
+
+        Returns:
+            Tick: The index of the tick, how many seconds after its deadline
+            it was released and how many ticks were skipped before it.
+        """
+        self.deadline += self.interval
+        self.index += 1
+        now = self.clock()
+
+        skipped = 0
+        if now > self.deadline:
+            # Ticks due besides this one
+            behind = int((now - self.deadline) // self.interval)
+            if self.policy == SKIP:
+                skipped = behind + 1
+            elif behind + 1 > self.max_catch_up:
+                skipped = behind + 1 - self.max_catch_up
+            self.deadline += skipped * self.interval
+            self.index += skipped
+            self.skipped += skipped
+
+        if now < self.deadline:
+            self.sleep(self.deadline - now)
+
+        lateness = max(0.0, self.clock() - self.deadline)
+        self.max_lateness = max(self.max_lateness, lateness)
+
+        if skipped:
+            logging.warning(
+                "Overran schedule, skipped %d tick(s), next tick %d "
+                "late by %.3fs", skipped, self.index, lateness
+            )
+        else:
+            logging.debug("Tick %d late by %.3fs", self.index, lateness)
+        return Tick(self.index, lateness, skipped)
@@ -0,0 +1,160 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A class representing a queue handler that defers formatting.
+
+    The standard QueueHandler merges the message arguments in the calling
+    thread; here records are queued as they are and formatted by the
+    listener thread, so logging only costs the caller the record creation.
+    Arguments must thus not be modified after they are logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    A class representing a filter limiting how often an event is logged.
+
+    Records with the same logger, level and message template are one
+    event. At most burst records of an event pass per period, the others
+    are dropped and counted; the next record let through says how many
+    were dropped. Templates must use lazy %-formatting, every distinct
+    f-string message being an event of its own.
+
+    Args:
+        period (float): The length in seconds of a rate limit window.
+        burst (int): The number of records of an event let through per
+        window.
+    """
+
+    def __init__(self, period=10.0, burst=5, max_events=1000):
+        super().__init__()
+        self.period = period
+        self.burst = burst
+        self.max_events = max_events
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, str(record.msg))
+        now = record.created
+        with self.lock:
+            event = self.events.get(key)
+            if event is not None and now - event[0] < self.period:
+                if event[1] < self.burst:
+                    event[1] += 1
+                    return True
+                event[2] += 1
+                return False
+            dropped = event[2] if event is not None else 0
+            if event is None and len(self.events) >= self.max_events:
+                self.events = {
+                    key: event for key, event in self.events.items()
+                    if now - event[0] < self.period
+                }
+            self.events[key] = [now, 1, 0]
+        if dropped:
+            record.msg = (
+                f"{record.getMessage()} ({dropped} similar messages dropped)")
+            record.args = None
+        return True
+
+
+class PeriodicSummary:
+    """
+    A class representing counters of hot path events logged periodically.
+
+    Instead of one line per message, loops count what happened and one
+    line like "1520 received, 12 suppressed in last 10s" is logged per
+    interval, by the first event after the interval ended.
+
+    Args:
+        interval (float): The minimum number of seconds between two
+        summary lines.
+        level (int): The level of the summary lines.
+    """
+
+    def __init__(self, interval=10.0, level=logging.INFO):
+        self.interval = interval
+        self.level = level
+        self.counts = {}
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, event, amount=1):
+        now = time.monotonic()
+        with self.lock:
+            self.counts[event] = self.counts.get(event, 0) + amount
+            if now - self.started < self.interval:
+                return
+            counts, self.counts = self.counts, {}
+            elapsed, self.started = now - self.started, now
+        self.log(counts, elapsed)
+
+    def flush(self):
+        """Log the events counted since the last summary line."""
+        now = time.monotonic()
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            elapsed, self.started = now - self.started, now
+        if counts:
+            self.log(counts, elapsed)
+
+    def log(self, counts, elapsed):
+        logging.log(
+            self.level, "%s in last %.0fs",
+            ", ".join(f"{count} {event}" for event, count in counts.items()),
+            elapsed,
+        )
+
+
+def setup_logging(level=logging.INFO, period=10.0, burst=5):
+    """
+    Configure the root logger to never block the logging threads.
+
+    Records go through a queue to a listener thread that formats and
+    writes them to stderr, and is stopped at exit once the queue is
+    empty. Every event is rate limited, see RateLimitFilter.
+
+    Args:
+        level (int): The minimum level of logged records.
+        period (float): The rate limit window in seconds.
+        burst (int): The number of records of an event logged per window.
+
+    Returns:
+        QueueListener: The started listener.
+    """
+    # The format does not use them, skip looking them up for every record
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(period, burst))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,67 @@
+import unittest
+import threading
+
+import requests
+
+from benchmarks.stub_coincap import StubCoinCapServer
+from coincap_fetcher import CoinCapFetcher
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubCoinCapServer(assets=5, period=3600).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def fetcher(self, **kwargs):
+        fetcher = CoinCapFetcher(self.server.url, **kwargs)
+        self.addCleanup(fetcher.close)
+        return fetcher
+
+    def test_concurrent_callers_share_one_request(self):
+        self.server.latency = 0.2
+        fetcher = self.fetcher(max_age=10)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(fetcher.get(5)))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.served, 1)
+        self.assertEqual(fetcher.coalesced, 7)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_revalidation_with_etag(self):
+        fetcher = self.fetcher(max_age=0)
+        first = fetcher.get(5)
+        second = fetcher.get(5)
+
+        self.assertEqual(self.server.served, 2)
+        self.assertEqual(self.server.not_modified, 1)
+        self.assertEqual(fetcher.not_modified, 1)
+        self.assertIs(second, first)
+        self.assertEqual(len(first["data"]), 5)
+
+    def test_retries_failed_requests(self):
+        self.server.failures = 2
+        fetcher = self.fetcher(retries=3, backoff_factor=0)
+
+        self.assertEqual(len(fetcher.get(5)["data"]), 5)
+        self.assertEqual(self.server.served, 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.failures = 5
+        fetcher = self.fetcher(retries=2, backoff_factor=0)
+
+        with self.assertRaises(requests.RequestException):
+            fetcher.get(5)
+        self.assertEqual(self.server.served, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
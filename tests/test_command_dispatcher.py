@@ -0,0 +1,63 @@
+import unittest
+from types import SimpleNamespace
+
+from command_dispatcher import CommandDispatcher
+
+
+def message(command, device_id="device"):
+    return SimpleNamespace(
+        topic=f"crypto/command/{device_id}", payload=command.encode())
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.intervals = []
+        self.dispatcher = CommandDispatcher("crypto/command")
+        self.dispatcher.register("device", {
+            "set_interval": self.set_interval,
+            "crash": self.crash,
+        })
+
+    def set_interval(self, interval):
+        interval = int(interval)
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.intervals.append(interval)
+
+    def crash(self):
+        return None + 1
+
+    def test_applies_command(self):
+        with self.assertLogs(level="INFO"):
+            self.dispatcher.on_message(None, None, message("set_interval 30"))
+
+        self.assertEqual(self.intervals, [30])
+        self.assertEqual(self.dispatcher.dispatched, 1)
+
+    def test_rejects_wrong_argument_count(self):
+        with self.assertLogs(level="ERROR"):
+            self.dispatcher.on_message(None, None, message("set_interval"))
+            self.dispatcher.on_message(
+                None, None, message("set_interval 1 2"))
+
+        self.assertEqual(self.intervals, [])
+        self.assertEqual(self.dispatcher.rejected, 2)
+
+    def test_rejects_invalid_value(self):
+        with self.assertLogs(level="ERROR"):
+            self.dispatcher.on_message(None, None, message("set_interval 0"))
+
+        self.assertEqual(self.dispatcher.rejected, 1)
+
+    def test_handler_bug_is_logged_as_failure(self):
+        with self.assertLogs(level="ERROR") as logs:
+            self.dispatcher.on_message(None, None, message("crash"))
+
+        self.assertEqual(self.dispatcher.rejected, 0)
+        self.assertEqual(self.dispatcher.failed, 1)
+        self.assertIn("TypeError", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+
+import payload_codec
+from dead_letter import DeadLetterLog
+from tests import load_script
+
+mqtt_persistence = load_script("mqtt-persistence.py")
+
+DATA = {
+    "timestamp": 1000000,
+    "crypto": [{"id": "bitcoin", "symbol": "BTC", "priceUsd": 1.0}],
+}
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log = DeadLetterLog(
+            os.path.join(self.directory.name, "dead-letters.ndjson"))
+        self.written = []
+        self.bridge = mqtt_persistence.MQTTMongoBridge.__new__(
+            mqtt_persistence.MQTTMongoBridge)
+        self.bridge.dead_letters = self.log
+        self.bridge.write_documents = self.write_documents
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_documents(self, documents):
+        self.written.extend(documents)
+        return len(documents), 0, []
+
+    def test_undecoded_delta_is_skipped_and_kept(self):
+        encoder = payload_codec.DeltaEncoder(keyframe_interval=2)
+        keyframe = encoder.encode(DATA)
+        delta = encoder.encode(dict(DATA, timestamp=1001000))
+        content_type = payload_codec.COMPACT_CONTENT_TYPE
+        self.log.append(
+            "crypto/data/device", keyframe, content_type,
+            ValueError("lost"))
+        self.log.append(
+            "crypto/data/device", delta, content_type,
+            payload_codec.PayloadError("Delta out of range"))
+
+        with self.assertLogs(level="WARNING") as logs:
+            self.bridge.replay_dead_letters(rate=1000)
+
+        self.assertEqual(
+            [document["timestamp"] for document in self.written], [1000000])
+        [record] = DeadLetterLog.read(self.log.path)
+        self.assertEqual(record["payload"], delta)
+        self.assertIn("cannot be replayed", logs.output[-1])
+
+    def test_delta_with_document_is_replayed(self):
+        encoder = payload_codec.DeltaEncoder(keyframe_interval=2)
+        encoder.encode(DATA)
+        delta = encoder.encode(dict(DATA, timestamp=1001000))
+        self.log.append(
+            "crypto/data/device", delta, payload_codec.COMPACT_CONTENT_TYPE,
+            ValueError("lost"), document=dict(DATA, timestamp=1001000))
+
+        self.bridge.replay_dead_letters(rate=1000)
+
+        self.assertEqual(
+            [document["timestamp"] for document in self.written], [1001000])
+        self.assertFalse(os.path.exists(self.log.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+from deadband import DeadbandFilter
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class DeadbandFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.deadband = DeadbandFilter(
+            absolute=1.0, percent=1.0, max_silent_interval=60,
+            points={"eth": (0.0, 0.0)}, clock=self.clock)
+
+    def write(self, values, stream="device"):
+        if self.deadband.should_write(stream, values):
+            self.deadband.commit(stream, values)
+            return True
+        return False
+
+    def test_first_sample_is_written(self):
+        self.assertTrue(self.write({"btc": 100.0}))
+
+    def test_change_must_exceed_absolute_and_percent(self):
+        self.write({"btc": 1000.0})
+
+        self.assertFalse(self.write({"btc": 1005.0}))
+        self.assertTrue(self.write({"btc": 1010.5}))
+        self.assertEqual(self.deadband.suppressed, 1)
+        self.assertEqual(self.deadband.written, 2)
+
+    def test_point_override(self):
+        self.write({"eth": 10.0})
+
+        self.assertTrue(self.write({"eth": 10.01}))
+
+    def test_changed_points_and_non_numeric_values_are_written(self):
+        self.write({"btc": 100.0})
+
+        self.assertTrue(self.write({"btc": 100.0, "eth": 10.0}))
+        self.assertTrue(self.write({"btc": "n/a", "eth": 10.0}))
+        self.assertFalse(self.write({"btc": "n/a", "eth": 10.0}))
+
+    def test_heartbeat(self):
+        self.write({"btc": 100.0})
+        self.clock.now = 59.0
+        self.assertFalse(self.write({"btc": 100.0}))
+        self.clock.now = 60.0
+
+        self.assertTrue(self.write({"btc": 100.0}))
+
+    def test_streams_are_independent(self):
+        self.write({"btc": 100.0}, stream="a")
+
+        self.assertTrue(self.write({"btc": 100.0}, stream="b"))
+
+    def test_uncommitted_sample_is_not_the_reference(self):
+        self.write({"btc": 100.0})
+
+        # Written but not stored, like a failed insert
+        self.assertTrue(self.deadband.should_write("device", {"btc": 200.0}))
+        self.assertTrue(self.deadband.should_write("device", {"btc": 200.0}))
+        self.assertEqual(self.deadband.written, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+from metrics import Registry, write_textfile
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_with_labels(self):
+        requests = self.registry.get_or_create(
+            "counter", "requests_total", "Requests", ("route", "status"))
+        requests.labels("/api", "200").inc()
+        requests.labels("/api", "200").inc(2)
+        requests.labels('say "hi"\n', "500").inc()
+
+        self.assertEqual(self.registry.render(), "\n".join([
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{route="/api",status="200"} 3',
+            'requests_total{route="say \\"hi\\"\\n",status="500"} 1',
+        ]) + "\n")
+
+    def test_labels_must_match(self):
+        requests = self.registry.get_or_create(
+            "counter", "requests_total", "Requests", ("route",))
+
+        with self.assertRaises(ValueError):
+            requests.labels()
+
+    def test_gauge_function(self):
+        depth = self.registry.get_or_create("gauge", "depth", "Depth")
+        depth.set(4)
+        self.assertIn("depth 4\n", self.registry.render())
+
+        depth.set_function(lambda: 2.5)
+        self.assertIn("depth 2.5\n", self.registry.render())
+
+        depth.set_function(lambda: 1 / 0)
+        self.assertIn("depth 4\n", self.registry.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        latency = self.registry.get_or_create(
+            "histogram", "latency_seconds", "Latency", buckets=(1, 0.1))
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value)
+
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'latency_seconds_bucket{le="0.1"} 2',
+            'latency_seconds_bucket{le="1"} 3',
+            'latency_seconds_bucket{le="+Inf"} 4',
+            "latency_seconds_sum 3.65",
+            "latency_seconds_count 4",
+        ])
+
+    def test_same_name_returns_same_metric(self):
+        first = self.registry.get_or_create("counter", "events", "Events")
+
+        self.assertIs(
+            self.registry.get_or_create("counter", "events", "Events"),
+            first)
+        with self.assertRaises(ValueError):
+            self.registry.get_or_create("gauge", "events", "Events")
+
+    def test_write_textfile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "service.prom")
+            write_textfile(path)
+
+            self.assertEqual(os.listdir(directory), ["service.prom"])
+
+
+if __name__ == "__main__":
+    unittest.main()
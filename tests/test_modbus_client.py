@@ -0,0 +1,310 @@
+import os
+import ssl
+import time
+import socket
+import struct
+import tempfile
+import itertools
+import threading
+import unittest
+from unittest.mock import patch
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import modbus_registers
+from service_logging import PeriodicSummary
+from tests import load_script, self_signed_certificate
+
+modbus_client = load_script("modbus-client.py")
+
+
+class FakeCollection:
+    """A collection writing fail_after documents of the next fail_times
+    inserts, then raising AutoReconnect."""
+
+    def __init__(self, fail_after=None, fail_times=1):
+        self.documents = {}
+        self.fail_after = fail_after
+        self.fail_times = fail_times
+        self.inserts = 0
+        self.ids = itertools.count()
+
+    def insert_many(self, documents, ordered=True):
+        self.inserts += 1
+        errors = []
+        for index, document in enumerate(documents):
+            # Like pymongo, set the _id of the documents in place
+            document.setdefault("_id", next(self.ids))
+            if self.fail_times and index == self.fail_after:
+                self.fail_times -= 1
+                raise AutoReconnect("connection reset")
+            if document["_id"] in self.documents:
+                errors.append({
+                    "index": index, "code": 11000,
+                    "errmsg": "E11000 duplicate key error"})
+            else:
+                self.documents[document["_id"]] = document
+        if errors:
+            raise BulkWriteError({
+                "writeErrors": errors,
+                "nInserted": len(documents) - len(errors)})
+
+
+def writer(collection, write_retries=5):
+    client = modbus_client.ModbusPersistenceClient.__new__(
+        modbus_client.ModbusPersistenceClient)
+    client.collection = collection
+    client.write_retries = write_retries
+    client.deadband = None
+    client.reconnect_delay = 0.0
+    client.reconnect_delay_max = 0.0
+    client.stopped = threading.Event()
+    client.summary = PeriodicSummary()
+    return client
+
+
+def failed_samples():
+    return modbus_client.SAMPLES.labels("failed").value
+
+
+class WriteBatchTest(unittest.TestCase):
+
+    def test_retry_after_partial_insert_skips_written_samples(self):
+        collection = FakeCollection(fail_after=2)
+        failed = failed_samples()
+
+        with self.assertLogs(level="ERROR"):
+            writer(collection).write_batch([{"value": i} for i in range(5)])
+
+        self.assertEqual(collection.inserts, 2)
+        self.assertEqual(
+            sorted(doc["value"] for doc in collection.documents.values()),
+            list(range(5)))
+        self.assertEqual(failed_samples(), failed)
+
+    def test_retries_are_capped(self):
+        collection = FakeCollection(fail_after=0, fail_times=10)
+        failed = failed_samples()
+
+        with self.assertLogs(level="ERROR"):
+            writer(collection, write_retries=2).write_batch(
+                [{"value": i} for i in range(3)])
+
+        self.assertEqual(collection.inserts, 3)
+        self.assertEqual(failed_samples(), failed + 3)
+
+
+class FakeResponse:
+
+    def __init__(self, registers):
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+
+class BackfillTest(unittest.TestCase):
+
+    def test_backfill_reads_across_ring_end(self):
+        # Updates 4 to 8 of a 5 slot history, the newest in slot 2
+        slots, newest = 5, 8
+        registers = [0] * modbus_registers.history_size(slots)
+        registers[:modbus_registers.HISTORY_HEADER_COUNT] = (
+            modbus_registers.encode_history_header(2, slots, newest))
+        for sequence in range(newest - slots + 1, newest + 1):
+            address = modbus_registers.history_address((sequence - 1) % slots)
+            registers[
+                address:address + modbus_registers.HISTORY_ENTRY_COUNT] = (
+                modbus_registers.encode_history_entry(
+                    sequence, sequence * 1000, [float(sequence)]))
+        reads = []
+
+        def read_registers(address, count, input_registers=False):
+            reads.append((address, count))
+            return FakeResponse(registers[address:address + count])
+
+        client = writer(FakeCollection())
+        client.sequence = 2
+        client.read_registers = read_registers
+        persisted = []
+        client.persist = lambda sequence, *_: persisted.append(sequence)
+
+        with self.assertLogs(level="WARNING"):
+            client.backfill(newest)
+
+        self.assertEqual(persisted, [4, 5, 6, 7])
+        entry = modbus_registers.HISTORY_ENTRY_COUNT
+        self.assertEqual(reads[1:], [
+            (modbus_registers.history_address(3), 2 * entry),
+            (modbus_registers.history_address(0), 2 * entry)])
+
+
+class PollTest(unittest.TestCase):
+
+    def poll(self, client, sequence, updated_ms):
+        registers = {
+            modbus_registers.STATUS_ADDRESS:
+                modbus_registers.encode_status(sequence, updated_ms),
+            modbus_registers.PRICE_ADDRESS: modbus_registers.encode_prices(
+                [1.0] * modbus_client.COINS),
+        }
+        client.read_registers = (
+            lambda address, count: FakeResponse(registers[address]))
+        client.poll()
+
+    def test_restored_status_is_not_persisted_again(self):
+        client = writer(FakeCollection())
+        client.sequence = client.updated_ms = None
+        persisted = []
+        client.persist = lambda sequence, *_: persisted.append(sequence)
+
+        self.poll(client, 5, 5000)
+        # The server restarts from a snapshot saved before update 5
+        self.poll(client, 3, 3000)
+        self.poll(client, 6, 6000)
+
+        self.assertEqual(persisted, [5, 6])
+
+    def test_reused_sequence_with_newer_time_is_persisted(self):
+        client = writer(FakeCollection())
+        client.sequence = client.updated_ms = None
+        persisted = []
+        client.persist = (
+            lambda sequence, updated_ms, _: persisted.append(updated_ms))
+
+        self.poll(client, 1, 1000)
+        self.poll(client, 1, 1000)
+        # The server restarts without a snapshot
+        self.poll(client, 1, 9000)
+
+        self.assertEqual(persisted, [1000, 9000])
+
+
+class DroppingServer:
+    """A Modbus TLS server answering every read with zeros, closing each
+    connection after answers reads."""
+
+    def __init__(self, ssl_context, host, answers=1):
+        self.ssl_context = ssl_context
+        self.answers = answers
+        self.connections = 0
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        self.listener.bind((host, 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            try:
+                with self.ssl_context.wrap_socket(
+                    sock, server_side=True
+                ) as conn:
+                    for _ in range(self.answers):
+                        self.answer(conn)
+            except (OSError, struct.error):
+                pass
+
+    def answer(self, conn):
+        # Modbus over TLS frames carry the bare PDU
+        function, _, count = struct.unpack(">BHH", conn.recv(5))
+        conn.sendall(
+            struct.pack(">BB", function, 2 * count) + bytes(2 * count))
+
+    def close(self):
+        self.listener.close()
+
+
+class ReconnectTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.certfile, cls.keyfile = self_signed_certificate(
+            cls.directory.name)
+        cls.server_context = ssl.create_default_context(
+            ssl.Purpose.CLIENT_AUTH)
+        cls.server_context.load_cert_chain(cls.certfile, cls.keyfile)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def client(self, host, port):
+        with patch.dict(
+            os.environ, MODBUS_CA_CERT_PATH=self.certfile,
+            MODBUS_CLIENT_CERT_PATH=self.certfile,
+            MODBUS_CLIENT_KEY_PATH=self.keyfile,
+        ):
+            client = modbus_client.ModbusPersistenceClient(
+                host, port, "mongodb://localhost:1", "test", "modbus", 1,
+                reconnect_delay=0.05, reconnect_delay_max=0.2)
+        self.addCleanup(client.mongo_client.close)
+        self.addCleanup(client.modbus_client.close)
+        return client
+
+    def read(self, client):
+        return client.read_registers(
+            modbus_registers.STATUS_ADDRESS, modbus_registers.STATUS_COUNT)
+
+    def assert_reconnects(self, host):
+        server = DroppingServer(self.server_context, host)
+        self.addCleanup(server.close)
+        client = self.client(host, server.port)
+        reconnects = modbus_client.RECONNECTS.labels().value
+
+        self.assertEqual(self.read(client).registers, [0] * 6)
+        with self.assertLogs(level="WARNING"):
+            response = self.read(client)
+
+        self.assertEqual(response.registers, [0] * 6)
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(
+            modbus_client.RECONNECTS.labels().value, reconnects + 1)
+        self.assertTrue(client.modbus_client.session_reused)
+
+    def test_reconnect_resumes_session(self):
+        self.assert_reconnects("127.0.0.1")
+
+    @unittest.skipUnless(socket.has_ipv6, "no IPv6")
+    def test_reconnect_over_ipv6(self):
+        try:
+            socket.create_server(("::1", 0), family=socket.AF_INET6).close()
+        except OSError:
+            self.skipTest("no IPv6 loopback")
+        self.assert_reconnects("::1")
+
+    def test_backoff_while_server_down(self):
+        # A bound socket that does not listen refuses connections, and
+        # keeps the client from connecting to itself from the same port
+        reserved = socket.socket()
+        self.addCleanup(reserved.close)
+        reserved.bind(("127.0.0.1", 0))
+        port = reserved.getsockname()[1]
+        failed = modbus_client.CONNECTS.labels("failed").value
+
+        with self.assertLogs(level="WARNING"):
+            client = self.client("127.0.0.1", port)
+            # Within the delay, polls are skipped without an attempt
+            self.assertIsNone(self.read(client))
+            self.assertEqual(
+                modbus_client.CONNECTS.labels("failed").value, failed + 1)
+            delays = []
+            for _ in range(3):
+                time.sleep(max(0, client.next_attempt - time.monotonic()))
+                delays.append(client.backoff)
+                self.assertIsNone(self.read(client))
+
+        self.assertEqual(delays, [0.1, 0.2, 0.2])
+        self.assertEqual(
+            modbus_client.CONNECTS.labels("failed").value, failed + 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+import modbus_registers
+
+
+class HistoryTest(unittest.TestCase):
+
+    def test_largest_history_fits_address_space(self):
+        slots = modbus_registers.MAX_HISTORY_SLOTS
+        last = modbus_registers.history_address(slots) - 1
+
+        self.assertLessEqual(last, 0xFFFF)
+        self.assertGreater(
+            modbus_registers.history_address(slots + 1) - 1, 0xFFFF)
+
+    def test_slot_matches_server_ring(self):
+        slots = 5
+        for newest in range(1, 13):
+            head = (newest - 1) % slots
+            for sequence in range(max(1, newest - slots + 1), newest + 1):
+                self.assertEqual(
+                    modbus_registers.history_slot(
+                        head, newest, sequence, slots),
+                    (sequence - 1) % slots)
+
+    def test_slots_wrap_around(self):
+        # Newest update 8 of 5 slots: updates 4 to 8 in slots 3, 4, 0, 1, 2
+        self.assertEqual(
+            [modbus_registers.history_slot(2, 8, sequence, 5)
+             for sequence in range(4, 9)],
+            [3, 4, 0, 1, 2])
+
+    def test_header_round_trip(self):
+        registers = modbus_registers.encode_history_header(
+            2519, 2520, 0xFFFFFFFF)
+
+        self.assertEqual(
+            len(registers), modbus_registers.HISTORY_HEADER_COUNT)
+        self.assertEqual(
+            modbus_registers.decode_history_header(registers),
+            (2519, 2520, 0xFFFFFFFF))
+
+    def test_entries_round_trip(self):
+        registers = (
+            modbus_registers.encode_history_entry(7, 1000, [1.5, 2.5])
+            + modbus_registers.encode_history_entry(8, 2000, [3.5] * 12))
+
+        self.assertEqual(
+            len(registers), 2 * modbus_registers.HISTORY_ENTRY_COUNT)
+        self.assertEqual(
+            modbus_registers.decode_history_entries(registers),
+            [(7, 1000, [1.5, 2.5] + [0.0] * 8), (8, 2000, [3.5] * 10)])
+
+
+if __name__ == "__main__":
+    unittest.main()
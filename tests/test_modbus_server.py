@@ -0,0 +1,86 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+import modbus_registers
+from register_snapshot import RegisterSnapshot
+from tests import load_script
+
+modbus_server = load_script("modbus-server.py")
+
+PRICES = [(rank, 100.0 + rank) for rank in range(1, 11)]
+
+
+class UpdateRegistersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "registers.snapshot")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def update_once(self, context, snapshot):
+        """Run update_registers for a single update."""
+        stopped = threading.Event()
+
+        def fetch_data():
+            stopped.set()
+            return PRICES
+
+        with patch.object(modbus_server, "fetch_data", fetch_data):
+            modbus_server.update_registers(
+                context, 1, snapshot=snapshot, snapshot_interval=10,
+                stopped=stopped)
+
+    def status(self, context):
+        return modbus_registers.decode_status(context[0].getValues(
+            3, modbus_registers.STATUS_ADDRESS,
+            modbus_registers.STATUS_COUNT))
+
+    def snapshot(self):
+        snapshot = RegisterSnapshot(
+            self.path, modbus_registers.HOLDING_COUNT,
+            modbus_registers.history_size(5))
+        self.addCleanup(snapshot.close)
+        return snapshot
+
+    def test_sequence_skips_unsaved_updates(self):
+        context = modbus_server.setup_server_context(5)
+        self.update_once(context, self.snapshot())
+        self.assertEqual(self.status(context)[0], 1)
+
+        restored = modbus_server.setup_server_context(5)
+        with self.assertLogs(level="INFO"):
+            self.assertTrue(
+                modbus_server.restore_registers(restored, self.snapshot()))
+        self.assertEqual(self.status(restored)[0], 1)
+        self.update_once(restored, self.snapshot())
+
+        # Up to 10 updates at 1s intervals were unsaved, plus a margin
+        self.assertEqual(self.status(restored)[0], 13)
+
+    def test_first_start_begins_at_one(self):
+        context = modbus_server.setup_server_context(5)
+        with self.assertLogs(level="INFO"):
+            self.assertFalse(
+                modbus_server.restore_registers(context, self.snapshot()))
+        self.update_once(context, self.snapshot())
+
+        self.assertEqual(self.status(context)[0], 1)
+
+    def test_largest_history_is_addressable(self):
+        slots = modbus_registers.MAX_HISTORY_SLOTS
+        context = modbus_server.setup_server_context(slots)
+        address = modbus_registers.history_address(slots - 1)
+        entry = modbus_registers.encode_history_entry(1, 1000, [1.0])
+        context[0].setValues(4, address, entry)
+
+        self.assertEqual(
+            context[0].getValues(4, address, len(entry)), entry)
+
+
+if __name__ == "__main__":
+    unittest.main()
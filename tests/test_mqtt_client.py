@@ -0,0 +1,130 @@
+import os
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import certifi
+import paho.mqtt.client as mqtt
+
+import payload_codec
+from offline_buffer import OfflineBuffer
+from tests import load_script
+
+mqtt_client = load_script("mqtt-client.py")
+
+
+class FakeClient:
+    """The part of the paho client used to publish, recording messages."""
+
+    def __init__(self, connected):
+        self.connected = connected
+        self.messages = []
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload=None, qos=0, properties=None):
+        self.messages.append((topic, payload, qos, properties))
+        info = mqtt.MQTTMessageInfo(len(self.messages))
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        # Acknowledged at once
+        info._published = True
+        return info
+
+
+class FakeFetcher:
+
+    def fetched_time(self, limit):
+        return 1000.0
+
+
+class OfflineTraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.buffer = OfflineBuffer(
+            os.path.join(self.directory.name, "buffer.db"))
+        with patch.dict(os.environ, MQTT_CA_CERT_PATH=certifi.where()):
+            self.client = mqtt_client.MQTTCryptoClient(
+                "localhost", 8883, None, None, "crypto/data",
+                "crypto/command", 60, offline_buffer=self.buffer)
+        self.client.fetcher = FakeFetcher()
+        self.client.fetch_data = lambda: {
+            "timestamp": 1000000,
+            "crypto": [{"id": "bitcoin", "symbol": "BTC", "priceUsd": "1"}],
+        }
+
+    def tearDown(self):
+        self.buffer.close()
+        self.directory.cleanup()
+
+    def test_buffered_message_is_stamped_when_drained(self):
+        self.client.client = FakeClient(connected=False)
+        with patch.object(payload_codec, "now_ms", return_value=2000000):
+            self.client.publish_data()
+
+        [(_, topic, payload, content_type, trace)] = self.buffer.peek(10)
+        self.assertEqual(trace, {"fetched": 1000000})
+
+        self.client.client = FakeClient(connected=True)
+        with patch.object(payload_codec, "now_ms", return_value=9000000):
+            self.client.send(topic, payload, content_type, trace, qos=1)
+
+        [(_, sent, qos, _)] = self.client.client.messages
+        self.assertEqual(qos, 1)
+        self.assertEqual(
+            json.loads(sent)["trace"],
+            {"fetched": 1000000, "published": 9000000})
+
+    def test_live_message_is_stamped_when_sent(self):
+        self.client.client = FakeClient(connected=True)
+        with patch.object(payload_codec, "now_ms", return_value=2000000):
+            self.client.publish_data()
+
+        [(_, sent, _, _)] = self.client.client.messages
+        self.assertEqual(
+            json.loads(sent)["trace"],
+            {"fetched": 1000000, "published": 2000000})
+        self.assertEqual(len(self.buffer), 0)
+
+    def test_drain_sends_batches(self):
+        for timestamp in range(5):
+            self.buffer.push(
+                "crypto/data", b'{"timestamp": %d}' % timestamp,
+                payload_codec.JSON_CONTENT_TYPE, {})
+        self.client.client = FakeClient(connected=True)
+        self.client.drain_batch = 2
+        batches = []
+
+        def sleep(seconds):
+            batches.append(len(self.client.client.messages))
+            if not len(self.buffer):
+                self.client.running = False
+
+        with patch.object(mqtt_client.time, "sleep", sleep):
+            self.client.drain_buffer()
+
+        self.assertEqual(batches, [2, 4, 5])
+        self.assertEqual(
+            [qos for _, _, qos, _ in self.client.client.messages], [1] * 5)
+
+    def test_compact_falls_back_to_json(self):
+        self.client.client = FakeClient(connected=True)
+        self.client.payload_format = payload_codec.COMPACT
+        self.client.encoder = payload_codec.DeltaEncoder()
+        self.client.fetch_data = lambda: {
+            "timestamp": 1000000,
+            "crypto": [{"id": "x" * 300, "symbol": "X", "priceUsd": "1"}],
+        }
+        with self.assertLogs(level="WARNING"):
+            self.client.publish_data()
+
+        [(_, sent, _, properties)] = self.client.client.messages
+        self.assertEqual(json.loads(sent)["crypto"][0]["id"], "x" * 300)
+        self.assertEqual(
+            properties.ContentType, payload_codec.JSON_CONTENT_TYPE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from tests import load_script
+
+mqtt_persistence = load_script("mqtt-persistence.py")
+
+
+class StubCollection:
+    """A collection failing the documents whose _id is in errors with the
+    given error code, like an unordered insert_many."""
+
+    def __init__(self, errors=None):
+        self.documents = {}
+        self.errors = errors or {}
+        self.ordered = []
+
+    def insert_many(self, documents, ordered=True):
+        self.ordered.append(ordered)
+        write_errors = []
+        for index, document in enumerate(documents):
+            code = self.errors.get(document["_id"])
+            if code is None and document["_id"] in self.documents:
+                code = mqtt_persistence.DUPLICATE_KEY_ERROR
+            if code is not None:
+                write_errors.append(
+                    {"index": index, "code": code, "errmsg": f"E{code}"})
+                if ordered:
+                    break
+            else:
+                self.documents[document["_id"]] = document
+        if write_errors:
+            raise BulkWriteError({
+                "writeErrors": write_errors,
+                "nInserted": len(documents) - len(write_errors)})
+        return type("Result", (), {
+            "inserted_ids": [document["_id"] for document in documents]})
+
+
+def bridge(layout):
+    bridge = mqtt_persistence.MQTTMongoBridge.__new__(
+        mqtt_persistence.MQTTMongoBridge)
+    bridge.layout = layout
+    bridge.collection = StubCollection()
+    bridge.symbol_collection = StubCollection()
+    return bridge
+
+
+def sample(sample_id, *cryptos):
+    return {
+        "_id": sample_id,
+        "device_id": "device",
+        "timestamp": 1000000,
+        "crypto": [
+            {"id": asset_id, "symbol": symbol, "priceUsd": price}
+            for asset_id, symbol, price in cryptos],
+    }
+
+
+def documents(label):
+    return mqtt_persistence.DOCUMENTS.labels(label).value
+
+
+class InsertDocumentsTest(unittest.TestCase):
+
+    def test_duplicates_and_failures_are_kept_apart(self):
+        embedded = bridge(mqtt_persistence.EMBEDDED)
+        embedded.collection.documents["s2"] = {"_id": "s2"}
+        embedded.collection.errors = {"s4": 121}
+        counts = {
+            label: documents(label)
+            for label in ("inserted", "duplicate", "failed")}
+
+        result = embedded.insert_documents([
+            {"_id": f"s{i}"} for i in range(1, 6)])
+
+        self.assertEqual(result, (3, 1, [(3, "E121")]))
+        self.assertEqual(embedded.collection.ordered, [False])
+        self.assertEqual(
+            sorted(embedded.collection.documents),
+            ["s1", "s2", "s3", "s5"])
+        self.assertEqual(documents("inserted"), counts["inserted"] + 3)
+        self.assertEqual(documents("duplicate"), counts["duplicate"] + 1)
+        self.assertEqual(documents("failed"), counts["failed"] + 1)
+
+    def test_delivered_twice_is_stored_once(self):
+        embedded = bridge(mqtt_persistence.EMBEDDED)
+
+        self.assertEqual(
+            embedded.insert_documents([{"_id": "s1"}]), (1, 0, []))
+        self.assertEqual(
+            embedded.insert_documents([{"_id": "s1"}]), (0, 1, []))
+        self.assertEqual(list(embedded.collection.documents), ["s1"])
+
+    def test_other_errors_are_raised(self):
+        embedded = bridge(mqtt_persistence.EMBEDDED)
+
+        def insert_many(documents, ordered=True):
+            raise AutoReconnect("connection reset")
+
+        embedded.collection.insert_many = insert_many
+
+        with self.assertRaises(AutoReconnect):
+            embedded.insert_documents([{"_id": "s1"}])
+
+
+class ExplodedTest(unittest.TestCase):
+
+    def test_assets_sharing_a_symbol_get_their_own_id(self):
+        documents = mqtt_persistence.MQTTMongoBridge.exploded_documents(
+            sample("s1", ("bitcoin", "BTC", "1.5"),
+                   ("bitcoin-token", "BTC", 2.5)))
+
+        self.assertEqual(documents, [
+            {"_id": "s1:bitcoin", "d": "device", "s": "BTC",
+             "t": 1000000, "p": 1.5},
+            {"_id": "s1:bitcoin-token", "d": "device", "s": "BTC",
+             "t": 1000000, "p": 2.5},
+        ])
+
+    def test_write_both_layouts(self):
+        both = bridge(mqtt_persistence.BOTH)
+
+        self.assertEqual(
+            both.write_documents([
+                sample("s1", ("bitcoin", "BTC", 1.0)),
+                sample("s2", ("bitcoin", "BTC", 2.0),
+                       ("bitcoin-token", "BTC", 3.0))]),
+            (5, 0, []))
+        self.assertEqual(list(both.collection.documents), ["s1", "s2"])
+        self.assertEqual(
+            list(both.symbol_collection.documents),
+            ["s1:bitcoin", "s2:bitcoin", "s2:bitcoin-token"])
+
+    def test_write_exploded_reports_failed_sample(self):
+        exploded = bridge(mqtt_persistence.EXPLODED)
+        exploded.symbol_collection.errors = {"s2:ether": 121}
+
+        inserted, duplicates, failures = exploded.write_documents([
+            sample("s1", ("bitcoin", "BTC", 1.0)),
+            sample("s2", ("bitcoin", "BTC", 2.0), ("ether", "ETH", 3.0))])
+
+        self.assertEqual((inserted, duplicates), (2, 0))
+        self.assertEqual(failures, [(1, "E121")])
+        self.assertEqual(exploded.collection.documents, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import logging
+import threading
+import unittest
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+import payload_codec
+from tests import load_script
+
+mqtt_simulator = load_script("mqtt-simulator.py")
+
+
+class FakeFetcher:
+
+    def get(self, limit, max_age):
+        return {"timestamp": 1, "data": [
+            {"id": "bitcoin", "symbol": "BTC", "priceUsd": "1.0"}]}
+
+    def fetched_time(self, limit):
+        return None
+
+
+class FakeClient:
+    """A client acknowledging publishes synchronously to on_publish."""
+
+    def __init__(self, on_publish=None, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.on_publish = on_publish
+        self.rc = rc
+        self.mid = 0
+
+    def publish(self, topic, payload, qos=0, properties=None):
+        self.mid += 1
+        if self.on_publish:
+            self.on_publish(self, None, self.mid)
+        return SimpleNamespace(rc=self.rc, mid=self.mid)
+
+
+def simulator(clients, ack_timeout=30.0):
+    simulator = mqtt_simulator.DeviceSimulator.__new__(
+        mqtt_simulator.DeviceSimulator)
+    simulator.fetcher = FakeFetcher()
+    simulator.fetch_limit = 1
+    simulator.interval = 1.0
+    simulator.limits = [1]
+    simulator.weights = None
+    simulator.device_limits = {}
+    simulator.encoders = None
+    simulator.payload_format = payload_codec.JSON
+    simulator.qos = 1
+    simulator.ack_timeout = ack_timeout
+    simulator.data_topic = "crypto/data"
+    simulator.device_ids = ["d0", "d1"]
+    simulator.clients = clients
+    simulator.lock = threading.Lock()
+    simulator.pending = {}
+    simulator.acked = {}
+    simulator.published = 0
+    simulator.failed = 0
+    simulator.expired = 0
+    simulator.latencies = []
+    simulator.lateness = []
+    return simulator
+
+
+class PublishTest(unittest.TestCase):
+
+    def test_ack_before_registration_is_matched(self):
+        device_simulator = simulator([FakeClient()])
+        client = device_simulator.clients[0]
+        client.on_publish = device_simulator._on_publish(0)
+
+        device_simulator.publish(0, 0.0)
+
+        self.assertEqual(device_simulator.published, 1)
+        self.assertEqual(device_simulator.pending, {})
+        self.assertEqual(device_simulator.acked, {})
+        self.assertEqual(len(device_simulator.latencies), 1)
+
+    def test_failed_publish_is_counted(self):
+        device_simulator = simulator(
+            [FakeClient(rc=mqtt.MQTT_ERR_NO_CONN)])
+
+        device_simulator.publish(0, 0.0)
+
+        self.assertEqual(device_simulator.published, 0)
+        self.assertEqual(device_simulator.failed, 1)
+        self.assertEqual(device_simulator.pending, {})
+
+
+class ExpireTest(unittest.TestCase):
+
+    def test_unacknowledged_publishes_expire_as_failed(self):
+        device_simulator = simulator([FakeClient()], ack_timeout=5.0)
+        device_simulator.pending = {(0, 1): 10.0, (0, 2): 12.0, (0, 3): 20.0}
+
+        device_simulator.expire(17.0)
+
+        self.assertEqual(device_simulator.pending, {(0, 3): 20.0})
+        self.assertEqual(device_simulator.expired, 2)
+        self.assertEqual(device_simulator.failed, 2)
+
+    def test_late_ack_is_not_matched_to_a_new_publish(self):
+        device_simulator = simulator([FakeClient()], ack_timeout=5.0)
+        on_publish = device_simulator._on_publish(0)
+        device_simulator.publish(0, 0.0)
+        device_simulator.expire(float("inf"))
+        # The ack of the expired publish arrives, then its mid is reused
+        on_publish(None, None, 1)
+        device_simulator.clients[0].mid = 0
+
+        device_simulator.publish(1, 0.0)
+
+        self.assertEqual(list(device_simulator.pending), [(0, 1)])
+        self.assertEqual(device_simulator.latencies, [])
+
+    def test_report_logs_expired_publishes(self):
+        device_simulator = simulator([FakeClient()], ack_timeout=5.0)
+        device_simulator.pending = {(0, 1): float("-inf")}
+
+        with self.assertLogs(level=logging.INFO) as logs:
+            device_simulator.report(1.0, 0)
+
+        self.assertIn("0 in flight, 1 unacknowledged", logs.output[0])
+
+
+class PercentileTest(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(mqtt_simulator.percentile([], 0.5), 0.0)
+        self.assertEqual(
+            mqtt_simulator.percentile([3, 1, 2, 4], 0.5), 3)
+        self.assertEqual(
+            mqtt_simulator.percentile(list(range(100)), 0.99), 99)
@@ -0,0 +1,126 @@
+import json
+import unittest
+
+import payload_codec
+
+DATA = {
+    "timestamp": 1000000,
+    "crypto": [
+        {"id": "bitcoin", "symbol": "BTC", "priceUsd": 65000.5},
+        {"id": "new-coin", "symbol": "NEW", "priceUsd": None},
+    ],
+}
+
+
+class CompactTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        payload, content_type = payload_codec.encode(
+            DATA, payload_codec.COMPACT)
+
+        self.assertEqual(content_type, payload_codec.COMPACT_CONTENT_TYPE)
+        self.assertEqual(payload_codec.decode(payload), DATA)
+        self.assertEqual(
+            payload_codec.decode(json.dumps(DATA).encode()), DATA)
+
+    def test_round_trip_compressed(self):
+        data = dict(DATA, crypto=DATA["crypto"] * 50)
+        payload = payload_codec.encode_compact(data, compression="zlib")
+
+        self.assertLess(len(payload), 100)
+        self.assertEqual(payload_codec.decode(payload), data)
+
+    def test_id_too_long(self):
+        data = dict(DATA, crypto=[
+            {"id": "x" * 256, "symbol": "X", "priceUsd": 1.0}])
+
+        with self.assertRaises(payload_codec.PayloadError):
+            payload_codec.encode_compact(data)
+        data["crypto"][0]["id"] = "x" * 255
+        self.assertEqual(
+            payload_codec.decode(payload_codec.encode_compact(data)), data)
+
+    def test_symbol_too_long_keeps_sequence(self):
+        encoder = payload_codec.DeltaEncoder()
+        decoder = payload_codec.StreamDecoder()
+        decoder.decode("device", encoder.encode(DATA))
+        with self.assertRaises(payload_codec.PayloadError):
+            encoder.encode(dict(DATA, crypto=[
+                {"id": "x", "symbol": "é" * 128, "priceUsd": 1.0}]))
+
+        self.assertEqual(
+            decoder.decode("device", encoder.encode(DATA)), DATA)
+        self.assertEqual(decoder.gaps, 0)
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = payload_codec.DeltaEncoder(keyframe_interval=3)
+        self.decoder = payload_codec.StreamDecoder()
+
+    def message(self, timestamp, price):
+        return dict(DATA, timestamp=timestamp, crypto=[
+            dict(DATA["crypto"][0], priceUsd=price), DATA["crypto"][1]])
+
+    def test_deltas_rebuild_messages(self):
+        messages = [self.message(t, 100.0 + t % 2) for t in range(6)]
+        decoded = [
+            self.decoder.decode("device", self.encoder.encode(message))
+            for message in messages]
+
+        self.assertEqual(decoded, messages)
+        self.assertEqual(self.decoder.gaps, 0)
+
+    def test_gap_drops_deltas_until_keyframe(self):
+        payloads = [
+            self.encoder.encode(self.message(t, float(t))) for t in range(6)]
+        with self.assertLogs(level="WARNING"):
+            decoded = [
+                self.decoder.decode("device", payload)
+                for index, payload in enumerate(payloads) if index != 1]
+
+        # 0 is a keyframe, 2 a delta after the gap, 3 the next keyframe
+        self.assertEqual(
+            [message and message["timestamp"] for message in decoded],
+            [0, None, 3, 4, 5])
+        self.assertEqual(
+            (self.decoder.gaps, self.decoder.lost, self.decoder.dropped),
+            (1, 1, 1))
+
+    def test_stale_delta_is_dropped(self):
+        payloads = [
+            self.encoder.encode(self.message(t, float(t))) for t in range(3)]
+        for payload in payloads:
+            self.decoder.decode("device", payload)
+
+        with self.assertLogs(level="WARNING"):
+            self.assertIsNone(self.decoder.decode("device", payloads[1]))
+        self.assertEqual(self.decoder.dropped, 1)
+        self.assertEqual(self.decoder.gaps, 0)
+
+    def test_sequence_wraps_around(self):
+        self.encoder.seq = 0xFFFFFFFF
+        messages = [self.message(t, float(t)) for t in range(3)]
+        decoded = [
+            self.decoder.decode("device", self.encoder.encode(message))
+            for message in messages]
+
+        self.assertEqual(decoded, messages)
+        self.assertEqual(self.decoder.gaps, 0)
+
+    def test_restart_is_accepted(self):
+        self.decoder.decode(
+            "device", self.encoder.encode(self.message(0, 1.0)))
+        self.decoder.decode(
+            "device", self.encoder.encode(self.message(1, 2.0)))
+        restarted = payload_codec.DeltaEncoder(keyframe_interval=3)
+
+        message = self.message(2, 3.0)
+        self.assertEqual(
+            self.decoder.decode("device", restarted.encode(message)),
+            message)
+
+
+if __name__ == "__main__":
+    unittest.main()
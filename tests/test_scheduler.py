@@ -0,0 +1,79 @@
+import unittest
+
+from scheduler import CATCH_UP, SKIP, DeadlineScheduler
+
+
+class FakeClock:
+    """A clock advanced by sleeping and by the work of a test."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class DeadlineSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def scheduler(self, policy=SKIP, max_catch_up=10):
+        return DeadlineScheduler(
+            10, policy=policy, max_catch_up=max_catch_up,
+            clock=self.clock, sleep=self.clock.sleep)
+
+    def test_on_time_ticks_do_not_drift(self):
+        scheduler = self.scheduler()
+        ticks = []
+        for _ in range(3):
+            self.clock.now += 3
+            ticks.append(scheduler.wait())
+
+        self.assertEqual(
+            [tuple(tick) for tick in ticks],
+            [(1, 0.0, 0), (2, 0.0, 0), (3, 0.0, 0)])
+        self.assertEqual(self.clock.now, 130.0)
+
+    def test_skip_keeps_the_time_grid(self):
+        scheduler = self.scheduler()
+        self.clock.now += 25
+        with self.assertLogs(level="WARNING"):
+            tick = scheduler.wait()
+
+        self.assertEqual(tuple(tick), (3, 0.0, 2))
+        self.assertEqual(self.clock.now, 130.0)
+
+    def test_catch_up_runs_missed_ticks(self):
+        scheduler = self.scheduler(CATCH_UP)
+        self.clock.now += 25
+        ticks = [scheduler.wait() for _ in range(3)]
+
+        self.assertEqual(
+            [(tick.index, tick.skipped) for tick in ticks],
+            [(1, 0), (2, 0), (3, 0)])
+        self.assertEqual([tick.lateness for tick in ticks], [15, 5, 0])
+        self.assertEqual(self.clock.now, 130.0)
+
+    def test_catch_up_is_limited(self):
+        scheduler = self.scheduler(CATCH_UP, max_catch_up=2)
+        # Ticks 1 to 5 are due
+        self.clock.now += 55
+        with self.assertLogs(level="WARNING"):
+            ticks = [scheduler.wait() for _ in range(3)]
+
+        self.assertEqual(
+            [(tick.index, tick.skipped) for tick in ticks],
+            [(4, 3), (5, 0), (6, 0)])
+        self.assertEqual([tick.lateness for tick in ticks], [15, 5, 0])
+
+    def test_interval_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            DeadlineScheduler(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import logging
+import unittest
+from unittest.mock import patch
+
+import service_logging
+from service_logging import PeriodicSummary, RateLimitFilter
+
+
+def record(msg, args, created, level=logging.ERROR):
+    record = logging.LogRecord(
+        "root", level, __file__, 1, msg, args, None)
+    record.created = created
+    return record
+
+
+class RateLimitFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = RateLimitFilter(period=10, burst=2)
+
+    def test_template_is_one_event(self):
+        passed = [
+            self.filter.filter(record("Invalid command %s", (name,), 0))
+            for name in ("a", "b", "c", "d")]
+
+        self.assertEqual(passed, [True, True, False, False])
+
+    def test_next_window_reports_dropped(self):
+        for created in range(4):
+            self.filter.filter(record("Lost %d", (created,), created))
+
+        late = record("Lost %d", (9,), 10)
+        self.assertTrue(self.filter.filter(late))
+        self.assertEqual(
+            late.getMessage(), "Lost 9 (2 similar messages dropped)")
+
+    def test_levels_and_templates_are_separate(self):
+        for _ in range(3):
+            self.filter.filter(record("Lost %d", (1,), 0))
+
+        self.assertTrue(self.filter.filter(record("Other %d", (1,), 0)))
+        self.assertTrue(self.filter.filter(
+            record("Lost %d", (1,), 0, level=logging.WARNING)))
+
+    def test_old_events_are_evicted(self):
+        limited = RateLimitFilter(period=10, burst=1, max_events=2)
+        limited.filter(record("a", None, 0))
+        limited.filter(record("b", None, 0))
+        limited.filter(record("c", None, 20))
+
+        self.assertEqual(
+            [key[2] for key in limited.events], ["c"])
+
+
+class PeriodicSummaryTest(unittest.TestCase):
+
+    def test_one_line_per_interval(self):
+        with patch.object(service_logging.time, "monotonic") as monotonic:
+            monotonic.return_value = 100.0
+            summary = PeriodicSummary(interval=10)
+            with self.assertLogs(level="INFO") as logs:
+                for _ in range(3):
+                    summary.add("received")
+                summary.add("inserted", 2)
+                monotonic.return_value = 110.0
+                summary.add("received")
+                logging.info("end")
+
+        self.assertEqual(logs.output, [
+            "INFO:root:4 received, 2 inserted in last 10s",
+            "INFO:root:end",
+        ])
+
+    def test_flush_logs_remaining_counts(self):
+        summary = PeriodicSummary(interval=10)
+        with self.assertLogs(level="INFO") as logs:
+            summary.add("buffered")
+            summary.flush()
+            summary.flush()
+            logging.info("end")
+
+        self.assertEqual(logs.output, [
+            "INFO:root:1 buffered in last 0s", "INFO:root:end"])
+
+
+if __name__ == "__main__":
+    unittest.main()